@@ -0,0 +1,171 @@
+# standard library imports
+import array
+import sys
+
+# 3rd party library imports
+import numpy as np
+import pandas as pd
+
+
+class RecordBatch(object):
+    """
+    Accumulate parsed log records column by column, so that a dataframe can
+    be built without first collecting a tuple for each line.
+
+    The string columns are dictionary-encoded as they arrive, i.e. each
+    distinct value is kept only once and each record holds an integer code.
+    They become categorical columns in the dataframe, so that the
+    processors can group and look up IDs by code rather than by hashing the
+    strings over and over again.
+
+    Attributes
+    ----------
+    date_codes : array.array
+        For each record, the index of its timestamp in timestamps.
+    memory_usage : int
+        Estimate of the number of bytes held by the batch.
+    timestamps : dict
+        Maps each distinct timestamp string to its index.  A busy log has
+        far fewer distinct timestamps than lines, so each one need only be
+        parsed once.
+    ip_address, path, referer, user_agent : array.array
+        Codes of the string columns.
+    ip_address_values, path_values, referer_values, user_agent_values : dict
+        Maps each distinct value of the string columns to its code.
+    status_code, nbytes : array.array
+        Integer columns, stored unboxed.
+    """
+    columns = [
+        'date', 'ip_address', 'path', 'hits', 'status_code', 'nbytes',
+        'referer', 'user_agent'
+    ]
+
+    # Approximate cost of a record, i.e. the unboxed codes and integers.
+    RECORD_OVERHEAD = 7 * 8
+
+    # Approximate cost of a distinct string beyond its characters, i.e. the
+    # string object plus its dictionary entry.
+    VALUE_OVERHEAD = sys.getsizeof('') + 3 * 8
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.date_codes)
+
+    def clear(self):
+        """
+        Reset for the next batch.
+        """
+        self.date_codes = array.array('q')
+        self.timestamps = {}
+        self.ip_address = array.array('q')
+        self.path = array.array('q')
+        self.status_code = array.array('q')
+        self.nbytes = array.array('q')
+        self.referer = array.array('q')
+        self.user_agent = array.array('q')
+
+        self.ip_address_values = {}
+        self.path_values = {}
+        self.referer_values = {}
+        self.user_agent_values = {}
+
+        self.memory_usage = 0
+
+    def append(self, record):
+        """
+        Parameters
+        ----------
+        record : tuple
+            As produced by the tokenizer, i.e. (timestamp, ip_address, path,
+            hits, status_code, nbytes, referer, user_agent).
+        """
+        (timestamp, ip_address, path, _,
+         status_code, nbytes, referer, user_agent) = record
+
+        try:
+            code = self.timestamps[timestamp]
+        except KeyError:
+            code = self.timestamps[timestamp] = len(self.timestamps)
+        self.date_codes.append(code)
+
+        self.status_code.append(status_code)
+        self.nbytes.append(nbytes)
+        self.memory_usage += self.RECORD_OVERHEAD
+
+        self.ip_address.append(self.encode(self.ip_address_values,
+                                           ip_address))
+        self.path.append(self.encode(self.path_values, path))
+        self.referer.append(self.encode(self.referer_values, referer))
+        self.user_agent.append(self.encode(self.user_agent_values,
+                                           user_agent))
+
+    def encode(self, values, value):
+        """
+        Parameters
+        ----------
+        values : dict
+            Maps each distinct value of a column to its code.
+        value : str
+            The value of the column for the current record.
+
+        Returns
+        -------
+            the code of the value
+        """
+        n = len(values)
+        code = values.setdefault(value, n)
+        if code == n:
+            self.memory_usage += self.VALUE_OVERHEAD + len(value)
+        return code
+
+    def to_dataframe(self):
+        """
+        Build a dataframe directly from the columns.  Each line counts as
+        one hit.  The string columns are categorical.
+        """
+        data = {
+            'date': self.decode_timestamps(),
+            'ip_address': self.categorical(self.ip_address,
+                                           self.ip_address_values),
+            'path': self.categorical(self.path, self.path_values),
+            'hits': np.ones(len(self), dtype=np.int64),
+            'status_code': np.frombuffer(self.status_code, dtype=np.int64),
+            'nbytes': np.frombuffer(self.nbytes, dtype=np.int64),
+            'referer': self.categorical(self.referer, self.referer_values),
+            'user_agent': self.categorical(self.user_agent,
+                                           self.user_agent_values),
+        }
+        return pd.DataFrame(data, columns=self.columns)
+
+    def categorical(self, codes, values):
+        """
+        Parameters
+        ----------
+        codes : array.array
+            Codes of a string column.
+        values : dict
+            Maps each distinct value of the column to its code.  The codes
+            are assigned in insertion order.
+
+        Returns
+        -------
+            pandas categorical
+        """
+        codes = np.frombuffer(codes, dtype=np.int64)
+        return pd.Categorical.from_codes(codes, categories=list(values))
+
+    def decode_timestamps(self):
+        """
+        Parse each distinct timestamp once, then map them back onto the
+        records.
+
+        Returns
+        -------
+            datetime64 array
+        """
+        format = '%d/%b/%Y:%H:%M:%S'
+        dates = pd.to_datetime(list(self.timestamps), format=format)
+        codes = np.frombuffer(self.date_codes, dtype=np.int64)
+        return dates.values.take(codes)
@@ -0,0 +1,299 @@
+# Standard library imports
+import datetime as dt
+
+# 3rd party library imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from .common import CommonProcessor
+from .schema import TIERS, floor_epoch, tier_table, to_epoch
+from .sketches import HyperLogLog, hash_values, merge_sketches
+
+# Service ID standing for all requests, known service or not.
+ALL_REQUESTS = 0
+
+
+class ClientsProcessor(CommonProcessor):
+    """
+    Estimate the number of distinct clients (IP addresses) for each hour,
+    both overall and for each service, with HyperLogLog sketches.  The
+    sketches are stored rather than the counts, so the number of clients
+    over a day or a week is found by merging them.  The hourly sketches are
+    also merged into daily and weekly ones as they arrive.
+
+    Attributes
+    ----------
+    precision : int
+        Each sketch has 2 ** precision registers.
+    """
+    # Keep well clear of SQLite's limit on the number of host parameters.
+    chunk_size = 500
+
+    def __init__(self, project, precision=12, **kwargs):
+        """
+        Parameters
+        ----------
+        precision : int
+            Each sketch has 2 ** precision registers.
+        """
+        super().__init__(project, **kwargs)
+
+        self.precision = precision
+        self.aggregate_keys = ['date', 'id']
+        self.tables = ['summary_clients', 'service_clients']
+
+    def aggregate_raw_records(self, df):
+        """
+        Sketch the clients of the raw records for each time bucket.  The
+        database is not touched, so this may be run in a worker process.
+
+        Parameters
+        ----------
+        df : dataframe
+            The shared batch of raw records, already classified into the
+            "service_id" column.  It must not be modified.
+
+        Returns
+        -------
+            dataframe of the serialized sketch for each time bucket and
+            service ID, with ALL_REQUESTS standing for all of them
+        """
+        # Only the distinct IP addresses need be hashed.
+        ips = df['ip_address'].astype('category')
+        hashes = hash_values(ips.cat.categories).take(ips.cat.codes.values)
+
+        # Requests for unknown services only count towards the overall
+        # sketches.
+        service_id = df['service_id'].values
+        known = service_id >= 0
+
+        keys = pd.DataFrame({
+            'date': np.concatenate((df['bucket'].values,
+                                    df['bucket'].values[known])),
+            'id': np.concatenate((np.full(len(df), ALL_REQUESTS),
+                                  service_id[known])),
+        })
+        hashes = np.concatenate((hashes, hashes[known]))
+
+        groups = keys.groupby(['date', 'id'], sort=False).ngroup().values
+        sketches = HyperLogLog.from_groups(groups, hashes, self.precision)
+
+        df = keys.drop_duplicates().reset_index(drop=True)
+        df['sketch'] = [sketch.to_bytes() for sketch in sketches]
+        return df
+
+    def combine_aggregates(self, dfs):
+        """
+        Combine several sets of sketches, e.g. from different log fragments,
+        by merging them.
+
+        Parameters
+        ----------
+        dfs : list
+            Dataframes as produced by aggregate_raw_records.
+
+        Returns
+        -------
+            dataframe, or None if there was nothing to combine
+        """
+        dfs = [df for df in dfs if df is not None and len(df) > 0]
+        if len(dfs) == 0:
+            return None
+        elif len(dfs) == 1:
+            return dfs[0]
+
+        df = (pd.concat(dfs, axis='index', sort=False)
+                .groupby(self.aggregate_keys)['sketch']
+                .agg(merge_sketches)
+                .reset_index())
+        return df
+
+    def update_database(self, df):
+        """
+        Merge the sketches into those already in the database, for each
+        tier.  The caller is responsible for committing.
+        """
+        epochs = to_epoch(df['date'])
+
+        for tier in TIERS:
+
+            key = TIERS[tier]['key']
+            df_tier = (df.assign(date=floor_epoch(epochs, tier))
+                         .rename(columns={'date': key}))
+            if tier != 'hourly':
+                df_tier = (df_tier.groupby([key, 'id'], sort=False)['sketch']
+                                  .agg(merge_sketches)
+                                  .reset_index())
+
+            is_all = df_tier['id'] == ALL_REQUESTS
+            self.merge_sketches_with_database(
+                df_tier[is_all], tier_table('summary_clients', tier), [key]
+            )
+            self.merge_sketches_with_database(
+                df_tier[~is_all], tier_table('service_clients', tier),
+                [key, 'id']
+            )
+
+    def merge_sketches_with_database(self, df, table, keys):
+        """
+        Parameters
+        ----------
+        df : dataframe
+            Serialized sketches keyed by the start of the time bucket in
+            seconds since the epoch.
+        table : str
+            Either summary_clients or service_clients, or the table for
+            another tier.
+        keys : list
+            Columns that uniquely identify a sketch in the table, the time
+            bucket first.
+        """
+        if len(df) == 0:
+            return
+
+        existing = self.select_sketches(df, table, keys)
+
+        # The keys are all integers, whatever types they were read as.
+        params = []
+        for row in df[keys + ['sketch']].itertuples(index=False):
+            key = tuple(int(value) for value in row[:-1])
+            sketch = row[-1]
+            if key in existing:
+                sketch = merge_sketches((sketch, existing[key]))
+            params.append((*key, sketch))
+
+        placeholders = ', '.join('?' * (len(keys) + 1))
+        sql = f"""
+               INSERT OR REPLACE INTO {table} ({', '.join(keys)}, sketch)
+               VALUES ({placeholders})
+               """
+        self.conn.executemany(sql, params)
+
+    def select_sketches(self, df, table, keys):
+        """
+        Read back the sketches already in the database for just the keys of
+        the batch, so that a late batch does not drag in everything since.
+
+        Parameters
+        ----------
+        df : dataframe
+            Serialized sketches, as for merge_sketches_with_database.
+        table : str
+            Either summary_clients or service_clients, or the table for
+            another tier.
+        keys : list
+            Columns that uniquely identify a sketch in the table, the time
+            bucket first.
+
+        Returns
+        -------
+            dictionary mapping tuples of the integer keys to sketches
+        """
+        # Look up the IDs for each time bucket, or else the time buckets
+        # themselves.
+        if len(keys) == 1:
+            groups = [((), df[keys[0]])]
+        else:
+            groups = [
+                ((int(bucket),), group[keys[1]])
+                for bucket, group in df.groupby(keys[0], sort=False)
+            ]
+
+        condition = ''.join(f'{key} = ? AND ' for key in keys[:-1])
+
+        existing = {}
+        for prefix, values in groups:
+            values = sorted(set(int(value) for value in values))
+            for j in range(0, len(values), self.chunk_size):
+                chunk = values[j:j + self.chunk_size]
+                placeholders = ', '.join('?' * len(chunk))
+                sql = f"""
+                       SELECT {', '.join(keys)}, sketch
+                       FROM {table}
+                       WHERE {condition}{keys[-1]} IN ({placeholders})
+                       """
+                existing.update(
+                    (tuple(int(value) for value in row[:-1]), row[-1])
+                    for row in self.conn.execute(sql, (*prefix, *chunk))
+                )
+
+        return existing
+
+    def count_unique_clients(self, start, stop, service_id=ALL_REQUESTS,
+                             tier='hourly'):
+        """
+        Estimate the number of distinct clients over a span of time by
+        merging the sketches.
+
+        Parameters
+        ----------
+        start, stop : datetime
+            The span of time, including start but not stop.
+        service_id : int
+            Restrict to this service, otherwise all requests.
+        tier : str
+            Merge the sketches of this tier, e.g. "daily" when the span is
+            whole days.
+
+        Returns
+        -------
+            estimated number of distinct clients
+        """
+        params = [int(x) for x in to_epoch([start, stop])]
+        key = TIERS[tier]['key']
+        if service_id == ALL_REQUESTS:
+            sql = f"""
+                   SELECT sketch
+                   FROM {tier_table('summary_clients', tier)}
+                   WHERE {key} >= ? AND {key} < ?
+                   """
+        else:
+            sql = f"""
+                   SELECT sketch
+                   FROM {tier_table('service_clients', tier)}
+                   WHERE {key} >= ? AND {key} < ? AND id = ?
+                   """
+            params.append(service_id)
+
+        blobs = [row[0] for row in self.conn.execute(sql, params)]
+        if len(blobs) == 0:
+            return 0
+
+        return HyperLogLog.from_bytes(merge_sketches(blobs)).count()
+
+    def process_graphics(self, html_doc):
+        """
+        Create a table of the number of distinct clients for each of the
+        last few days and for the whole week.
+
+        Parameters
+        ----------
+        html_doc : lxml.etree.ElementTree
+            HTML document for the logs.
+        """
+        today = dt.date.today()
+        days = [today - dt.timedelta(days=n) for n in range(7, 0, -1)]
+
+        data = {
+            day.isoformat(): self.count_unique_clients(
+                day, day + dt.timedelta(days=1), tier='daily'
+            )
+            for day in days
+        }
+        data['week'] = self.count_unique_clients(days[0], today,
+                                                 tier='daily')
+
+        df = pd.Series(data, name='clients').to_frame()
+        df.index.name = 'day'
+
+        kwargs = {
+            'aname': 'clients',
+            'atext': 'Distinct Clients',
+            'h1text': 'Distinct Clients (IP addresses) by Day',
+            'ptext': (
+                'These are estimates, good to within a few percent.  The week '
+                'is not the sum of the days, as many clients return.'
+            ),
+        }
+        self.create_html_table(df, html_doc, **kwargs)
@@ -2,7 +2,8 @@
 import argparse
 
 # local imports
-from .parse_apache_logs import ApacheLogParser
+from .explain import explain_sql
+from .parse_apache_logs import ApacheLogParser, collect_log_files
 from .initialize import Initializer
 
 
@@ -14,7 +15,56 @@ def parse_arcgis_apache_logs():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('project', choices=['idpgis', 'nowcoast'])
-    parser.add_argument('--infile')
+
+    help = (
+        "Gzipped log file(s) to parse.  Directories and glob patterns are "
+        "also accepted.  Use \"-\" to read from stdin (gzipped or not)."
+    )
+    parser.add_argument('--infile', nargs='+', help=help)
+
+    help = (
+        "Keep reading the (uncompressed) log file as it grows, like "
+        "\"tail -f\".  Stop with Ctrl-C."
+    )
+    parser.add_argument('--follow', action='store_true', help=help)
+
+    help = (
+        "When reading stdin or following a file, merge into the database at "
+        "least this often (in seconds).  Default is %(default)s."
+    )
+    parser.add_argument('--flush-interval', type=float, default=60,
+                        help=help)
+
+    help = (
+        "When reading stdin or following a file, also merge into the "
+        "database after this many records."
+    )
+    parser.add_argument('--flush-lines', type=int, help=help)
+
+    help = (
+        "Parse multiple log files across this many processes.  Default is "
+        "the number of processors on the machine."
+    )
+    parser.add_argument('--workers', type=int, help=help)
+
+    help = (
+        "Flush a batch of log records to the database once it is estimated "
+        "to use this many megabytes.  Default is %(default)s."
+    )
+    parser.add_argument('--memory-budget', type=int, default=512, help=help)
+
+    help = (
+        "Parse log files even if they have already been ingested.  Their "
+        "counts will be added to the database again."
+    )
+    parser.add_argument('--force', action='store_true', help=help)
+
+    help = (
+        "Only keep this many IP addresses, referers, and user agents per "
+        "hour, plus one row for all the others.  The counts of those kept "
+        "are lower bounds, stored along with their error bounds."
+    )
+    parser.add_argument('--heavy-hitters', type=int, metavar='K', help=help)
 
     help = 'If specified, ignore the user agent, referer, and IP address'
     parser.add_argument('--services-only', action='store_true', help=help)
@@ -27,10 +77,30 @@ def parse_arcgis_apache_logs():
 
     args = parser.parse_args()
 
-    log_processor = ApacheLogParser(args.project, infile=args.infile,
-                                    document_root=args.document_root,
-                                    services_only=args.services_only)
-    log_processor.parse_input()
+    if args.infile is None:
+        infile = None
+    elif args.infile == ['-']:
+        infile = '-'
+    else:
+        infile = collect_log_files(args.infile)
+
+    kwargs = {
+        'infile': infile,
+        'document_root': args.document_root,
+        'services_only': args.services_only,
+        'memory_budget': args.memory_budget * 2 ** 20,
+        'heavy_hitters': args.heavy_hitters,
+    }
+    log_processor = ApacheLogParser(args.project, **kwargs)
+
+    kwargs = {
+        'max_workers': args.workers,
+        'force': args.force,
+        'follow': args.follow,
+        'flush_interval': args.flush_interval,
+        'flush_lines': args.flush_lines,
+    }
+    log_processor.parse_input(**kwargs)
 
 
 def produce_arcgis_apache_graphics():
@@ -52,6 +122,41 @@ def produce_arcgis_apache_graphics():
     p.process_graphics()
 
 
+def explain_arcgis_apache_sql():
+    """
+    Entry point for checking how the database executes the SQL.
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('project', choices=['idpgis', 'nowcoast'])
+
+    help = (
+        "Gzipped log file(s) to parse into a copy of the database, so that "
+        "the statements that merge records are reported too."
+    )
+    parser.add_argument('--infile', nargs='+', help=help)
+
+    help = "Also report the statements issued when producing the graphics."
+    parser.add_argument('--graphics', action='store_true', help=help)
+
+    help = (
+        "The database is in this directory.  Default is "
+        "$HOME/Documents/arcgis_apache_logs"
+    )
+    parser.add_argument('--document-root', nargs='?', help=help)
+
+    args = parser.parse_args()
+
+    if args.infile is None:
+        infile = None
+    else:
+        infile = collect_log_files(args.infile)
+
+    explain_sql(args.project, document_root=args.document_root,
+                infile=infile, graphics=args.graphics)
+
+
 def init_db():
     """
     Entry point for initializing the database.
@@ -64,10 +169,35 @@ def init_db():
     help = "Initialize the database in this directory."
     parser.add_argument('--document-root', nargs='?', help=help)
 
+    help = (
+        "Load the services from a snapshot rather than from the web site.  "
+        "Without a path, use the snapshot saved by the last retrieval."
+    )
+    parser.add_argument('--from-snapshot', nargs='?', const=True, help=help)
+
+    help = (
+        "Only add new services to an existing database, leaving everything "
+        "else alone."
+    )
+    parser.add_argument('--refresh', action='store_true', help=help)
+
+    help = "Retrieve this many folders of services at a time."
+    parser.add_argument('--workers', type=int, default=8, help=help)
+
     args = parser.parse_args()
 
     with Initializer(args.project, document_root=args.document_root) as p:
-        p.initialize()
+
+        if args.from_snapshot is True:
+            snapshot = p.snapshot_path
+        else:
+            snapshot = args.from_snapshot
+
+        kwargs = {'snapshot': snapshot, 'max_workers': args.workers}
+        if args.refresh:
+            p.refresh(**kwargs)
+        else:
+            p.initialize(**kwargs)
 
 
 def prune_arcgis_apache_database():
@@ -1,4 +1,5 @@
 # Standard library imports
+import datetime as dt
 import logging
 import pathlib
 import sqlite3
@@ -6,8 +7,46 @@ import sqlite3
 # 3rd party library imports
 from lxml import etree
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
+# Local imports
+from .schema import TIERS, floor_epoch, from_epoch, tier_table, to_epoch
+from .sketches import HeavyHitters
+
+
+def connect(database):
+    """
+    Open the database, tuned for merging batches of records.  Readers, e.g.
+    worker processes, do not block the writer in WAL mode, and only the
+    WAL is synced at each commit, not the database itself.
+
+    Parameters
+    ----------
+    database : path or str
+        Path to database
+
+    Returns
+    -------
+        sqlite3 connection
+    """
+    detect_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    conn = sqlite3.connect(database, detect_types=detect_types)
+
+    # Force foreign key support.
+    conn.execute("PRAGMA foreign_keys = 1")
+
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+
+    # 64MB of page cache (negative means KiB), temporary tables and indexes
+    # in memory, and up to 256MB of the database read through mmap.
+    conn.execute("PRAGMA cache_size = -65536")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")
+
+    return conn
+
 
 def millions_fcn(x, pos):
     """
@@ -37,14 +76,32 @@ class CommonProcessor(object):
         database connectivity
     database : path or str
         Path to database
+    aggregate_keys : list
+        Columns that uniquely identify a row of aggregated records.
+    data_retention_days : int
+        The time series only reach back this many days, or to the beginning
+        if None.
     frequency : str
         How to resample the dataframe of apache log records.
+    heavy_hitters : HeavyHitters
+        If not None, only the top keys for each time bucket are kept.
+    lut_cache : LookupTableCache
+        Resolves names to IDs for processors with a lookup table.
     project : str
         Either nowcoast or idpgis
-    records : list
-        Raw records collected, one for each apache log entry.
+    retention_days : dict
+        How many days each tier of the tables is kept, or None for forever.
+    tables : list
+        The aggregate tables merged into, by the names of the hourly tables.
     """
-    def __init__(self, project, document_root=None, logger=None):
+    def __init__(self, project, document_root=None, logger=None, conn=None):
+        """
+        Parameters
+        ----------
+        conn : obj
+            database connectivity shared with other processors, otherwise
+            the processor opens its own
+        """
 
         self.project = project
 
@@ -64,16 +121,18 @@ class CommonProcessor(object):
             self.root.mkdir(parents=True, exist_ok=True)
 
         self.database = self.root / f'arcgis_apache_{self.project}.db'
-        self.conn = sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        if conn is None:
+            conn = connect(self.database)
+        self.conn = conn
         self.cursor = self.conn.cursor()
 
-        # Force foreign key support.
-        self.conn.execute("PRAGMA foreign_keys = 1")
-
-        self.MAX_RAW_RECORDS = 100000000
-
-        self.records = []
         self.frequency = '1H'
+        self.aggregate_keys = ['date']
+        self.data_retention_days = None
+        self.lut_cache = None
+        self.heavy_hitters = None
+        self.tables = []
+        self.retention_days = {'hourly': 7, 'daily': 365, 'weekly': None}
 
     def __enter__(self):
         return self
@@ -135,11 +194,43 @@ class CommonProcessor(object):
         data should be summed/aggregated for each time interval.
         """
 
-        df = pd.read_sql(self.time_series_sql, self.conn)
+        df = self.get_rollup(self.time_series_sql,
+                             params=self.time_series_params())
 
         self.df = df
         self.df_today = self.df[self.df.date.dt.day == self.df.date.max().day]
 
+    def get_rollup(self, sql, params=None):
+        """
+        Read aggregates from the table of any tier.
+
+        Parameters
+        ----------
+        sql : str
+            Query returning the start of each time bucket as "date".
+        params : sequence
+            Parameters for the query, if any.
+
+        Returns
+        -------
+            dataframe with the dates converted from seconds since the epoch
+        """
+        df = pd.read_sql(sql, self.conn, params=params)
+        df['date'] = from_epoch(df['date'])
+        return df
+
+    def time_series_params(self):
+        """
+        Parameters for the time series SQL.  If there is a retention period,
+        the time series starts that many days ago, which lets it be read
+        from the primary keys.
+        """
+        if self.data_retention_days is None:
+            return None
+
+        start = dt.datetime.now() - dt.timedelta(days=self.data_retention_days)
+        return (int(to_epoch([start])[0]),)
+
     def write_html_and_image_output(self, df, html_doc, title=None,
                                     filename=None, yaxis_formatter=None,
                                     folder=None, restrict_handles=True,
@@ -233,40 +324,297 @@ class CommonProcessor(object):
 
         div.append(table)
 
-    def merge_with_database(self, df_current, table):
+    def aggregate_by_frequency(self, df, keys, columns=None):
+        """
+        Sum the counters of the shared batch dataframe for each time bucket
+        and key.  The batch is not copied.
+
+        Parameters
+        ----------
+        df : dataframe
+            The batch of raw records, which already has the time bucket in
+            the "bucket" column.
+        keys : list
+            Column names (or series aligned with the batch) to group by in
+            addition to the time bucket.  These are usually categorical, in
+            which case only the combinations actually seen are kept.
+        columns : list
+            The counters to sum.  Defaults to hits, errors, and nbytes.
+
+        Returns
+        -------
+            dataframe with the time bucket in the "date" column
+        """
+        if columns is None:
+            columns = ['hits', 'errors', 'nbytes']
+
+        df = (df.groupby(['bucket'] + keys, observed=True)[columns]
+                .sum()
+                .reset_index()
+                .rename(columns={'bucket': 'date'}))
+        return df
+
+    def combine_aggregates(self, dfs):
+        """
+        Combine several sets of aggregated records, e.g. from different log
+        fragments, into a single set.
+
+        Parameters
+        ----------
+        dfs : list
+            Dataframes as produced by aggregate_raw_records.
+
+        Returns
+        -------
+            dataframe, or None if there was nothing to combine
+        """
+        dfs = [df for df in dfs if df is not None and len(df) > 0]
+        if len(dfs) == 0:
+            return None
+        elif len(dfs) == 1:
+            return dfs[0]
+        elif self.heavy_hitters is not None:
+            return self.heavy_hitters.merge(dfs)
+
+        df = (pd.concat(dfs, axis='index', sort=False)
+                .groupby(self.aggregate_keys, observed=True)
+                .sum()
+                .reset_index())
+        return df
+
+    def upgrade_tables(self):
+        """
+        Bring the tables of a database created by an older version up to
+        date.  Nothing to do by default.
+        """
+        pass
+
+    def add_missing_column(self, table, column, declaration):
         """
-        The current set of records may overlap with existing records in the
-        database, so we must merge them.
+        Add a column to a table if it does not already have it.
+
+        Parameters
+        ----------
+        table, column : str
+            Names of the table and the column.
+        declaration : str
+            Type of the column, e.g. "integer".
         """
-        start = df_current.iloc[0].date.isoformat()
+        sql = f"""
+               PRAGMA table_info({table})
+               """
+        columns = [row[1] for row in self.conn.execute(sql)]
+        if column in columns:
+            return
 
-        # Get everything from the database after this time.
+        self.logger.info(f"Adding {column} to {table}...")
         sql = f"""
-               SELECT *
-               FROM {table}
-               WHERE date >= ?
-               ORDER BY date
+               ALTER TABLE {table}
+               ADD COLUMN {column} {declaration}
                """
-        df_database = pd.read_sql(sql, self.conn, params=(start,))
-        if df_database.shape[0] == 0:
-            # Nothing to merge.
-            return df_current
+        self.conn.execute(sql)
+        self.conn.commit()
+
+    def replace_with_ids(self, df, column):
+        """
+        Don't log the names themselves to the database, log the IDs from the
+        lookup table instead.  Any names not yet in the lookup table are
+        added to it first.
+
+        Only the distinct names are resolved, through the lookup table
+        cache.  The IDs are then mapped back onto the rows by their
+        categorical codes.
+
+        Parameters
+        ----------
+        df : dataframe
+            Aggregated records.
+        column : str
+            Column of names to be replaced by the "id" column.
+
+        Returns
+        -------
+            dataframe with the IDs in place of the names
+        """
+        values = df[column].astype('category')
+        ids = self.lut_cache.get_ids(values.cat.categories)
+
+        df = df.drop([column], axis='columns')
+        df['id'] = ids.take(values.cat.codes.values)
+        return df
+
+    def merge_with_tiers(self, df, table, keys=None):
+        """
+        Merge aggregated records into the table for each tier, so that the
+        daily and weekly tables are kept up to date along with the hourly
+        one.  Summaries of heavy hitters, i.e. records with error bounds,
+        are merged as summaries.  The caller is responsible for committing.
+
+        Parameters
+        ----------
+        df : dataframe
+            Aggregated records, with IDs in place of any names.
+        table : str
+            The hourly database table.
+        keys : list
+            Columns other than the time that uniquely identify a row of the
+            table.  Defaults to the ID.
+        """
+        for tier in TIERS:
+            if 'hits_error' in df.columns:
+                self.merge_summary_with_database(df, table, tier=tier)
+            else:
+                self.merge_with_database(df, table, keys=keys, tier=tier)
+
+    def merge_summary_with_database(self, df, table, tier='hourly'):
+        """
+        Merge a summary of heavy hitters into the database.  The rows already
+        there for the same time buckets, e.g. from an earlier run, are a
+        summary as well, so the two are merged and truncated as summaries
+        rather than simply added.  Adding them would neither keep the bounds
+        on the hits of each key nor the number of rows of each bucket.
+
+        The caller is responsible for committing.
 
-        # Delete those rows, as we will be replacing them.
+        Parameters
+        ----------
+        df : dataframe
+            Summary as produced by HeavyHitters, with IDs in place of any
+            names.
+        table : str
+            The hourly database table.
+        tier : str
+            Merge into the table for this tier instead, rolling the summary
+            up to its time buckets.
+        """
+        if len(df) == 0:
+            return
+
+        key = TIERS[tier]['key']
+        table = tier_table(table, tier)
+        counters = self.heavy_hitters.counters
+        columns = [key, 'id'] + counters + ['hits_error']
+
+        # Each hour is a summary of its own, even when rolled up into a
+        # longer time bucket.
+        hours = to_epoch(df['date'])
+        df = df.assign(date=floor_epoch(hours, tier))
+        parts = [part for _, part in df.groupby(hours, sort=False)]
+
+        buckets = np.unique(df['date'])
         sql = f"""
-               DELETE
+               SELECT {', '.join(columns)}
                FROM {table}
-               WHERE date >= ?
+               WHERE {key} BETWEEN ? AND ?
                """
-        self.cursor.execute(sql, (start,))
+        params = (int(buckets[0]), int(buckets[-1]))
+        stored = (pd.read_sql(sql, self.conn, params=params)
+                    .rename(columns={key: 'date'})
+                    .fillna({'hits_error': 0})
+                    .astype('int64'))
+        stored = stored[stored['date'].isin(buckets)]
+
+        # The summaries are keyed by ID, so the other row is too.
+        other = self.lut_cache.get_ids([self.heavy_hitters.other])[0]
+        summary = HeavyHitters('id', self.heavy_hitters.capacity,
+                               other=int(other), counters=counters)
+        df = (summary.merge([stored] + parts)
+                     .rename(columns={'date': key})
+                     .astype('int64'))
 
-        # Aggregate the two dataframes together.
-        if table == 'summary':
-            group_cols = ['date']
-        else:
-            group_cols = ['date', 'id']
-        df = (pd.concat((df_current, df_database), axis='index', sort=False)
-                .groupby(group_cols)
-                .sum()
-                .reset_index())
-        return df
+        sql = f"""
+               DELETE FROM {table}
+               WHERE {key} = ?
+               """
+        self.conn.executemany(sql, [(int(x),) for x in buckets])
+
+        placeholders = ', '.join('?' * len(columns))
+        sql = f"""
+               INSERT INTO {table} ({', '.join(columns)})
+               VALUES ({placeholders})
+               """
+        self.conn.executemany(sql, df[columns].itertuples(index=False,
+                                                          name=None))
+
+    def merge_with_database(self, df, table, keys=None, replace=None,
+                            tier='hourly'):
+        """
+        Merge aggregated records into the database.  The counters of rows
+        already there with the same keys, e.g. from another fragment of the
+        same hour, are added to in place.  Only those rows are touched, so
+        the cost depends upon the size of the batch, not how late it is.
+
+        The caller is responsible for committing.
+
+        Parameters
+        ----------
+        df : dataframe
+            Aggregated records, with IDs in place of any names.
+        table : str
+            The hourly database table.
+        keys : list
+            Columns other than the time that uniquely identify a row of the
+            table.  Defaults to the ID.
+        replace : list
+            Columns whose values replace those already in the database
+            rather than being added to them.
+        tier : str
+            Merge into the table for this tier instead, rolling the records
+            up to its time buckets.
+        """
+        if len(df) == 0:
+            return
+
+        if keys is None:
+            keys = ['id']
+        replace = [] if replace is None else replace
+
+        key = TIERS[tier]['key']
+        epochs = floor_epoch(to_epoch(df['date']), tier)
+        df = df.assign(date=epochs).rename(columns={'date': key})
+        if tier != 'hourly':
+            df = (df.groupby([key] + keys, observed=True, sort=False)
+                    .sum()
+                    .reset_index())
+
+        keys = [key] + keys
+        table = tier_table(table, tier)
+
+        columns = list(df.columns)
+        updates = [
+            f"{col} = excluded.{col}"
+            if col in replace
+            else f"{col} = IFNULL({col}, 0) + excluded.{col}"
+            for col in columns if col not in keys
+        ]
+        placeholders = ', '.join('?' * len(columns))
+
+        sql = f"""
+               INSERT INTO {table} ({', '.join(columns)})
+               VALUES ({placeholders})
+               ON CONFLICT ({', '.join(keys)})
+               DO UPDATE SET {', '.join(updates)}
+               """
+        self.conn.executemany(sql, df.itertuples(index=False, name=None))
+
+    def prune_tiers(self):
+        """
+        Delete the rows of each tier of the tables that have outlived its
+        retention.  The caller is responsible for committing.
+        """
+        now = to_epoch([dt.datetime.now()])[0]
+
+        for tier, days in self.retention_days.items():
+            if days is None:
+                continue
+
+            cutoff = int(now) - days * 86400
+            for table in self.tables:
+                name = tier_table(table, tier)
+                sql = f"""
+                       DELETE FROM {name}
+                       WHERE {TIERS[tier]['key']} < ?
+                       """
+                n = self.conn.execute(sql, (cutoff,)).rowcount
+                if n > 0:
+                    self.logger.info(f"Pruned {n} rows from {name}")
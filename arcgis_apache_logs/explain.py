@@ -0,0 +1,163 @@
+# standard library imports
+import pathlib
+import re
+import sqlite3
+import tempfile
+import time
+
+# local imports
+from .parse_apache_logs import ApacheLogParser
+
+# Statements that have no query plan worth looking at.
+SKIP = ('ALTER', 'BEGIN', 'COMMIT', 'CREATE', 'DROP', 'PRAGMA', 'RELEASE',
+        'ROLLBACK', 'SAVEPOINT', 'VACUUM')
+
+# Literal values that the parameters expand to in the trace.
+LITERALS = re.compile(r"""
+    [xX]'[0-9a-fA-F]*'                    # blob
+    |
+    '(?:[^']|'')*'                        # string
+    |
+    (?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?  # number
+    """, re.VERBOSE)
+
+# A list of placeholders, e.g. for IN, of whatever length.
+PLACEHOLDERS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+class SQLTracer(object):
+    """
+    Collect the distinct SQL statements executed on one or more database
+    connections.  Statements differing only in their parameters are
+    counted as the same.
+
+    Attributes
+    ----------
+    statements : dict
+        Maps each statement, with its parameters replaced by placeholders,
+        to an example as executed and the number of times it was executed.
+    """
+    def __init__(self):
+        self.statements = {}
+
+    def __call__(self, sql):
+        """
+        Trace callback for sqlite3 connections.
+
+        Parameters
+        ----------
+        sql : str
+            Statement as executed, with its parameters expanded.
+        """
+        sql = ' '.join(sql.split())
+        if sql.upper().startswith(SKIP):
+            return
+
+        key = PLACEHOLDERS.sub('(?, ...)', LITERALS.sub('?', sql))
+        example, count = self.statements.get(key, (sql, 0))
+        self.statements[key] = (example, count + 1)
+
+    def attach(self, conn):
+        """
+        Start collecting the statements executed on a connection.
+        """
+        conn.set_trace_callback(self)
+
+    def report(self, conn, file=None):
+        """
+        Print the query plan of each statement and the time it takes when
+        run again.  Anything changed by running a statement is rolled back.
+
+        Parameters
+        ----------
+        conn : obj
+            database connectivity, in autocommit mode
+        file : file-like
+            Defaults to stdout.
+        """
+        for key, (example, count) in self.statements.items():
+
+            plan = conn.execute(f'EXPLAIN QUERY PLAN {example}').fetchall()
+
+            conn.execute('BEGIN')
+            try:
+                start = time.perf_counter()
+                conn.execute(example).fetchall()
+                elapsed = time.perf_counter() - start
+                timing = f'{elapsed * 1000:.2f} ms'
+            except sqlite3.Error as e:
+                # E.g. inserting a name into a lookup table that is already
+                # there.
+                timing = f'not timed, {e}'
+            finally:
+                conn.execute('ROLLBACK')
+
+            print(f'[{count} x, {timing}] {key}', file=file)
+
+            # Indent each step of the plan beneath its parent.
+            depth = {0: 0}
+            for id, parent, _, detail in plan:
+                depth[id] = depth.get(parent, 0) + 1
+                print(f"{'    ' * depth[id]}{detail}", file=file)
+            print(file=file)
+
+
+def explain_sql(project, document_root=None, infile=None, graphics=False):
+    """
+    Work on a copy of the database just as the package does, then report
+    the query plan and timing of every SQL statement it issued.  Useful for
+    checking that the indexes are used as the tables grow.
+
+    Parameters
+    ----------
+    project : str
+        Either nowcoast or idpgis
+    document_root : path or str
+        Directory of the database to copy.
+    infile : list
+        Log files to parse into the copy, if any.
+    graphics : bool
+        Also produce the graphics, from the copy.
+    """
+    tracer = SQLTracer()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        # Copy the database, so that it is not changed, not even upgraded.
+        # It is opened read-only, so nothing is ever written to it, not
+        # even its journal mode.
+        if document_root is None:
+            root = pathlib.Path.home() / 'Documents' / 'arcgis_apache_logs'
+        else:
+            root = pathlib.Path(document_root)
+        path = (root / f'arcgis_apache_{project}.db').resolve()
+        src = sqlite3.connect(f'{path.as_uri()}?mode=ro', uri=True)
+        dst = sqlite3.connect(f'{tmpdir}/arcgis_apache_{project}.db')
+        src.backup(dst)
+        dst.close()
+        src.close()
+
+        p = ApacheLogParser(project, infile=infile, document_root=tmpdir)
+        tracer.attach(p.conn)
+
+        if infile is not None:
+            p.parse_input(force=True)
+
+        # The time series queries are issued when the graphics are
+        # produced.
+        for processor in p.processors.values():
+            sqls = [
+                value for name, value in vars(processor).items()
+                if name.endswith('time_series_sql')
+            ]
+            params = processor.time_series_params() or ()
+            for sql in sqls:
+                processor.conn.execute(sql, params).fetchall()
+
+        if graphics:
+            p.process_graphics()
+
+        conn = sqlite3.connect(f'{tmpdir}/arcgis_apache_{project}.db',
+                               isolation_level=None)
+        tracer.report(conn)
+        conn.close()
@@ -1,15 +1,26 @@
 # standard library imports
+import concurrent.futures
 import datetime as dt
+import json
 import logging
 import pathlib
-import sqlite3
+import time
 
 # 3rd party library imports
 import pandas as pd
 import requests
 
 # Local imports
-from .common import CommonProcessor
+from .common import CommonProcessor, connect
+from .manifest import IngestManifest
+from .parse_apache_logs import ApacheLogParser
+from .schema import (
+    AGGREGATE_TABLES, TIERS, create_aggregate_table, create_burst_table,
+    set_schema_version
+)
+
+# Bump this whenever the layout of the service snapshot changes.
+SNAPSHOT_VERSION = 1
 
 
 class Initializer(CommonProcessor):
@@ -63,182 +74,55 @@ class Initializer(CommonProcessor):
         self.logger.addHandler(ch)
 
     def prune_database(self):
+        """
+        Delete whatever has outlived the retention of its tier, then give
+        back the space.  Do this at least daily, it's not too expensive.
+        """
+        p = ApacheLogParser(self.project, document_root=self.root)
+        p.prune_database()
 
-        self.conn = sqlite3.connect(self.database)
-
-        # Do this at least daily, it's not too expensive.
-        self.conn.execute('VACUUM')
-
-        if dt.date.today().weekday() != 0:
-            # If it's not Monday, do nothing.
-            return
-
-        self.drop_tables()
-
-        self.initialize_ip_address_tables()
-        self.initialize_referer_tables()
-        self.initialize_user_agent_tables()
-
-    def drop_tables():
-
-        self.drop_ip_address_tables()
-        self.drop_referer_tables()
-        self.drop_user_agent_tables()
-
-    def drop_referer_tables(self):
-
-        cursor = self.conn.cursor()
-
-        sql = """
-              DROP INDEX idx_referer_logs_date
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP TABLE referer_logs
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP INDEX idx_referer
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP TABLE referer_lut
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-        self.conn.commit()
-
-    def drop_user_agent_tables(self):
-
-        cursor = self.conn.cursor()
-
-        sql = """
-              DROP INDEX idx_user_agent_logs_date
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP TABLE user_agent_logs
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP INDEX idx_user_agent
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP TABLE user_agent_lut
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        self.conn.commit()
-
-    def drop_ip_address_tables(self):
-
-        sql = """
-              DROP INDEX idx_ip_address_logs_date
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP TABLE ip_address_logs
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP INDEX idx_ip_address
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        sql = """
-              DROP TABLE ip_address_lut
-              """
-        self.logger.info(sql)
-        cursor.execute(sql)
-
-        self.conn.commit()
-
-    def initialize(self):
+    def initialize(self, snapshot=None, max_workers=8):
+        """
+        Create the database from scratch.
 
+        Parameters
+        ----------
+        snapshot : path or str
+            If given, load the services from this snapshot rather than from
+            the project web site.
+        max_workers : int
+            Retrieve this many folders at a time from the web site.
+        """
         if self.database.exists():
             self.logger.warning(f"Deleting {self.database}")
             self.database.unlink()
 
-        self.conn = sqlite3.connect(self.database)
+        self.conn = connect(self.database)
 
         self.initialize_service_tables()
-        self.populate_service_lut()
+        self.populate_service_lut(snapshot=snapshot, max_workers=max_workers)
 
         self.initialize_ip_address_tables()
         self.initialize_referer_tables()
         self.initialize_user_agent_tables()
 
-        self.initialize_summary_table()
+        self.initialize_aggregate_tables()
 
-    def initialize_summary_table(self):
+        IngestManifest(self.conn, self.logger).initialize_table()
 
-        cursor = self.conn.cursor()
+    def initialize_aggregate_tables(self):
+        """
+        Create the aggregate tables for every tier, and the burst summary, in
+        their current form, so that there is nothing to migrate.
+        """
+        for table in AGGREGATE_TABLES:
+            for tier in TIERS:
+                create_aggregate_table(self.conn, table, tier)
 
-        # Do the summary tables exist?
-        sql = """
-              SELECT name
-              FROM sqlite_master
-              WHERE
-                  type='table'
-                  AND name NOT LIKE 'sqlite_%'
-              """
-        df = pd.read_sql(sql, self.conn)
-
-        if 'summary' not in df.name.values:
-
-            sql = """
-                  CREATE TABLE summary (
-                      date timestamp,
-                      hits integer,
-                      mapdraws integer,
-                      errors integer,
-                      nbytes integer
-                  )
-                  """
-            cursor.execute(sql)
-
-            # sql = """
-            #       CREATE UNIQUE INDEX idx_summary_date
-            #       ON summary(date)
-            #       """
-            # cursor.execute(sql)
-
-        if "burst_staging" not in df.name.values:
-
-            sql = """
-                  CREATE TABLE burst_staging (
-                      date timestamp,
-                      hits integer,
-                      errors integer,
-                      nbytes integer
-                  )
-                  """
-            cursor.execute(sql)
-
-            # sql = """
-            #       CREATE INDEX idx_burst_staging_date
-            #       ON summary(date)
-            #       """
-            # cursor.execute(sql)
+        create_burst_table(self.conn)
+
+        set_schema_version(self.conn)
+        self.conn.commit()
 
     def initialize_user_agent_tables(self):
         """
@@ -261,28 +145,6 @@ class Initializer(CommonProcessor):
               """
         cursor.execute(sql)
 
-        sql = """
-              CREATE TABLE user_agent_logs (
-                  date timestamp,
-                  id integer,
-                  hits integer,
-                  errors integer,
-                  nbytes integer,
-                  CONSTRAINT fk_user_agents_id
-                      FOREIGN KEY (id)
-                      REFERENCES user_agent_lut(id)
-                      ON DELETE CASCADE
-              )
-              """
-        cursor.execute(sql)
-
-        # This cannot be unique.  Log fragments are messy.
-        # sql = """
-        #       CREATE UNIQUE INDEX idx_user_agent_logs_date
-        #       ON user_agent_logs(date, id)
-        #           """
-        # cursor.execute(sql)
-
     def initialize_ip_address_tables(self):
         """
         Verify that all the database tables are setup properly for managing
@@ -290,44 +152,22 @@ class Initializer(CommonProcessor):
         """
         cursor = self.conn.cursor()
         # Create the known IP addresses table.  The IP addresses must be
-        # unique.
+        # unique.  They are kept only in normalized form, 16 bytes with IPv4
+        # addresses mapped into IPv6.
         sql = """
               CREATE TABLE ip_address_lut (
                   id integer PRIMARY KEY,
-                  ip_address text,
-                  name text
+                  name text,
+                  address blob
               )
               """
         cursor.execute(sql)
         sql = """
-              CREATE UNIQUE INDEX idx_ip_address
-              ON ip_address_lut(ip_address)
-              """
-        cursor.execute(sql)
-
-        # Create the IP address logs table.
-        sql = """
-              CREATE TABLE ip_address_logs (
-                  date timestamp,
-                  id integer,
-                  hits integer,
-                  errors integer,
-                  nbytes integer,
-                  CONSTRAINT fk_known_ip_address_id
-                      FOREIGN KEY (id)
-                      REFERENCES ip_address_lut(id)
-                      ON DELETE CASCADE
-              )
+              CREATE UNIQUE INDEX idx_ip_address_key
+              ON ip_address_lut(address)
               """
         cursor.execute(sql)
 
-        # Unfortunately the index cannot be unique here.
-        # sql = """
-        #       CREATE INDEX idx_ip_address_logs_date
-        #       ON ip_address_logs(date)
-        #       """
-        # cursor.execute(sql)
-
     def initialize_referer_tables(self):
         """
         Verify that all the database tables are setup properly for managing
@@ -349,33 +189,11 @@ class Initializer(CommonProcessor):
               """
         cursor.execute(sql)
 
-        sql = """
-              CREATE TABLE referer_logs (
-                  date timestamp,
-                  id integer,
-                  hits integer,
-                  errors integer,
-                  nbytes integer,
-                  CONSTRAINT fk_referer_lut_id
-                      FOREIGN KEY (id)
-                      REFERENCES referer_lut(id)
-                      ON DELETE CASCADE
-              )
-              """
-        cursor.execute(sql)
-
-        # Unfortunately the index cannot be unique here.
-        # sql = """
-        #       CREATE UNIQUE INDEX idx_referer_logs_date
-        #       ON referer_logs(date, id)
-        #       """
-        # cursor.execute(sql)
-
     def initialize_service_tables(self):
 
         cursor = self.conn.cursor()
 
-        # Create the known services and logs tables.
+        # Create the known services table.
         sql = """
               CREATE TABLE service_lut (
                   id integer PRIMARY KEY,
@@ -392,76 +210,272 @@ class Initializer(CommonProcessor):
               """
         cursor.execute(sql)
 
+    def populate_service_lut(self, snapshot=None, max_workers=8):
+        """
+        Populate the services database with existing services.
+
+        Parameters
+        ----------
+        snapshot : path or str
+            If given, load the services from this snapshot rather than from
+            the project web site.
+        max_workers : int
+            Retrieve this many folders at a time from the web site.
+        """
+        if snapshot is not None:
+            df = self.load_snapshot(snapshot)
+        else:
+            df = self.retrieve_and_save_services(max_workers=max_workers)
+
+        df.to_sql('service_lut', self.conn, index=False, if_exists='append')
+        self.conn.commit()
+
+    def refresh(self, snapshot=None, max_workers=8):
+        """
+        Add any new services to an existing database, leaving everything
+        else alone.
+
+        Parameters
+        ----------
+        snapshot : path or str
+            If given, load the services from this snapshot rather than from
+            the project web site.
+        max_workers : int
+            Retrieve this many folders at a time from the web site.
+        """
+        self.conn = connect(self.database)
+
+        if snapshot is not None:
+            df = self.load_snapshot(snapshot)
+        else:
+            df = self.retrieve_and_save_services(max_workers=max_workers)
+
+        before = self.conn.total_changes
+
         sql = """
-              CREATE TABLE service_logs (
-                  date timestamp,
-                  id integer,
-                  hits integer,
-                  errors integer,
-                  nbytes integer,
-                  export_mapdraws integer,
-                  wms_mapdraws integer,
-                  CONSTRAINT fk_service_lut_id
-                      FOREIGN KEY (id)
-                      REFERENCES service_lut(id)
-                      ON DELETE CASCADE
-              )
+              INSERT OR IGNORE INTO service_lut (folder, service, service_type)
+              VALUES (?, ?, ?)
               """
-        cursor.execute(sql)
+        records = df[['folder', 'service', 'service_type']].itertuples(
+            index=False
+        )
+        self.conn.executemany(sql, list(records))
+        self.conn.commit()
 
-        # This cannot be unique
-        # sql = """
-        #       CREATE UNIQUE INDEX idx_services_logs_date
-        #       ON service_logs(date, id)
-        #       """
-        # cursor.execute(sql)
+        n = self.conn.total_changes - before
+        self.logger.info(f"Added {n} new services.")
 
-    def populate_service_lut(self):
+    @property
+    def snapshot_path(self):
         """
-        Populate the services database with existing services.
+        Where the service catalog is saved.
         """
-        df = self.retrieve_services()
-        df.to_sql('service_lut', self.conn, index=False, if_exists='append')
-        self.conn.commit()
+        return self.root / f'arcgis_services_{self.project}.json'
 
-    def retrieve_services(self):
+    @property
+    def partial_snapshot_path(self):
         """
-        Examine the project web site and retrieve a list of the services.
+        Where an incomplete service catalog is saved, i.e. one with folders
+        that could not be retrieved.
         """
-        url = f"https://{self.project}.ncep.noaa.gov/arcgis/rest/services"
-        params = {'f': 'json'}
+        return self.root / f'arcgis_services_{self.project}.partial.json'
 
-        self.logger.info(f"Retrieving folders from {url}")
+    def retrieve_and_save_services(self, max_workers=8):
+        """
+        Retrieve the services from the project web site and save them as the
+        snapshot.  If any folders could not be retrieved, the catalog is
+        saved to the partial snapshot instead, so that it never replaces
+        the last complete one.
 
-        r = requests.get(url, params=params)
-        r.raise_for_status()
+        Parameters
+        ----------
+        max_workers : int
+            Retrieve this many folders at a time from the web site.
 
-        j = r.json()
-        folders = j['folders']
-        records = []
-        for folder in folders:
+        Returns
+        -------
+            dataframe of the folder, service, and service type of each
+            service
+        """
+        df, failed = self.retrieve_services(max_workers=max_workers)
 
-            # Retrieve the JSON metadata for the folder, which will contain
-            # the list of all services.
-            url = (
-                f"https://{self.project}.ncep.noaa.gov"
-                f"/arcgis/rest/services/{folder}"
+        if len(failed) == 0:
+            self.save_snapshot(df)
+        else:
+            msg = f"Keeping {self.snapshot_path}, the services are incomplete."
+            self.logger.warning(msg)
+            self.save_snapshot(df, path=self.partial_snapshot_path)
+
+        return df
+
+    def save_snapshot(self, df, path=None):
+        """
+        Save the service catalog so that the database can later be
+        initialized without the web site.
+
+        Parameters
+        ----------
+        df : dataframe
+            The folder, service, and service type of each service.
+        path : path or str
+            Defaults to snapshot_path.
+        """
+        path = self.snapshot_path if path is None else pathlib.Path(path)
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'project': self.project,
+            'retrieved': dt.datetime.now().isoformat(timespec='seconds'),
+            'services': df.to_dict(orient='records'),
+        }
+
+        # Write it out whole, so that a failure never leaves a truncated
+        # snapshot behind.
+        tmp = path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(snapshot, indent=1))
+        tmp.replace(path)
+
+        self.logger.info(f"Saved {len(df)} services to {path}")
+
+    def load_snapshot(self, path=None):
+        """
+        Parameters
+        ----------
+        path : path or str
+            Defaults to snapshot_path.
+
+        Returns
+        -------
+            dataframe of the folder, service, and service type of each
+            service
+        """
+        path = self.snapshot_path if path is None else pathlib.Path(path)
+
+        snapshot = json.loads(path.read_text())
+
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            msg = (
+                f"{path} is a version {snapshot.get('version')} snapshot, "
+                f"expected version {SNAPSHOT_VERSION}."
             )
+            raise ValueError(msg)
 
-            self.logger.info(f"Retrieving services from {url}")
+        if snapshot['project'] != self.project:
+            msg = f"{path} is a snapshot for {snapshot['project']}."
+            raise ValueError(msg)
+
+        columns = ['folder', 'service', 'service_type']
+        df = pd.DataFrame.from_records(snapshot['services'], columns=columns)
+
+        msg = (
+            f"Loaded {len(df)} services from {path}, retrieved "
+            f"{snapshot['retrieved']}"
+        )
+        self.logger.info(msg)
+        return df
+
+    def retrieve_services(self, max_workers=8, timeout=30, retries=3):
+        """
+        Examine the project web site and retrieve a list of the services.
+        The folders are retrieved concurrently.
 
-            r = requests.get(url, params=params)
-            r.raise_for_status()
+        Parameters
+        ----------
+        max_workers : int
+            Retrieve this many folders at a time.
+        timeout : float
+            Give up on a request after this many seconds.
+        retries : int
+            Try each request this many times.
+
+        Returns
+        -------
+            dataframe of the folder, service, and service type of each
+            service
+            list of the folders that could not be retrieved
+        """
+        url = f"https://{self.project}.ncep.noaa.gov/arcgis/rest/services"
 
-            # Save each service.
-            j = r.json()
-            for item in j['services']:
-                folder, service = item['name'].split('/')
-                service_type = item['type']
-                records.append((folder, service, service_type))
+        self.logger.info(f"Retrieving folders from {url}")
+        j = self.retrieve_json(url, timeout=timeout, retries=retries)
+        folders = j['folders']
 
+        kwargs = {'timeout': timeout, 'retries': retries}
+        records = []
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(self.retrieve_json, f'{url}/{folder}',
+                                **kwargs): folder
+                for folder in folders
+            }
+            for future in concurrent.futures.as_completed(futures):
+                folder = futures[future]
+                try:
+                    j = future.result()
+                except requests.RequestException as e:
+                    # Don't let one bad folder spoil the rest.
+                    msg = f"Unable to retrieve folder {folder}:  {e!r}"
+                    self.logger.error(msg)
+                    failed.append(folder)
+                    continue
+
+                # ArcGIS reports errors in the body, even with a status of
+                # 200.
+                if 'services' not in j:
+                    msg = (
+                        f"Unable to retrieve folder {folder}:  "
+                        f"{j.get('error')!r}"
+                    )
+                    self.logger.error(msg)
+                    failed.append(folder)
+                    continue
+
+                # Save each service.
+                for item in j['services']:
+                    folder, service = item['name'].split('/')
+                    service_type = item['type']
+                    records.append((folder, service, service_type))
+
+        if len(failed) > 0:
+            msg = (
+                f"Services are missing from {len(failed)} folder(s), "
+                f"refresh later to add them:  {', '.join(sorted(failed))}"
+            )
+            self.logger.warning(msg)
+
+        # Keep the order stable regardless of which folder came back first.
         columns = ['folder', 'service', 'service_type']
-        df = pd.DataFrame.from_records(records, columns=columns)
+        df = pd.DataFrame.from_records(sorted(records), columns=columns)
 
         self.logger.info(f"Retrieved {len(df)} services...")
-        return df
+        return df, failed
+
+    def retrieve_json(self, url, timeout=30, retries=3):
+        """
+        Retrieve the JSON metadata for a folder of services, retrying if
+        need be.
+
+        Parameters
+        ----------
+        url : str
+            The folder URL.
+        timeout : float
+            Give up on a request after this many seconds.
+        retries : int
+            Try the request this many times.
+        """
+        params = {'f': 'json'}
+
+        for attempt in range(1, retries + 1):
+            self.logger.info(f"Retrieving services from {url}")
+            try:
+                r = requests.get(url, params=params, timeout=timeout)
+                r.raise_for_status()
+                return r.json()
+            except requests.RequestException as e:
+                if attempt == retries:
+                    raise
+                msg = f"Attempt {attempt} for {url} failed:  {e!r}"
+                self.logger.warning(msg)
+                time.sleep(2 ** attempt)
@@ -1,5 +1,7 @@
 # Standard library imports
 import datetime as dt
+import functools
+import ipaddress
 
 # 3rd party library imports
 import matplotlib.pyplot as plt
@@ -8,12 +10,108 @@ import pandas as pd
 
 # Local imports
 from .common import CommonProcessor
+from .lut import LookupTableCache
+from .sketches import OTHER
+
+# IPv4 addresses are stored as IPv4-mapped IPv6 addresses, so that every
+# address has the same 16-byte key.
+IPV4_MAPPED = b'\x00' * 10 + b'\xff\xff'
+
+# Key standing for every IP address that is not a heavy hitter.
+OTHER_IP_ADDRESS = b''
+
+
+@functools.lru_cache(maxsize=100000)
+def pack_ip_address(text):
+    """
+    Normalize an IP address as found in the log.
+
+    Parameters
+    ----------
+    text : str
+        IPv4 or IPv6 address.
+
+    Returns
+    -------
+        16-byte key, or None if this is not a valid IP address
+    """
+    try:
+        address = ipaddress.ip_address(text)
+    except ValueError:
+        return None
+
+    if address.version == 4:
+        return IPV4_MAPPED + address.packed
+    else:
+        return address.packed
+
+
+def unpack_ip_address(key):
+    """
+    Parameters
+    ----------
+    key : bytes
+        16-byte key as produced by pack_ip_address.
+
+    Returns
+    -------
+        the IP address in its canonical text form
+    """
+    if key == OTHER_IP_ADDRESS:
+        return OTHER
+
+    address = ipaddress.IPv6Address(key)
+    if address.ipv4_mapped is not None:
+        return str(address.ipv4_mapped)
+    else:
+        return str(address)
+
+
+def ip_prefix(key):
+    """
+    Network prefix of an address, i.e. the /24 for IPv4 or the /48 for IPv6.
+    A single client is often spread across many addresses in such a network.
+
+    Parameters
+    ----------
+    key : bytes
+        16-byte key as produced by pack_ip_address.
+
+    Returns
+    -------
+        3 bytes for IPv4, or 6 bytes for IPv6
+    """
+    if key.startswith(IPV4_MAPPED):
+        return key[12:15]
+    else:
+        return key[:6]
+
+
+def format_ip_prefix(prefix):
+    """
+    Parameters
+    ----------
+    prefix : bytes
+        Network prefix as produced by ip_prefix.
+
+    Returns
+    -------
+        the network in CIDR notation, e.g. 192.0.2.0/24
+    """
+    if prefix == OTHER_IP_ADDRESS:
+        return OTHER
+    elif len(prefix) == 3:
+        return str(ipaddress.IPv4Network((prefix + b'\x00', 24)))
+    else:
+        return str(ipaddress.IPv6Network((prefix + b'\x00' * 10, 48)))
 
 
 class IPAddressProcessor(CommonProcessor):
     """
     Attributes
     ----------
+    prefix_time_series_sql : str
+        SQL to collect a coherent timeseries of network prefix information.
     time_series_sql : str
         SQL to collect a coherent timeseries of folder/service information.
     """
@@ -26,74 +124,244 @@ class IPAddressProcessor(CommonProcessor):
         super().__init__(project, **kwargs)
 
         self.time_series_sql = """
-            SELECT a.date, SUM(a.hits) as hits, SUM(a.errors) as errors,
-                   SUM(a.nbytes) as nbytes, b.ip_address
+            SELECT a.hour_epoch as date, SUM(a.hits) as hits,
+                   SUM(a.errors) as errors, SUM(a.nbytes) as nbytes,
+                   b.address as ip_address
             FROM ip_address_logs a
             INNER JOIN ip_address_lut b
             ON a.id = b.id
-            GROUP BY a.date, b.ip_address
-            ORDER BY a.date
+            WHERE b.address != x'' AND a.hour_epoch >= ?
+            GROUP BY a.hour_epoch, b.address
+            ORDER BY a.hour_epoch
+            """
+
+        self.prefix_time_series_sql = """
+            SELECT hour_epoch as date, prefix, SUM(hits) as hits,
+                   SUM(errors) as errors, SUM(nbytes) as nbytes
+            FROM ip_prefix_logs
+            WHERE hour_epoch >= ?
+            GROUP BY hour_epoch, prefix
+            ORDER BY hour_epoch
             """
 
         self.data_retention_days = 7
 
-    def process_raw_records(self, df):
+        self.aggregate_keys = ['date', 'ip_address']
+        self.tables = ['ip_address_logs', 'ip_prefix_logs']
+
+        # There are a great many of these, so only keep the most recently
+        # seen in memory.
+        self.lut_cache = LookupTableCache(self.conn, 'ip_address_lut',
+                                          'address', max_size=1000000)
+
+    def upgrade_tables(self):
         """
-        We have reached a limit on how many records we accumulate before
-        processing.  Turn what we have into a dataframe and aggregate it
-        to the appropriate granularity.
+        Databases created before IP addresses were stored in binary form
+        have neither the address key nor the network prefix table.  Add them,
+        filling in the key for the IP addresses already known, then drop the
+        text form of the IP addresses.  Also make room for the error bounds
+        of heavy hitters.  The prefix table is created along with the other
+        hourly tables.
         """
-        columns = ['date', 'ip_address', 'hits', 'errors', 'nbytes']
-        df = df[columns].copy()
+        cursor = self.conn.cursor()
 
-        # Aggregate by the set frequency and referer, taking sums.
-        groupers = [pd.Grouper(freq=self.frequency), 'ip_address']
-        df = df.set_index('date').groupby(groupers).sum().reset_index()
+        sql = """
+              PRAGMA table_info(ip_address_lut)
+              """
+        columns = [row[1] for row in cursor.execute(sql)]
 
-        df = self.replace_ip_addresses_with_ids(df)
+        if 'address' not in columns:
+            self.logger.info("Adding binary keys to ip_address_lut...")
 
-        df = self.merge_with_database(df, 'ip_address_logs')
+            sql = """
+                  ALTER TABLE ip_address_lut
+                  ADD COLUMN address blob
+                  """
+            cursor.execute(sql)
 
-        df.to_sql('ip_address_logs', self.conn,
-                  if_exists='append', index=False)
+            sql = """
+                  SELECT id, ip_address FROM ip_address_lut
+                  """
+            rows = cursor.execute(sql).fetchall()
+
+            # Different spellings of the same address keep their old rows,
+            # but only the first gets the key.
+            keys = set()
+            params = []
+            for id, text in rows:
+                key = pack_ip_address(text)
+                if key is None or key in keys:
+                    continue
+                keys.add(key)
+                params.append((key, id))
+
+            sql = """
+                  UPDATE ip_address_lut
+                  SET address = ?
+                  WHERE id = ?
+                  """
+            cursor.executemany(sql, params)
+
+        if 'ip_address' in columns:
+            self.logger.info("Dropping text keys from ip_address_lut...")
+
+            # Without the text, rows that did not get a key cannot be told
+            # apart, so they go, and their logs along with them.
+            sql = """
+                  DELETE FROM ip_address_lut
+                  WHERE address IS NULL
+                  """
+            cursor.execute(sql)
+
+            sql = """
+                  DROP INDEX IF EXISTS idx_ip_address
+                  """
+            cursor.execute(sql)
+
+            sql = """
+                  ALTER TABLE ip_address_lut
+                  DROP COLUMN ip_address
+                  """
+            cursor.execute(sql)
+
+        sql = """
+              CREATE UNIQUE INDEX IF NOT EXISTS idx_ip_address_key
+              ON ip_address_lut(address)
+              """
+        cursor.execute(sql)
 
         self.conn.commit()
 
-        self.records = []
+        self.add_missing_column('ip_address_logs', 'hits_error',
+                                'integer DEFAULT 0')
 
-    def replace_ip_addresses_with_ids(self, df_orig):
+    def aggregate_raw_records(self, df):
         """
-        The IP addresses themselves are not to be logged.  Rather, we wish to
-        log an ID standing for the IP address.
+        Aggregate the raw records to the set frequency.  The database is not
+        touched, so this may be run in a worker process.
+
+        Parameters
+        ----------
+        df : dataframe
+            The shared batch of raw records.  It must not be modified.
+
+        Returns
+        -------
+            dataframe with the 16-byte key of each IP address
+            dataframe rolled up by network prefix
         """
+        # Normalize each distinct IP address only once, then map the keys
+        # back onto the records by their codes.  Different spellings of an
+        # address have the same key, so the categories are encoded again.
+        ips = df['ip_address'].astype('category')
+        keys = np.array([pack_ip_address(x) for x in ips.cat.categories],
+                        dtype=object)
+        codes, uniques = pd.factorize(keys)
+        codes = codes.take(ips.cat.codes.values)
 
-        sql = """
-              SELECT id, ip_address from ip_address_lut
-              """
-        known_ips = pd.read_sql(sql, self.conn)
+        # Whatever is not an IP address must be dropped.
+        invalid = (codes < 0).sum()
+        if invalid > 0:
+            msg = f"Dropping {invalid} requests without a valid IP address"
+            self.logger.info(msg)
 
-        # Get the referer IDs
-        df = pd.merge(df_orig, known_ips, how='left', on='ip_address')
+        key = pd.Series(pd.Categorical.from_codes(codes, categories=uniques),
+                        index=df.index, name='ip_address')
 
-        # How many IP addresses have NaN for IDs?  This must populate the known
-        # IP address table before going further.
-        unknown_ips = df['ip_address'][df['id'].isnull()].unique()
-        if len(unknown_ips) > 0:
-            new_ips_df = pd.Series(unknown_ips, name='ip_address').to_frame()
+        # Aggregate by the set frequency and IP address, taking sums.
+        df = self.aggregate_by_frequency(df, [key])
 
-            new_ips_df.to_sql('ip_address_lut', self.conn,
-                              if_exists='append', index=False)
+        # The prefixes are rolled up from the exact aggregates, so that only
+        # the IP addresses themselves are cut down to the heavy hitters.
+        df_prefix = self.aggregate_prefixes(df)
 
-            sql = """
-                  SELECT id, ip_address from ip_address_lut
-                  """
-            known_ips = pd.read_sql(sql, self.conn)
+        if self.heavy_hitters is not None:
+            df = self.heavy_hitters.summarize(df)
+
+        return df, df_prefix
 
-            df = pd.merge(df_orig, known_ips, how='left', on='ip_address')
+    def combine_aggregates(self, aggregates):
+        """
+        Combine several sets of aggregated records, e.g. from different log
+        fragments, into a single set.
+
+        Parameters
+        ----------
+        aggregates : list
+            Pairs of dataframes as produced by aggregate_raw_records.
+
+        Returns
+        -------
+            pair of dataframes, or None if there was nothing to combine
+        """
+        aggregates = [item for item in aggregates if item is not None]
+        if len(aggregates) == 0:
+            return None
+
+        df = super().combine_aggregates([item[0] for item in aggregates])
+        if df is None:
+            return None
+
+        columns = ['hits', 'errors', 'nbytes']
+        df_prefix = (pd.concat([item[1] for item in aggregates],
+                               axis='index', sort=False)
+                       .groupby(['date', 'prefix'])[columns]
+                       .sum()
+                       .reset_index())
+        return df, df_prefix
+
+    def update_database(self, aggregates):
+        """
+        Merge aggregated records into the database, along with the rollup by
+        network prefix.  The caller is responsible for committing.
+
+        Parameters
+        ----------
+        aggregates : tuple
+            Pair of dataframes as produced by aggregate_raw_records.
+        """
+        df, df_prefix = aggregates
+        self.merge_with_tiers(df_prefix, 'ip_prefix_logs', keys=['prefix'])
+
+        df = self.replace_ip_addresses_with_ids(df)
+        self.merge_with_tiers(df, 'ip_address_logs')
+
+    def aggregate_prefixes(self, df):
+        """
+        Roll up the aggregated records by network prefix.
 
-        df = df.drop(['ip_address'], axis='columns')
+        Parameters
+        ----------
+        df : dataframe
+            Aggregated records with the 16-byte key of each IP address.
+        """
+        keys = df['ip_address'].astype('category')
+        prefixes = np.array([ip_prefix(x) for x in keys.cat.categories],
+                            dtype=object)
+        prefix = pd.Series(prefixes.take(keys.cat.codes.values),
+                           index=df.index, name='prefix')
+
+        columns = ['hits', 'errors', 'nbytes']
+        df = df.groupby(['date', prefix])[columns].sum().reset_index()
         return df
 
+    def get_timeseries(self):
+        """
+        Collect a timeseries of the IP addresses, rendering their keys in
+        text form.
+        """
+        super().get_timeseries()
+
+        self.df['ip_address'] = self.df['ip_address'].map(unpack_ip_address)
+        self.df_today = self.df.loc[self.df_today.index]
+
+    def replace_ip_addresses_with_ids(self, df_orig):
+        """
+        The IP addresses themselves are not to be logged.  Rather, we wish to
+        log an ID standing for the IP address.
+        """
+        return self.replace_with_ids(df_orig, 'ip_address')
+
     def process_graphics(self, html_doc):
         """Create the HTML and graphs for the IP addresses.
 
@@ -122,6 +390,7 @@ class IPAddressProcessor(CommonProcessor):
         self.summarize_ip_addresses(top_ips, html_doc)
         self.summarize_transactions(top_ips, html_doc)
         self.summarize_bandwidth(top_ips, html_doc)
+        self.summarize_prefixes(html_doc)
 
     def summarize_transactions(self, top_ips, html_doc):
 
@@ -214,3 +483,60 @@ class IPAddressProcessor(CommonProcessor):
             'h1text': f'Top IP Addresses by Hits: {yesterday}',
         }
         self.create_html_table(df, html_doc, **kwargs)
+
+    def summarize_prefixes(self, html_doc):
+        """
+        Create a table of the networks with the most hits for the latest
+        day.  A client spread across many addresses shows up here even if
+        none of its addresses make the top IP addresses.
+
+        Parameters
+        ----------
+        html_doc : etree Element
+            The table is to be inserted into this document.
+        """
+        df = self.get_rollup(self.prefix_time_series_sql,
+                             params=self.time_series_params())
+        df = df[df.date.dt.day == df.date.max().day]
+
+        columns = ['hits', 'errors', 'nbytes']
+        df = df.groupby('prefix')[columns].sum()
+        df.index = pd.Index([format_ip_prefix(x) for x in df.index],
+                            name='network')
+
+        total_hits = df['hits'].sum()
+        total_bytes = df['nbytes'].sum()
+        total_errors = df['errors'].sum()
+
+        df['hits %'] = df['hits'] / total_hits * 100
+        df['GBytes'] = df['nbytes'] / (1024 ** 3)  # GBytes
+        df['GBytes %'] = df['nbytes'] / total_bytes * 100
+
+        df['errors: % of all hits'] = df['errors'] / total_hits * 100
+        df['errors: % of all errors'] = df['errors'] / total_errors * 100
+
+        # Reorder the columns
+        reordered_cols = [
+            'hits',
+            'hits %',
+            'GBytes',
+            'GBytes %',
+            'errors',
+            'errors: % of all hits',
+            'errors: % of all errors'
+        ]
+        df = df[reordered_cols]
+
+        df = df.sort_values(by='hits', ascending=False).head(10)
+
+        yesterday = (dt.date.today() - dt.timedelta(days=1)).isoformat()
+        kwargs = {
+            'aname': 'ipprefixtable',
+            'atext': 'Top Networks Table',
+            'h1text': f'Top Networks by Hits: {yesterday}',
+            'ptext': (
+                'IPv4 addresses are grouped by /24 network, IPv6 addresses '
+                'by /48 network.'
+            ),
+        }
+        self.create_html_table(df, html_doc, **kwargs)
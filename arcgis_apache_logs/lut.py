@@ -0,0 +1,168 @@
+# standard library imports
+import collections
+
+# 3rd party library imports
+import numpy as np
+
+
+class LookupTableCache(object):
+    """
+    In-memory cache of a lookup table (e.g. ip_address_lut) mapping names to
+    IDs.  The table is read once per process, after which IDs are resolved
+    from memory.  Only names not already cached go to the database, and only
+    their rows are read back.
+
+    The lookup tables for IP addresses and referers grow without bound, so
+    the cache may be limited in size, in which case the least recently used
+    names are evicted.  They are simply looked up again if they return.
+
+    Attributes
+    ----------
+    cache : collections.OrderedDict
+        Maps names to IDs, least recently used first.
+    columns : dict
+        Other columns of the lookup table to fill in when adding a name,
+        mapped to functions computing their values from the name.
+    conn : obj
+        database connectivity
+    max_size : int
+        Maximum number of names to hold, or None for no limit.
+    name : str
+        Column of names in the lookup table.
+    table : str
+        The lookup table.
+    """
+    # Keep well clear of SQLite's limit on the number of host parameters.
+    chunk_size = 500
+
+    def __init__(self, conn, table, name, max_size=None, columns=None):
+        """
+        Parameters
+        ----------
+        conn : obj
+            database connectivity
+        table : str
+            The lookup table.
+        name : str
+            Column of names in the lookup table.
+        max_size : int
+            Maximum number of names to hold, or None for no limit.
+        columns : dict
+            Other columns of the lookup table to fill in when adding a name,
+            mapped to functions computing their values from the name.
+        """
+        self.conn = conn
+        self.table = table
+        self.name = name
+        self.max_size = max_size
+        self.columns = {} if columns is None else columns
+
+        self.cache = None
+
+    def __len__(self):
+        return 0 if self.cache is None else len(self.cache)
+
+    def load(self):
+        """
+        Read the lookup table into memory.  If it is larger than the cache,
+        only the most recently added names are kept.
+        """
+        sql = f"""
+               SELECT {self.name}, id
+               FROM {self.table}
+               WHERE {self.name} IS NOT NULL
+               ORDER BY id DESC
+               """
+        if self.max_size is not None:
+            sql += f"LIMIT {self.max_size}"
+        rows = self.conn.execute(sql).fetchall()
+
+        # Oldest first, so that they are the first to be evicted.
+        self.cache = collections.OrderedDict(reversed(rows))
+
+    def get_ids(self, names):
+        """
+        Resolve names to IDs, adding any new names to the lookup table.  The
+        caller is responsible for committing.
+
+        Parameters
+        ----------
+        names : sequence
+            Distinct names.
+
+        Returns
+        -------
+            numpy array of IDs
+        """
+        if self.cache is None:
+            self.load()
+
+        ids = {}
+        missing = []
+        for name in names:
+            try:
+                ids[name] = self.cache[name]
+            except KeyError:
+                missing.append(name)
+            else:
+                self.cache.move_to_end(name)
+
+        if len(missing) > 0:
+            found = self.select(missing)
+
+            new = [name for name in missing if name not in found]
+            if len(new) > 0:
+                self.insert(new)
+                found.update(self.select(new))
+
+            ids.update(found)
+            self.cache.update(found)
+            self.evict()
+
+        return np.array([ids[name] for name in names], dtype=np.int64)
+
+    def insert(self, names):
+        """
+        Add new names to the lookup table, along with any other columns.
+        """
+        columns = [self.name] + list(self.columns)
+        placeholders = ', '.join('?' * len(columns))
+        sql = f"""
+               INSERT INTO {self.table} ({', '.join(columns)})
+               VALUES ({placeholders})
+               """
+        params = [
+            (name, *(fcn(name) for fcn in self.columns.values()))
+            for name in names
+        ]
+        self.conn.executemany(sql, params)
+
+    def select(self, names):
+        """
+        Read back the IDs of just these names.
+
+        Returns
+        -------
+            dictionary mapping names to IDs
+        """
+        found = {}
+        for j in range(0, len(names), self.chunk_size):
+            chunk = names[j:j + self.chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            sql = f"""
+                   SELECT {self.name}, id
+                   FROM {self.table}
+                   WHERE {self.name} IN ({placeholders})
+                   """
+            found.update(self.conn.execute(sql, chunk).fetchall())
+        return found
+
+    def evict(self):
+        """
+        Drop the least recently used names if the cache is over its limit.
+        """
+        if self.max_size is None:
+            return
+
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
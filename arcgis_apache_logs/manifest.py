@@ -0,0 +1,159 @@
+# standard library imports
+import datetime as dt
+import hashlib
+import logging
+import pathlib
+
+
+def fingerprint_log_file(path):
+    """
+    Identify a log file by its contents rather than by its name.
+
+    Parameters
+    ----------
+    path : path or str
+        Path to gzipped log file
+
+    Returns
+    -------
+        dictionary with the filename, size, and SHA-256 checksum
+    """
+    path = pathlib.Path(path)
+
+    sha = hashlib.sha256()
+    with path.open(mode='rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+
+    entry = {
+        'filename': path.name,
+        'size': path.stat().st_size,
+        'checksum': sha.hexdigest(),
+    }
+    return entry
+
+
+class IngestManifest(object):
+    """
+    Ledger of the log files that have been merged into the database.  The
+    counts in the database are additive, so ingesting the same file twice
+    would double its hits and bytes.
+
+    Attributes
+    ----------
+    conn : obj
+        database connectivity
+    logger : object
+        Log any pertinent events.
+    """
+    def __init__(self, conn, logger=None):
+        """
+        Parameters
+        ----------
+        conn : obj
+            database connectivity
+        logger : object
+            Log any pertinent events.
+        """
+        self.conn = conn
+
+        if logger is not None:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+    def initialize_table(self):
+        """
+        Create the manifest table if it does not already exist.
+        """
+        cursor = self.conn.cursor()
+
+        sql = """
+              CREATE TABLE IF NOT EXISTS ingest_manifest (
+                  checksum text PRIMARY KEY,
+                  filename text,
+                  size integer,
+                  first_date timestamp,
+                  last_date timestamp,
+                  records integer,
+                  unmatched integer,
+                  ingested timestamp
+              )
+              """
+        cursor.execute(sql)
+
+        sql = """
+              CREATE INDEX IF NOT EXISTS idx_ingest_manifest_filename
+              ON ingest_manifest(filename)
+              """
+        cursor.execute(sql)
+        self.conn.commit()
+
+    def lookup(self, entry):
+        """
+        Has a log file with these contents already been ingested?
+
+        Parameters
+        ----------
+        entry : dict
+            As produced by fingerprint_log_file.
+
+        Returns
+        -------
+            the time at which it was ingested, or None
+        """
+        sql = """
+              SELECT ingested
+              FROM ingest_manifest
+              WHERE checksum = ?
+              """
+        row = self.conn.execute(sql, (entry['checksum'],)).fetchone()
+        if row is not None:
+            return row[0]
+
+        # Same name, different contents?  Worth a mention, but it is still a
+        # different fragment.
+        sql = """
+              SELECT ingested
+              FROM ingest_manifest
+              WHERE filename = ?
+              """
+        row = self.conn.execute(sql, (entry['filename'],)).fetchone()
+        if row is not None:
+            msg = (
+                f"{entry['filename']} was ingested on {row[0]}, but its "
+                f"contents have since changed."
+            )
+            self.logger.warning(msg)
+
+        return None
+
+    def record(self, entries):
+        """
+        Add log files to the ledger, replacing any previous entries for the
+        same contents.  The caller is responsible for committing.
+
+        Parameters
+        ----------
+        entries : list
+            Each item is a dictionary as produced by fingerprint_log_file,
+            plus the time range, the number of records, and the number of
+            unmatched lines.
+        """
+        ingested = dt.datetime.now().isoformat(sep=' ', timespec='seconds')
+
+        sql = """
+              INSERT OR REPLACE INTO ingest_manifest
+              (checksum, filename, size, first_date, last_date, records,
+               unmatched, ingested)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+              """
+        params = [
+            (
+                entry['checksum'], entry['filename'], entry['size'],
+                entry['first_date'], entry['last_date'], entry['records'],
+                entry['unmatched'], ingested,
+            )
+            for entry in entries
+        ]
+        self.conn.executemany(sql, params)
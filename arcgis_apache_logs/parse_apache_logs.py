@@ -1,49 +1,134 @@
 # standard library imports
-import gzip
+import concurrent.futures
+import datetime as dt
+import glob
 import logging
 import pathlib
-import re
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
 
 # 3rd party library imports
 import lxml.etree
-import pandas as pd
 
 # local imports
-from .ip_address import IPAddressProcessor
+from .batch import RecordBatch
+from .clients import ClientsProcessor
+from .common import connect
+from .ip_address import IPAddressProcessor, OTHER_IP_ADDRESS
+from .manifest import IngestManifest, fingerprint_log_file
+from .quarantine import Quarantine
+from .reader import BackgroundReader
 from .referer import RefererProcessor
+from .schema import migrate
 from .services import ServicesProcessor
+from .sketches import HeavyHitters
 from .summary import SummaryProcessor
-from .user_agent import UserAgentProcessor
+from .tokenizer import parse_line
+from .user_agent import UserAgentFamilyProcessor, UserAgentProcessor
+
+
+def collect_log_files(items):
+    """
+    Expand the command line inputs into a list of log files.
+
+    Parameters
+    ----------
+    items : list
+        Each item may be a path to a gzipped log file, a directory containing
+        gzipped log files, or a glob pattern.
+
+    Returns
+    -------
+        list of paths, in order and without duplicates
+    """
+    paths = []
+    for item in items:
+        path = pathlib.Path(item)
+        if path.is_dir():
+            paths.extend(sorted(path.glob('*.gz')))
+        elif any(c in item for c in '*?['):
+            paths.extend(pathlib.Path(x) for x in sorted(glob.glob(item)))
+        else:
+            paths.append(path)
+
+    # Remove any duplicates, but keep the order.
+    return list(dict.fromkeys(paths))
+
+
+# Each worker process has its own parser, which is created once when the
+# worker starts up.
+_worker_parser = None
+
+
+def _initialize_worker(project, kwargs):
+    global _worker_parser
+    _worker_parser = ApacheLogParser(project, **kwargs)
+
+
+def _aggregate_log_file(path):
+    return _worker_parser.aggregate_log_file(path)
 
 
 class ApacheLogParser(object):
     """
     Attributes
     ----------
-    database_file : path or str
+    conn : obj
+        database connectivity, shared by all the processors
+    database : path or str
         Path to database
+    frequency : str
+        The time bucket to which records are aggregated.
+    heavy_hitters : int
+        If not None, only keep this many IP addresses, referers, and user
+        agents for each time bucket, plus one row for all the others.
     infile : file-like
-        The apache log file (can be stdin).
+        The apache log file (can be stdin, i.e. "-").  May also be a list of
+        log files.
     logger : object
         Log any pertinent events.
+    manifest : IngestManifest
+        Ledger of log files already merged into the database.
+    memory_budget : int
+        Flush a batch of records once it is estimated to hold this many
+        bytes.
     project : str
         Either nowcoast or idpgis
     """
     def __init__(self, project, infile=None, document_root=None,
-                 services_only=False):
+                 services_only=False, memory_budget=512 * 1024 * 1024,
+                 heavy_hitters=None):
         """
         Parameters
         ----------
-        infile : str
-            Path to gzipped log file
+        infile : str or list
+            Path to gzipped log file, or list of such paths
         document_root : str
             Where the database and graphical output is written
         services_only : bool
             If true, do not track referers, ip addresses, or user agents.
+        memory_budget : int
+            Flush a batch of records once it is estimated to hold this many
+            bytes.
+        heavy_hitters : int
+            If not None, only keep this many IP addresses, referers, and
+            user agents for each time bucket.  This bounds the memory and
+            database size when the number of clients explodes, e.g. during
+            a crawler flood.
         """
         self.project = project
         self.infile = infile
+        self.document_root = document_root
         self.services_only = services_only
+        self.memory_budget = memory_budget
+        self.heavy_hitters = heavy_hitters
+        self.frequency = '1H'
 
         if document_root is None:
             self.root = pathlib.Path.home() \
@@ -54,12 +139,52 @@ class ApacheLogParser(object):
 
         self.setup_logger()
 
-        kwargs = {'logger': self.logger, 'document_root': document_root}
+        if not self.root.exists():
+            self.root.mkdir(parents=True, exist_ok=True)
+
+        # All the processors share one connection, so that each batch is
+        # merged in a single transaction.
+        self.database = self.root / f'arcgis_apache_{self.project}.db'
+        self.conn = connect(self.database)
+
+        kwargs = {
+            'logger': self.logger,
+            'document_root': document_root,
+            'conn': self.conn,
+        }
+        self.clients = ClientsProcessor(self.project, **kwargs)
         self.ip_address = IPAddressProcessor(self.project, **kwargs)
         self.referer = RefererProcessor(self.project, **kwargs)
         self.services = ServicesProcessor(self.project, **kwargs)
         self.summarizer = SummaryProcessor(self.project, **kwargs)
         self.user_agent = UserAgentProcessor(self.project, **kwargs)
+        self.user_agent_family = UserAgentFamilyProcessor(self.project,
+                                                          **kwargs)
+
+        if heavy_hitters is not None:
+            self.ip_address.heavy_hitters = HeavyHitters(
+                'ip_address', heavy_hitters, other=OTHER_IP_ADDRESS
+            )
+            self.referer.heavy_hitters = HeavyHitters('referer',
+                                                      heavy_hitters)
+            self.user_agent.heavy_hitters = HeavyHitters('user_agent',
+                                                         heavy_hitters)
+
+        # Keep track of which log files have been ingested.
+        self.manifest = IngestManifest(self.conn, self.logger)
+        self.manifest.initialize_table()
+
+        # The database may have been created by an older version.  Every
+        # table is brought up to date, whether or not its processor is
+        # active, since the migration below rebuilds all of them.
+        processors = (self.clients, self.ip_address, self.referer,
+                      self.services, self.summarizer, self.user_agent,
+                      self.user_agent_family)
+        for processor in processors:
+            processor.upgrade_tables()
+
+        # Then rebuild the hourly tables in their current form, if need be.
+        migrate(self.conn, self.logger)
 
         # Setup a skeleton output document.
         self.doc = lxml.etree.Element('html')
@@ -75,6 +200,10 @@ class ApacheLogParser(object):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
 
+        if self.logger.handlers:
+            # Already setup, e.g. inherited by a worker process.
+            return
+
         ch = logging.StreamHandler()
         ch.setLevel(logging.INFO)
 
@@ -84,110 +213,416 @@ class ApacheLogParser(object):
 
         self.logger.addHandler(ch)
 
-    def parse_input(self):
+    @property
+    def processors(self):
+        """
+        The active processors, keyed by name.  The order is significant, as
+        the summary depends upon the services having already been written to
+        the database.
+        """
+        processors = {}
+        if not self.services_only:
+            processors['ip_address'] = self.ip_address
+            processors['referer'] = self.referer
+            processors['user_agent'] = self.user_agent
+            processors['user_agent_family'] = self.user_agent_family
+
+        processors['services'] = self.services
+        processors['summarizer'] = self.summarizer
+
+        if not self.services_only:
+            processors['clients'] = self.clients
+
+        return processors
+
+    def parse_input(self, max_workers=None, force=False, follow=False,
+                    flush_interval=60, flush_lines=None):
         """
-        Process the entire log file.
+        Process the entire log file (or files).
+
+        Parameters
+        ----------
+        max_workers : int
+            If there are multiple log files, parse them across this many
+            processes.  Defaults to the number of processors on the machine.
+        force : bool
+            If true, parse log files even if the manifest says they have
+            already been ingested.
+        follow : bool
+            If true, keep reading the (uncompressed) log file as it grows.
+        flush_interval, flush_lines : float, int
+            When reading stdin or following a file, merge into the database
+            at least this often (in seconds) or after this many records.
         """
         if self.infile is None:
             return
 
-        pattern = r'''
-            # (?P<ip_address>((\d+.\d+.\d+.\d+)|((\w*?:){6}(\w*?:)?(\w+)?)))
-            (?P<ip_address>.*?)
-            \s
-            # Client identity, always -?
-            -
-            \s
-            # Remote user, always -?
-            -
-            \s
-            # Time of request.  The timezone is always UTC, so don't bother
-            # parsing it.
-            \[(?P<timestamp>\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2})\s.....\]
-            \s
-            # The request
-            "(?P<request_op>(GET|DELETE|HEAD|OPTIONS|POST|PROPFIND|PUT))
-            \s
-            (?P<path>.*?)
-            \s
-            HTTP\/1.1"
-            \s
-            # Status code
-            (?P<status_code>\d+)
-            \s
-            # payload size
-            (?P<nbytes>\d+)
-            \s
-            # referer
-            "(?P<referer>.*?)"
-            \s
-            # user agent
-            "(?P<user_agent>.*?)"
-            \s
-            # something else that seems to always be "-"
-            "-"
-            '''
-        regex = re.compile(pattern, re.VERBOSE)
-
-        records = []
-
-        self.logger.info(f"Parsing {self.infile}...")
-
-        for line in gzip.open(self.infile, mode='rt', errors='replace'):
-            m = regex.match(line)
-            if m is None:
-                msg = (
-                    f"This line from the apache log files was not matched.\n"
-                    f"\n"
-                    f"{line}"
-                )
+        if self.infile == '-' or follow:
+            self.parse_stream(follow=follow, flush_interval=flush_interval,
+                              flush_lines=flush_lines)
+            return
+
+        if isinstance(self.infile, (str, pathlib.PurePath)):
+            paths = [self.infile]
+        else:
+            paths = list(self.infile)
+
+        # Skip anything that has already been ingested, and any copies of
+        # the same log file under other names, e.g. one downloaded twice.
+        entries = {}
+        originals = {}
+        for path in paths:
+            entry = fingerprint_log_file(path)
+
+            original = originals.get(entry['checksum'])
+            if original is not None:
+                msg = f"Skipping {path}, the same log file as {original}"
                 self.logger.warning(msg)
                 continue
 
-            # the 4th row is to designate a "hit".
-            records.append((
-                m.group('timestamp'),
-                m.group('ip_address'),
-                m.group('path'),
-                1,
-                int(m.group('status_code')),
-                int(m.group('nbytes')),
-                m.group('referer'),
-                m.group('user_agent')
-            ))
+            ingested = self.manifest.lookup(entry)
+            if ingested is not None and not force:
+                self.logger.info(f"Skipping {path}, ingested on {ingested}")
+                continue
+
+            originals[entry['checksum']] = path
+            entries[path] = entry
+
+        paths = list(entries)
+        if len(paths) == 0:
+            return
+        elif len(paths) == 1 or max_workers == 1:
+            results = self.aggregate_log_files_serially(paths)
+        else:
+            results = self.aggregate_log_files_in_parallel(paths, max_workers)
+
+        # Everything gets merged into the database just once, in the same
+        # transaction as the manifest, so that a log file is never counted
+        # without being recorded or recorded without being counted.
+        aggregates = [item for item, _ in results.values()]
+        self.update_database(self.combine_aggregates(aggregates))
+
+        for path, (item, unmatched) in results.items():
+            entries[path].update(self.describe_aggregates(item))
+            entries[path]['unmatched'] = unmatched
+        self.manifest.record(entries[path] for path in results)
+        self.conn.commit()
+
+    def parse_stream(self, follow=False, flush_interval=60, flush_lines=None):
+        """
+        Parse stdin (gzipped or not) or follow a growing log file, merging
+        into the database as we go rather than all at once at the end.  The
+        manifest does not apply here.  Interrupting it, e.g. with Ctrl-C,
+        merges whatever has been collected so far and ends cleanly.
+        """
+        if self.infile == '-':
+            # Read stdin through a buffer of our own.  The reader thread may
+            # still be blocked in it at exit, which would otherwise deadlock
+            # the interpreter as it shuts down sys.stdin.
+            source = open(sys.stdin.fileno(), mode='rb', closefd=False)
+        elif isinstance(self.infile, (str, pathlib.PurePath)):
+            source = self.infile
+        elif len(self.infile) == 1:
+            source = self.infile[0]
+        else:
+            raise ValueError("Only a single log file can be followed.")
+
+        kwargs = {
+            'follow': follow,
+            'flush_interval': flush_interval,
+            'flush_lines': flush_lines,
+        }
+        with self.create_quarantine(source) as quarantine:
+            for aggregates in self.parse_log_file(source, quarantine,
+                                                  **kwargs):
+                self.update_database(aggregates)
+                self.conn.commit()
+
+    def describe_aggregates(self, aggregates):
+        """
+        Summarize the aggregates of a log file for the manifest.
+
+        Returns
+        -------
+            dictionary with the number of records and the time range (to the
+            minute)
+        """
+        df = aggregates['summarizer']
+        if df is None or len(df) == 0:
+            return {'records': 0, 'first_date': None, 'last_date': None}
+
+        description = {
+            'records': int(df['hits'].sum()),
+            'first_date': str(df['date'].min()),
+            'last_date': str(df['date'].max()),
+        }
+        return description
+
+    def aggregate_log_files_serially(self, paths):
+        """
+        Parse and aggregate each log file in this process.
+
+        Returns
+        -------
+            dictionary of aggregates and number of unmatched lines for each
+            log file successfully parsed, keyed by path
+        """
+        results = {}
+        for path in paths:
+            try:
+                results[path] = self.aggregate_log_file(path)
+            except Exception as e:
+                # Don't let one bad fragment spoil the rest.
+                self.logger.error(f"Unable to parse {path}:  {e!r}")
+
+        return results
+
+    def aggregate_log_files_in_parallel(self, paths, max_workers):
+        """
+        Parse and aggregate each log file in a pool of processes.
+
+        Returns
+        -------
+            dictionary of aggregates and number of unmatched lines for each
+            log file successfully parsed, keyed by path
+        """
+        self.logger.info(f"Parsing {len(paths)} log files...")
+
+        parser_kwargs = {
+            'document_root': self.document_root,
+            'services_only': self.services_only,
+            'memory_budget': self.memory_budget,
+            'heavy_hitters': self.heavy_hitters,
+        }
+        kwargs = {
+            'max_workers': max_workers,
+            'initializer': _initialize_worker,
+            'initargs': (self.project, parser_kwargs),
+        }
+        results = {}
+        with concurrent.futures.ProcessPoolExecutor(**kwargs) as executor:
+            futures = {
+                executor.submit(_aggregate_log_file, path): path
+                for path in paths
+            }
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    # Don't let one bad fragment spoil the rest.
+                    self.logger.error(f"Unable to parse {path}:  {e!r}")
+
+        return results
+
+    def aggregate_log_file(self, path):
+        """
+        Parse a single log file and aggregate its records.  The database is
+        not touched.
+
+        Returns
+        -------
+            dictionary of aggregated dataframes, keyed by processor name
+            number of unmatched lines in the log file
+        """
+        with self.create_quarantine(path) as quarantine:
+            aggregates = list(self.parse_log_file(path, quarantine))
+        return self.combine_aggregates(aggregates), quarantine.count
 
-            if len(records) % 1000000 == 0:
-                self.process_records(records)
+    def create_quarantine(self, path):
+        """
+        Create a sink for the unmatched lines of a log file.
 
-                # reset for the next batch
-                records = []
+        Parameters
+        ----------
+        path : path, str, or file-like
+            Path to gzipped log file, or a binary stream.
+        """
+        directory = self.root / 'quarantine'
+        if hasattr(path, 'read'):
+            name = dt.datetime.now().strftime('stdin-%Y%m%dT%H%M%S')
+        else:
+            name = str(pathlib.Path(path).resolve())
+        return Quarantine(directory, name, logger=self.logger)
 
-        self.process_records(records)
+    def parse_log_file(self, path, quarantine, follow=False,
+                       flush_interval=None, flush_lines=None):
+        """
+        Parse a single log file.
 
-    def process_records(self, records):
+        Parameters
+        ----------
+        path : path, str, or file-like
+            Path to gzipped log file, or a binary stream.
+        quarantine : Quarantine
+            Sink for unmatched lines.
+        follow : bool
+            If true, keep reading as the file grows until interrupted.
+        flush_interval : float
+            If not None, flush a batch at least this often (in seconds).
+        flush_lines : int
+            If not None, flush a batch once it has this many records.
+
+        Yields
+        ------
+            dictionary of aggregated dataframes for each batch of records,
+            keyed by processor name
+        """
+        batch = RecordBatch()
+
+        self.logger.info(f"Parsing {getattr(path, 'name', path)}...")
+
+        if flush_lines is None:
+            flush_lines = float('inf')
+        last_flush = time.monotonic()
+
+        # Decompression happens in a background thread while we parse.
+        kwargs = {'follow': follow, 'idle_timeout': flush_interval}
+        with BackgroundReader(path, **kwargs) as reader:
+            try:
+                for lines in reader:
+                    for line in lines:
+                        record = parse_line(line)
+                        if record is None:
+                            quarantine.add(line)
+                            continue
+
+                        batch.append(record)
+
+                        if (
+                            batch.memory_usage >= self.memory_budget
+                            or len(batch) >= flush_lines
+                        ):
+                            yield self.aggregate_records(batch)
+
+                            # reset for the next batch
+                            batch.clear()
+                            last_flush = time.monotonic()
+
+                    if (
+                        flush_interval is not None
+                        and len(batch) > 0
+                        and time.monotonic() - last_flush >= flush_interval
+                    ):
+                        yield self.aggregate_records(batch)
+                        batch.clear()
+                        last_flush = time.monotonic()
+
+            except KeyboardInterrupt:
+                if not (follow or reader.is_stream):
+                    raise
+                # This is how following a file or reading a stream that
+                # never ends, e.g. from a log shipper, ends.  Don't lose
+                # what has been collected so far.
+                self.logger.info("Interrupted, flushing the last batch...")
+
+        if len(batch) > 0:
+            yield self.aggregate_records(batch)
+
+    def aggregate_records(self, batch):
+        """
+        Turn a batch of records into a dataframe and aggregate it for each of
+        the processors.
 
-        columns = [
-            'date', 'ip_address', 'path', 'hits', 'status_code', 'nbytes',
-            'referer', 'user_agent'
-        ]
-        df = pd.DataFrame.from_records(records, columns=columns)
+        Parameters
+        ----------
+        batch : RecordBatch
+            Columns of parsed log records.
 
-        format = '%d/%b/%Y:%H:%M:%S'
-        df['date'] = pd.to_datetime(df['date'], format=format)
+        Returns
+        -------
+            dictionary of aggregated dataframes, keyed by processor name
+        """
+        nbytes = batch.memory_usage
+        df = batch.to_dataframe()
 
+        # Everything the processors have in common is computed just once,
+        # and they all share the same dataframe.  That includes which
+        # service each request is for.
         df['errors'] = df.eval(
             'status_code < 200 or status_code >= 400'
         ).astype(int)
+        df['bucket'] = df['date'].dt.floor(self.frequency)
 
-        self.logger.info(f"Parsed {len(df)} log records...")
+        df_svc = self.services.classify_records(df)
+        df['service_id'] = df_svc['id']
+        df['export_mapdraws'] = df_svc['export_mapdraws']
+        df['wms_mapdraws'] = df_svc['wms_mapdraws']
 
-        if not self.services_only:
-            self.ip_address.process_raw_records(df)
-            self.referer.process_raw_records(df)
-            self.user_agent.process_raw_records(df)
+        aggregates = {
+            name: processor.aggregate_raw_records(df)
+            for name, processor in self.processors.items()
+        }
+
+        msg = (
+            f"Parsed {len(df)} log records (~{nbytes / 1024 ** 2:.0f} MB), "
+            f"peak RSS {self.peak_rss() / 1024 ** 2:.0f} MB..."
+        )
+        self.logger.info(msg)
+
+        return aggregates
+
+    def peak_rss(self):
+        """
+        Returns
+        -------
+            peak resident set size of this process in bytes, or NaN if that
+            cannot be determined
+        """
+        if resource is None:
+            return float('nan')
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            # Already in bytes.
+            return maxrss
+        else:
+            return maxrss * 1024
+
+    def combine_aggregates(self, aggregates):
+        """
+        Combine a list of aggregates, e.g. from several batches or several
+        log files, into one.
+
+        Parameters
+        ----------
+        aggregates : list
+            Each item is a dictionary of aggregated dataframes, keyed by
+            processor name.
+        """
+        combined = {}
+        for name, processor in self.processors.items():
+            dfs = [item.get(name) for item in aggregates]
+            combined[name] = processor.combine_aggregates(dfs)
+        return combined
+
+    def update_database(self, aggregates):
+        """
+        Merge the aggregated records into the database.  The caller commits
+        once all are merged, so the tables never disagree with each other.
+
+        Parameters
+        ----------
+        aggregates : dict
+            Aggregated dataframes, keyed by processor name.
+        """
+        for name, processor in self.processors.items():
+            df = aggregates.get(name)
+            if df is None or len(df) == 0:
+                continue
+            processor.update_database(df)
+
+    def prune_database(self):
+        """
+        Delete the rows of each tier of the tables that have outlived its
+        retention, e.g. the hourly rows after a week, then give back the
+        space.
+        """
+        for processor in self.processors.values():
+            processor.prune_tiers()
+        self.conn.commit()
 
-        self.services.process_raw_records(df)
-        self.summarizer.process_raw_records(df)
+        self.conn.execute('VACUUM')
 
     def process_graphics(self):
 
@@ -204,6 +639,8 @@ class ApacheLogParser(object):
         if not self.services_only:
             self.ip_address.process_graphics(self.doc)
             self.user_agent.process_graphics(self.doc)
+            self.user_agent_family.process_graphics(self.doc)
+            self.clients.process_graphics(self.doc)
 
         # Write the HTML document.
         path = self.root / f'{self.project}.html'
@@ -0,0 +1,113 @@
+# standard library imports
+import gzip
+import hashlib
+import logging
+import pathlib
+import time
+
+
+class Quarantine(object):
+    """
+    Sink for log lines that could not be parsed.  The lines are written in
+    bulk to a compressed file rather than to the log, and the warnings are
+    rate limited, so that a bad fragment or a change in the log format does
+    not slow the ingest to a crawl.
+
+    Attributes
+    ----------
+    count : int
+        Number of unmatched lines seen.
+    logger : object
+        Log any pertinent events.
+    max_lines : int
+        Keep every unmatched line up to this many.
+    name : str
+        Name of the log file being parsed.
+    path : path
+        The compressed quarantine file.  It is only created if there are
+        any unmatched lines.  It is named after the log file, along with a
+        hash of its full name, so that log files of the same name in
+        different directories, e.g. one for each host, have their own.
+    sample_every : int
+        After max_lines, keep only every n-th unmatched line.
+    saved : int
+        Number of unmatched lines written to the quarantine file.
+    warning_interval : float
+        Warn about unmatched lines at most this often (in seconds).
+    """
+    def __init__(self, directory, name, logger=None, max_lines=10000,
+                 sample_every=100, warning_interval=60):
+        """
+        Parameters
+        ----------
+        directory : path
+            Write the quarantine file here.
+        name : str
+            Name of the log file being parsed, e.g. its full path.
+        """
+        self.name = name
+
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+        stem = pathlib.Path(name).stem
+        self.path = directory / f'{stem}.{digest}.unmatched.gz'
+        self.max_lines = max_lines
+        self.sample_every = sample_every
+        self.warning_interval = warning_interval
+
+        if logger is not None:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+        self.count = 0
+        self.saved = 0
+
+        self._file = None
+        self._last_warning = float('-inf')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def add(self, line):
+        """
+        Parameters
+        ----------
+        line : bytes
+            Raw line from the apache log file.
+        """
+        self.count += 1
+
+        if self.count <= self.max_lines or self.count % self.sample_every == 0:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = gzip.open(self.path, mode='wb')
+            self._file.write(line + b'\n')
+            self.saved += 1
+
+        now = time.monotonic()
+        if now - self._last_warning >= self.warning_interval:
+            msg = (
+                f"{self.count} unmatched line(s) so far in {self.name}, "
+                f"latest:  {line[:200]!r}"
+            )
+            self.logger.warning(msg)
+            self._last_warning = now
+
+    def close(self):
+        """
+        Close the quarantine file and summarize.
+        """
+        if self._file is None:
+            return
+
+        self._file.close()
+        self._file = None
+
+        msg = (
+            f"{self.count} unmatched line(s) in {self.name}, {self.saved} "
+            f"written to {self.path}"
+        )
+        self.logger.warning(msg)
@@ -0,0 +1,174 @@
+# standard library imports
+import gzip
+import queue
+import threading
+import time
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class BackgroundReader(object):
+    """
+    Decompress a gzipped log file in a background thread, handing over
+    batches of lines through a bounded queue.  zlib releases the GIL while
+    inflating, so decompression overlaps with parsing in the main thread.
+
+    Streams (e.g. stdin) may be either gzipped or uncompressed, and a growing
+    uncompressed file may be followed like "tail -f".
+
+    Attributes
+    ----------
+    chunk_size : int
+        Number of decompressed bytes to read at a time.
+    close_timeout : float
+        How long to wait for the background thread when closing.
+    follow : bool
+        If true, keep waiting for more data at the end of the file.
+    idle_timeout : float
+        If not None, an empty batch is handed over whenever nothing has
+        arrived for this many seconds.
+    path : path, str, or file-like
+        Path to gzipped log file, or a binary stream.
+    queue : queue.Queue
+        Batches of lines waiting to be parsed.
+    """
+    def __init__(self, path, chunk_size=4 * 1024 * 1024, max_batches=8,
+                 follow=False, idle_timeout=None, poll_interval=1.0,
+                 close_timeout=1.0):
+        """
+        Parameters
+        ----------
+        path : path, str, or file-like
+            Path to gzipped log file, or a binary stream
+        chunk_size : int
+            Number of decompressed bytes to read at a time.
+        max_batches : int
+            Maximum number of batches of lines held in the queue.  This
+            bounds the memory used by the reader.
+        follow : bool
+            If true, keep waiting for more data at the end of the file.
+        idle_timeout : float
+            If not None, hand over an empty batch whenever nothing has
+            arrived for this many seconds, so that the consumer gets a
+            chance to do periodic work.
+        poll_interval : float
+            When following a file, check for more data this often.
+        close_timeout : float
+            How long to wait for the background thread when closing.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.follow = follow
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.close_timeout = close_timeout
+
+        self.queue = queue.Queue(maxsize=max_batches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __iter__(self):
+        """
+        Yields
+        ------
+            list of lines (bytes, without the trailing newline)
+        """
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                yield []
+                continue
+
+            if item is None:
+                return
+            elif isinstance(item, BaseException):
+                raise item
+            yield item
+
+    @property
+    def is_stream(self):
+        return hasattr(self.path, 'read')
+
+    def close(self):
+        """
+        Stop the background thread, even if the file has not been fully read.
+        The thread may be blocked reading a stream such as stdin, which only
+        returns once more data arrives, so it is not waited on forever.  It
+        is a daemon, so it does not hold up the exit.
+        """
+        self._stop.set()
+        self._thread.join(timeout=self.close_timeout)
+
+    def _put(self, item):
+        # Don't block forever if the consumer has gone away.
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            if self.is_stream:
+                self._read(self._wrap(self.path))
+            elif self.follow:
+                with open(self.path, mode='rb') as f:
+                    self._read(self._wrap(f))
+            else:
+                with gzip.open(self.path, mode='rb') as f:
+                    self._read(f)
+        except BaseException as e:
+            self._put(e)
+        else:
+            self._put(None)
+
+    def _wrap(self, f):
+        """
+        Decompress the stream if it starts with the gzip magic number.
+        """
+        if f.peek(2)[:2] != GZIP_MAGIC:
+            return f
+        elif self.follow:
+            msg = "Cannot follow a gzipped file, it must be uncompressed."
+            raise ValueError(msg)
+        else:
+            return gzip.GzipFile(fileobj=f, mode='rb')
+
+    def _read(self, f):
+        # Streams hand over whatever is available rather than waiting for a
+        # full chunk.
+        if self.is_stream or self.follow:
+            read = f.read1
+        else:
+            read = f.read
+
+        tail = b''
+        while not self._stop.is_set():
+            chunk = read(self.chunk_size)
+            if len(chunk) == 0:
+                if self.follow:
+                    time.sleep(self.poll_interval)
+                    continue
+                break
+
+            # The last item is an incomplete line that continues in the next
+            # chunk.
+            lines = chunk.split(b'\n')
+            lines[0] = tail + lines[0]
+            tail = lines.pop()
+
+            if not self._put(lines):
+                return
+
+        if len(tail) > 0:
+            self._put([tail])
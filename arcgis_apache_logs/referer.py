@@ -2,6 +2,7 @@
 
 # Standard library imports
 import datetime as dt
+import functools
 import urllib.parse
 
 # 3rd party library imports
@@ -12,6 +13,7 @@ import seaborn as sns
 
 # Local imports
 from .common import CommonProcessor
+from .lut import LookupTableCache
 
 sns.set()
 
@@ -26,6 +28,26 @@ def millions_fcn(x, pos):
     return f'{(x/1e6):.2f}M'
 
 
+@functools.lru_cache(maxsize=100000)
+def normalize_referer(referer):
+    """
+    Throw away any query string in the referer.  The same referers turn up
+    over and over again, so the results are cached across batches and
+    files.
+
+    Parameters
+    ----------
+    referer : str
+        Referer as found in the log.
+    """
+    p = urllib.parse.urlparse(referer)
+    if p.query == '':
+        # No query string, use the referer as-is.
+        return referer
+    else:
+        return f"{p.scheme}://{p.netloc}{p.path}"
+
+
 class RefererProcessor(CommonProcessor):
     """
     Attributes
@@ -49,87 +71,81 @@ class RefererProcessor(CommonProcessor):
         super().__init__(project, **kwargs)
 
         self.time_series_sql = """
-            SELECT a.date, SUM(a.hits) as hits, SUM(a.errors) as errors,
-                   SUM(a.nbytes) as nbytes, b.name as referer
+            SELECT a.hour_epoch as date, SUM(a.hits) as hits,
+                   SUM(a.errors) as errors, SUM(a.nbytes) as nbytes,
+                   b.name as referer
             FROM referer_logs a
             INNER JOIN referer_lut b
             ON a.id = b.id
-            GROUP BY a.date, referer
-            ORDER BY a.date
+            WHERE b.name != '(other)' AND a.hour_epoch >= ?
+            GROUP BY a.hour_epoch, referer
+            ORDER BY a.hour_epoch
             """
 
         self.data_retention_days = 7
 
-    def process_raw_records(self, df):
+        self.aggregate_keys = ['date', 'referer']
+        self.tables = ['referer_logs']
+
+        # There are a great many of these, so only keep the most recently
+        # seen in memory.
+        self.lut_cache = LookupTableCache(self.conn, 'referer_lut', 'name',
+                                          max_size=200000)
+
+    def upgrade_tables(self):
         """
-        We have reached a limit on how many records we accumulate before
-        processing.  Turn what we have into a dataframe and aggregate it
-        to the appropriate granularity.
+        Older databases have no room for the error bounds of heavy hitters.
         """
-        columns = ['date', 'referer', 'hits', 'errors', 'nbytes']
-        df = df[columns].copy()
+        self.add_missing_column('referer_logs', 'hits_error',
+                                'integer DEFAULT 0')
 
-        # Throw away any the query string in the referer.
-        def fcn(referer):
-            p = urllib.parse.urlparse(referer)
-            if p.query == '':
-                # No query string, use the referer as-is.
-                pass
-            else:
-                referer = f"{p.scheme}://{p.netloc}{p.path}"
-            return referer
+    def aggregate_raw_records(self, df):
+        """
+        Aggregate the raw records to the set frequency.  The database is not
+        touched, so this may be run in a worker process.
 
-        df['referer'] = df['referer'].apply(fcn)
+        Parameters
+        ----------
+        df : dataframe
+            The shared batch of raw records.  It must not be modified.
+        """
+        # Normalize each distinct referer only once, then map the results
+        # back onto the records by their codes.  Different referers may
+        # normalize to the same value, so the categories are encoded again.
+        referers = df['referer'].astype('category')
+        normalized = [
+            normalize_referer(x) for x in referers.cat.categories
+        ]
+        codes, uniques = pd.factorize(normalized)
+        referer = pd.Series(
+            pd.Categorical.from_codes(codes.take(referers.cat.codes.values),
+                                      categories=uniques),
+            index=df.index, name='referer'
+        )
 
         # Aggregate by the set frequency and referer, taking sums.
-        groupers = [pd.Grouper(freq=self.frequency), 'referer']
-        df_ref = df.set_index('date').groupby(groupers).sum().reset_index()
+        df_ref = self.aggregate_by_frequency(df, [referer])
 
-        # Have to have the same column names as the database.
-        df_ref = self.replace_referers_with_ids(df_ref)
+        if self.heavy_hitters is not None:
+            df_ref = self.heavy_hitters.summarize(df_ref)
 
-        df_ref = self.merge_with_database(df_ref, 'referer_logs')
+        return df_ref
 
-        df_ref.to_sql('referer_logs', self.conn,
-                      if_exists='append', index=False)
-        self.conn.commit()
+    def update_database(self, df_ref):
+        """
+        Merge aggregated records into the database.  The caller is
+        responsible for committing.
+        """
+        # Have to have the same column names as the database.
+        df_ref = self.replace_referers_with_ids(df_ref)
 
-        # Reset for the next round of records.
-        self.records = []
+        self.merge_with_tiers(df_ref, 'referer_logs')
 
     def replace_referers_with_ids(self, df_orig):
         """
         Don't log the actual referer names to the database, log the ID instead.
         """
-
-        sql = """
-              SELECT * from referer_lut
-              """
-        known_referers = pd.read_sql(sql, self.conn)
-
-        # Get the referer IDs
-        df = pd.merge(df_orig, known_referers,
-                      how='left', left_on='referer', right_on='name')
-
-        # How many referers have NaN for IDs?  This must populate the known
-        # referers table before going further.
-        unknown_referers = df['referer'][df['id'].isnull()].unique()
-        if len(unknown_referers) > 0:
-            new_df = pd.Series(unknown_referers, name='name').to_frame()
-
-            new_df.to_sql('referer_lut', self.conn,
-                          if_exists='append', index=False)
-
-            sql = """
-                  SELECT * from referer_lut
-                  """
-            known_referers = pd.read_sql(sql, self.conn)
-            df = pd.merge(df_orig, known_referers,
-                          how='left', left_on='referer', right_on='name')
-
-        df.drop(['referer', 'name'], axis='columns', inplace=True)
-
-        return df
+        return self.replace_with_ids(df_orig, 'referer')
 
     def process_graphics(self, html_doc):
         """Create the HTML and graphs for the referers.
@@ -0,0 +1,618 @@
+# 3rd party library imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from .sketches import merge_sketches
+
+# Bump this whenever the layout of the tables changes, adding a migration to
+# MIGRATIONS.
+SCHEMA_VERSION = 3
+
+# The resolutions at which the aggregates are kept.  Each tier has its own
+# table for each aggregate table, with the suffix added to its name, keyed by
+# the start of the time bucket in seconds since the epoch.  Buckets start
+# every so many seconds from the origin, so weeks start on Monday, the 5th
+# of January 1970.
+TIERS = {
+    'hourly': {'suffix': '', 'key': 'hour_epoch', 'seconds': 3600,
+               'origin': 0},
+    'daily': {'suffix': '_daily', 'key': 'day_epoch', 'seconds': 86400,
+              'origin': 0},
+    'weekly': {'suffix': '_weekly', 'key': 'week_epoch', 'seconds': 604800,
+               'origin': 4 * 86400},
+}
+
+# The aggregate tables, in the form of their tables for each tier.  All the
+# counters of a row live in the primary key's b-tree, so a range of time is
+# read without touching anything else.
+AGGREGATE_TABLES = {
+    'summary': """
+        CREATE TABLE {name} (
+            {key} integer PRIMARY KEY,
+            hits integer,
+            mapdraws integer,
+            errors integer,
+            nbytes integer
+        ) WITHOUT ROWID
+        """,
+    'service_logs': """
+        CREATE TABLE {name} (
+            {key} integer,
+            id integer,
+            hits integer,
+            errors integer,
+            nbytes integer,
+            export_mapdraws integer,
+            wms_mapdraws integer,
+            PRIMARY KEY ({key}, id),
+            CONSTRAINT fk_service_lut_id
+                FOREIGN KEY (id)
+                REFERENCES service_lut(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+    'ip_address_logs': """
+        CREATE TABLE {name} (
+            {key} integer,
+            id integer,
+            hits integer,
+            errors integer,
+            nbytes integer,
+            hits_error integer,
+            PRIMARY KEY ({key}, id),
+            CONSTRAINT fk_known_ip_address_id
+                FOREIGN KEY (id)
+                REFERENCES ip_address_lut(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+    'ip_prefix_logs': """
+        CREATE TABLE {name} (
+            {key} integer,
+            prefix blob,
+            hits integer,
+            errors integer,
+            nbytes integer,
+            PRIMARY KEY ({key}, prefix)
+        ) WITHOUT ROWID
+        """,
+    'referer_logs': """
+        CREATE TABLE {name} (
+            {key} integer,
+            id integer,
+            hits integer,
+            errors integer,
+            nbytes integer,
+            hits_error integer,
+            PRIMARY KEY ({key}, id),
+            CONSTRAINT fk_referer_lut_id
+                FOREIGN KEY (id)
+                REFERENCES referer_lut(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+    'user_agent_logs': """
+        CREATE TABLE {name} (
+            {key} integer,
+            id integer,
+            hits integer,
+            errors integer,
+            nbytes integer,
+            hits_error integer,
+            PRIMARY KEY ({key}, id),
+            CONSTRAINT fk_user_agents_id
+                FOREIGN KEY (id)
+                REFERENCES user_agent_lut(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+    'user_agent_family_logs': """
+        CREATE TABLE {name} (
+            {key} integer,
+            family text,
+            hits integer,
+            errors integer,
+            nbytes integer,
+            PRIMARY KEY ({key}, family)
+        ) WITHOUT ROWID
+        """,
+    'summary_clients': """
+        CREATE TABLE {name} (
+            {key} integer PRIMARY KEY,
+            sketch blob
+        ) WITHOUT ROWID
+        """,
+    'service_clients': """
+        CREATE TABLE {name} (
+            {key} integer,
+            id integer,
+            sketch blob,
+            PRIMARY KEY ({key}, id),
+            CONSTRAINT fk_service_clients_id
+                FOREIGN KEY (id)
+                REFERENCES service_lut(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+}
+
+# Other indexes on the aggregate tables.
+AGGREGATE_INDEXES = {
+    'user_agent_family_logs': """
+        CREATE INDEX idx_{name}
+        ON {name}(family, {key})
+        """,
+}
+
+# Minutes of the burst summary kept, in a ring of that many slots, enough for
+# the last 72 hours and then some.  Each minute has a slot of its own, so the
+# table never grows beyond this.
+BURST_MINUTES = 4 * 1440
+
+BURST_TABLE = """
+    CREATE TABLE {name} (
+        slot integer PRIMARY KEY,
+        minute_epoch integer,
+        hits integer,
+        errors integer,
+        nbytes integer
+    ) WITHOUT ROWID
+    """
+
+# Covers the reads of the last so many minutes.
+BURST_INDEX = """
+    CREATE INDEX idx_burst_staging_minute
+    ON burst_staging(minute_epoch, hits, errors, nbytes)
+    """
+
+
+def to_epoch(dates):
+    """
+    Convert dates to seconds since the epoch, all at once.
+
+    Parameters
+    ----------
+    dates : series
+        datetime64 values
+
+    Returns
+    -------
+        numpy array of int64
+    """
+    return np.asarray(dates, dtype='datetime64[s]').astype(np.int64)
+
+
+def from_epoch(epochs):
+    """
+    Convert seconds since the epoch to dates, all at once.
+
+    Parameters
+    ----------
+    epochs : series or numpy array
+        Integer seconds since the epoch.
+
+    Returns
+    -------
+        datetime64 values of the same kind as given
+    """
+    return pd.to_datetime(epochs, unit='s')
+
+
+def tier_table(table, tier):
+    """
+    Parameters
+    ----------
+    table : str
+        Key of AGGREGATE_TABLES, i.e. the name of the hourly table.
+    tier : str
+        Key of TIERS.
+
+    Returns
+    -------
+        name of the table for the tier
+    """
+    return table + TIERS[tier]['suffix']
+
+
+def floor_epoch(epochs, tier):
+    """
+    Move seconds since the epoch back to the start of their time bucket.
+
+    Parameters
+    ----------
+    epochs : numpy array
+        Integer seconds since the epoch.
+    tier : str
+        Key of TIERS.
+
+    Returns
+    -------
+        numpy array of int64
+    """
+    seconds, origin = TIERS[tier]['seconds'], TIERS[tier]['origin']
+    epochs = np.asarray(epochs, dtype=np.int64)
+    return epochs - (epochs - origin) % seconds
+
+
+def floor_epoch_sql(column, tier):
+    """
+    The same as floor_epoch, as an SQL expression.
+
+    Parameters
+    ----------
+    column : str
+        Column of integer seconds since the epoch, from 1970-01-05 onwards.
+    tier : str
+        Key of TIERS.
+    """
+    seconds, origin = TIERS[tier]['seconds'], TIERS[tier]['origin']
+    return f"{column} - ({column} - {origin}) % {seconds}"
+
+
+def create_aggregate_table(conn, table, tier='hourly', name=None):
+    """
+    Create the table of one of the aggregate tables for a tier, in its
+    current form, along with any other indexes.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity
+    table : str
+        Key of AGGREGATE_TABLES.
+    tier : str
+        Key of TIERS.
+    name : str
+        Create the table under this name instead, without the other
+        indexes, e.g. to copy the old table into.
+    """
+    key = TIERS[tier]['key']
+    sql = AGGREGATE_TABLES[table].format(name=name or tier_table(table, tier),
+                                         key=key)
+    conn.execute(sql)
+    if name is None:
+        create_aggregate_indexes(conn, table, tier)
+
+
+def create_aggregate_indexes(conn, table, tier='hourly'):
+    """
+    Create any other indexes of one of the aggregate tables for a tier.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity
+    table : str
+        Key of AGGREGATE_TABLES.
+    tier : str
+        Key of TIERS.
+    """
+    if table in AGGREGATE_INDEXES:
+        sql = AGGREGATE_INDEXES[table].format(name=tier_table(table, tier),
+                                              key=TIERS[tier]['key'])
+        conn.execute(sql)
+
+
+def create_burst_table(conn, name=None):
+    """
+    Create the table of the burst summary in its current form, along with
+    its index.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity
+    name : str
+        Create the table under this name instead, without the index, e.g.
+        to copy the old table into.
+    """
+    conn.execute(BURST_TABLE.format(name=name or 'burst_staging'))
+    if name is None:
+        conn.execute(BURST_INDEX)
+
+
+def get_schema_version(conn):
+    """
+    Parameters
+    ----------
+    conn : obj
+        database connectivity
+
+    Returns
+    -------
+        the version of the tables, 0 if created before versioning
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def set_schema_version(conn, version=SCHEMA_VERSION):
+    """
+    Parameters
+    ----------
+    conn : obj
+        database connectivity
+    version : int
+        The version of the tables.
+    """
+    conn.execute(f'PRAGMA user_version = {int(version)}')
+
+
+def migrate_to_integer_keys(conn, logger):
+    """
+    Rebuild the hourly aggregate tables keyed by the hour in seconds since
+    the epoch rather than text dates.  Any duplicate rows for the same hour
+    and key, e.g. from overlapping log fragments, are combined along the
+    way.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity, inside a transaction
+    logger : object
+        Log any pertinent events.
+    """
+    # The map draws of the summary were each taken from the services as a
+    # whole, so the largest of any duplicates is kept rather than their
+    # sum.  Sketches never had duplicates.
+    aggregates = {
+        'summary': {'mapdraws': 'MAX'},
+        'summary_clients': {'sketch': 'MAX'},
+        'service_clients': {'sketch': 'MAX'},
+    }
+
+    for table in AGGREGATE_TABLES:
+
+        sql = f"""
+               PRAGMA table_info({table})
+               """
+        columns = [row[1] for row in conn.execute(sql)]
+
+        if len(columns) == 0:
+            # Never created, so just create it.
+            create_aggregate_table(conn, table)
+            continue
+        elif 'date' not in columns:
+            # Already in its current form.
+            continue
+
+        logger.info(f"Rebuilding {table} with integer keys...")
+
+        create_aggregate_table(conn, table, name=f'{table}_new')
+        sql = f"""
+               PRAGMA table_info({table}_new)
+               """
+        new_columns = [row[1] for row in conn.execute(sql)]
+        pk = [row[1] for row in conn.execute(sql) if row[5] > 0]
+
+        # Columns that the old table lacks, e.g. the heavy hitter bounds,
+        # start out as zero.
+        others = [col for col in new_columns if col not in pk]
+        aggs = [
+            f"{aggregates.get(table, {}).get(col, 'SUM')}({col})"
+            if col in columns else '0'
+            for col in others
+        ]
+        keys = ["CAST(strftime('%s', date) AS integer)"] + pk[1:]
+
+        sql = f"""
+               INSERT INTO {table}_new ({', '.join(pk + others)})
+               SELECT {', '.join(keys + aggs)}
+               FROM {table}
+               WHERE date IS NOT NULL
+               GROUP BY {', '.join(keys)}
+               """
+        conn.execute(sql)
+
+        sql = f"""
+               DROP TABLE {table}
+               """
+        conn.execute(sql)
+
+        sql = f"""
+               ALTER TABLE {table}_new RENAME TO {table}
+               """
+        conn.execute(sql)
+
+        create_aggregate_indexes(conn, table)
+
+
+def add_rollup_tiers(conn, logger):
+    """
+    Add the tables for the tiers other than hourly, filling them in from the
+    hourly tables.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity, inside a transaction
+    logger : object
+        Log any pertinent events.
+    """
+    # The map draws of the summary are totals for each hour, so they add up
+    # just like the other counters.
+    for table in AGGREGATE_TABLES:
+        for tier in TIERS:
+
+            if tier == 'hourly':
+                continue
+
+            logger.info(f"Adding {tier_table(table, tier)}...")
+            create_aggregate_table(conn, table, tier)
+
+            sql = f"""
+                   PRAGMA table_info({tier_table(table, tier)})
+                   """
+            rows = conn.execute(sql).fetchall()
+            pk = [row[1] for row in rows if row[5] > 0]
+            others = [row[1] for row in rows if row[5] == 0]
+
+            if others == ['sketch']:
+                rollup_sketches(conn, table, tier, pk)
+                continue
+
+            keys = [floor_epoch_sql('hour_epoch', tier)] + pk[1:]
+            aggs = [f"SUM({col})" for col in others]
+            sql = f"""
+                   INSERT INTO {tier_table(table, tier)}
+                       ({', '.join(pk + others)})
+                   SELECT {', '.join(keys + aggs)}
+                   FROM {table}
+                   GROUP BY {', '.join(keys)}
+                   """
+            conn.execute(sql)
+
+
+def rollup_sketches(conn, table, tier, pk):
+    """
+    Fill in the table of client sketches for a tier from the hourly
+    sketches, which are merged rather than summed.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity, inside a transaction
+    table : str
+        Either summary_clients or service_clients.
+    tier : str
+        Key of TIERS.
+    pk : list
+        The primary key of the table for the tier.
+    """
+    sql = f"""
+           SELECT {', '.join(['hour_epoch'] + pk[1:])}, sketch
+           FROM {table}
+           """
+    df = pd.read_sql(sql, conn)
+    if len(df) == 0:
+        return
+
+    df[pk[0]] = floor_epoch(df['hour_epoch'], tier)
+    df = (df.groupby(pk, sort=False)['sketch']
+            .agg(merge_sketches)
+            .reset_index())
+
+    sql = f"""
+           INSERT INTO {tier_table(table, tier)} ({', '.join(pk)}, sketch)
+           VALUES ({', '.join('?' * (len(pk) + 1))})
+           """
+    conn.executemany(sql, df.itertuples(index=False, name=None))
+
+
+def migrate_burst_to_ring(conn, logger):
+    """
+    Rebuild the burst summary as a ring of minute slots.  Only the last
+    BURST_MINUTES minutes are kept, with any duplicate rows for the same
+    minute combined.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity, inside a transaction
+    logger : object
+        Log any pertinent events.
+    """
+    sql = """
+          PRAGMA table_info(burst_staging)
+          """
+    columns = [row[1] for row in conn.execute(sql)]
+
+    if len(columns) == 0:
+        create_burst_table(conn)
+        return
+    elif 'date' not in columns:
+        return
+
+    logger.info("Rebuilding burst_staging as a ring of minutes...")
+
+    create_burst_table(conn, name='burst_staging_new')
+
+    # The dates were written as text, or by some versions as seconds since
+    # the epoch.
+    epoch = """
+        CASE typeof(date)
+            WHEN 'integer' THEN date
+            ELSE CAST(strftime('%s', date) AS integer)
+        END
+        """
+    sql = f"""
+           WITH minutes AS (
+               SELECT {epoch} - {epoch} % 60 AS minute_epoch,
+                      hits, errors, nbytes
+               FROM burst_staging
+               WHERE date IS NOT NULL
+           )
+           INSERT INTO burst_staging_new
+               (slot, minute_epoch, hits, errors, nbytes)
+           SELECT minute_epoch / 60 % {BURST_MINUTES}, minute_epoch,
+                  SUM(hits), SUM(errors), SUM(nbytes)
+           FROM minutes
+           WHERE minute_epoch > (SELECT MAX(minute_epoch) FROM minutes)
+                                - {BURST_MINUTES * 60}
+           GROUP BY minute_epoch
+           """
+    conn.execute(sql)
+
+    sql = """
+          DROP TABLE burst_staging
+          """
+    conn.execute(sql)
+
+    sql = """
+          ALTER TABLE burst_staging_new RENAME TO burst_staging
+          """
+    conn.execute(sql)
+
+    conn.execute(BURST_INDEX)
+
+
+# Migrations in order, the first bringing version 0 to version 1, and so on.
+MIGRATIONS = [
+    migrate_to_integer_keys,
+    add_rollup_tiers,
+    migrate_burst_to_ring,
+]
+
+
+def migrate(conn, logger):
+    """
+    Bring the tables up to the current version.  Each migration runs in its
+    own transaction, with foreign keys off while the tables are rebuilt.
+
+    Parameters
+    ----------
+    conn : obj
+        database connectivity
+    logger : object
+        Log any pertinent events.
+
+    Returns
+    -------
+        True if anything was migrated
+    """
+    version = get_schema_version(conn)
+    if version >= SCHEMA_VERSION:
+        return False
+
+    # Foreign keys cannot be switched off inside a transaction.
+    conn.commit()
+    conn.execute('PRAGMA foreign_keys = 0')
+    try:
+        for j in range(version, SCHEMA_VERSION):
+            logger.info(f"Migrating the database to version {j + 1}...")
+            conn.execute('BEGIN')
+            try:
+                MIGRATIONS[j](conn, logger)
+                set_schema_version(conn, j + 1)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.execute('PRAGMA foreign_keys = 1')
+
+    # Give back the space the old tables held.
+    logger.info("Compacting the database...")
+    conn.execute('VACUUM')
+
+    return True
@@ -12,10 +12,169 @@ import pandas as pd
 from .common import CommonProcessor
 
 
+class ServicePathClassifier(object):
+    """
+    Map request paths straight to a service ID and mapdraw kind.  Paths in
+    the usual layout, i.e.
+
+        /<host>/arcgis[/rest]/services/<folder>/<service>/<type>...
+
+    are split apart and looked up in the known services.  Only paths that
+    do not fit that layout are given to the regular expression.
+
+    Attributes
+    ----------
+    cache : dict
+        Classification of each path up to the query string.
+    lut : dict
+        Maps (folder, service, service_type) to the service ID.
+    regex : object
+        Fallback parser for the request path.
+    """
+    hosts = frozenset((
+        'idpgis.ncep.noaa.gov.akadns.net',
+        'nowcoast.ncep.noaa.gov.akadns.net',
+    ))
+    word = re.compile(r'\w+')
+    max_cache_size = 100000
+
+    def __init__(self, services, regex):
+        """
+        Parameters
+        ----------
+        services : dataframe
+            The service_lut table.
+        regex : object
+            Fallback parser for the request path.
+        """
+        keys = zip(services['folder'], services['service'],
+                   services['service_type'])
+        self.lut = dict(zip(keys, services['id']))
+        self.regex = regex
+
+        self.cache = {}
+
+    def classify(self, paths):
+        """
+        Parameters
+        ----------
+        paths : iterable
+            The request paths.
+
+        Returns
+        -------
+            dataframe of service ID (-1 if not a known service), export
+            mapdraws, and WMS mapdraws for each path
+        """
+        records = [self.classify_path(path) for path in paths]
+        columns = ['id', 'export_mapdraws', 'wms_mapdraws']
+        return pd.DataFrame.from_records(records, columns=columns)
+
+    def classify_path(self, path):
+        """
+        Returns
+        -------
+            tuple of service ID (-1 if not a known service) and whether the
+            request was an export or WMS mapdraw
+        """
+        # Everything but the mapdraws is determined by the part before the
+        # query string, which repeats a great deal.
+        q = path.find('?')
+        prefix = path if q < 0 else path[:q]
+        try:
+            service_id, endpoint, offset = self.cache[prefix]
+        except KeyError:
+            service_id, endpoint, offset = self.classify_prefix(prefix)
+            if len(self.cache) >= self.max_cache_size:
+                self.cache.clear()
+            self.cache[prefix] = service_id, endpoint, offset
+
+        if service_id is None:
+            return self.classify_path_with_regex(path)
+        elif endpoint == 'export':
+            found = path[offset:].lower().find('f=image', 8) >= 0
+            return service_id, int(found), 0
+        elif endpoint == 'wms':
+            found = path[offset:].lower().find('request=getmap', 11) >= 0
+            return service_id, 0, int(found)
+        else:
+            return service_id, 0, 0
+
+    def classify_prefix(self, prefix):
+        """
+        Parameters
+        ----------
+        prefix : str
+            The request path up to the query string.
+
+        Returns
+        -------
+            tuple of service ID (None if the regex is needed), mapdraw
+            endpoint (export, wms, or None), and the offset of whatever
+            follows the service type
+        """
+        parts = prefix.split('/', 5)
+        if (
+            len(parts) < 6
+            or parts[0] != ''
+            or parts[1].lower() not in self.hosts
+            or parts[2].lower() != 'arcgis'
+        ):
+            return None, None, 0
+
+        if parts[3].lower() == 'rest' and parts[4].lower() == 'services':
+            tail = parts[5]
+        elif parts[3].lower() == 'services':
+            tail = parts[4] + '/' + parts[5]
+        else:
+            return None, None, 0
+
+        pieces = tail.split('/', 2)
+        if len(pieces) < 3:
+            return None, None, 0
+        folder, service, rest = pieces
+
+        m = self.word.match(rest)
+        if m is None:
+            return None, None, 0
+        service_type = m.group()
+
+        try:
+            service_id = self.lut[(folder, service, service_type)]
+        except KeyError:
+            return None, None, 0
+
+        # What's left after the service type determines the mapdraw kind.
+        offset = len(prefix) - len(rest) + m.end()
+        rest = rest[m.end():].lower()
+        if rest.startswith('/export'):
+            endpoint = 'export'
+        elif rest.startswith('/wmsserver'):
+            endpoint = 'wms'
+        else:
+            endpoint = None
+
+        return service_id, endpoint, offset
+
+    def classify_path_with_regex(self, path):
+        m = self.regex.search(path)
+        if m is None:
+            return -1, 0, 0
+
+        key = m.group('folder', 'service', 'service_type')
+        service_id = self.lut.get(key, -1)
+        export = m.group('export') is not None
+        wms = m.group('wmsgetmap') is not None
+        return service_id, int(export), int(wms)
+
+
 class ServicesProcessor(CommonProcessor):
     """
     Attributes
     ----------
+    classifier : ServicePathClassifier
+        Maps request paths to service IDs.  Built from the service_lut table
+        when first needed.
     regex : object
         Parses arcgis folders, services, types from the request path.
     time_series_sql : str
@@ -56,7 +215,7 @@ class ServicesProcessor(CommonProcessor):
 
         self.time_series_sql = """
             SELECT
-                a.date,
+                a.hour_epoch as date,
                 SUM(a.hits) as hits,
                 SUM(a.errors) as errors,
                 SUM(a.nbytes) as nbytes,
@@ -66,83 +225,87 @@ class ServicesProcessor(CommonProcessor):
             FROM service_logs a
             INNER JOIN service_lut b
             ON a.id = b.id
-            GROUP BY a.date, b.folder, b.service, b.service_type
-            ORDER BY a.date
+            WHERE a.hour_epoch >= ?
+            GROUP BY a.hour_epoch, b.folder, b.service, b.service_type
+            ORDER BY a.hour_epoch
             """
-        self.records = []
 
         self.data_retention_days = 30
 
-    def process_raw_records(self, df):
-        """
-        We have reached a limit on how many records we accumulate before
-        processing.  Turn what we have into a dataframe and aggregate it
-        to the appropriate granularity.
+        self.aggregate_keys = ['date', 'id']
+        self.tables = ['service_logs']
+        self.retention_days['hourly'] = self.data_retention_days
+        self.classifier = None
+
+    def classify_records(self, df):
         """
-        columns = ['date', 'path', 'hits', 'errors', 'nbytes']
-        df = df[columns].copy()
+        Determine the service and the kind of mapdraw, if any, for each
+        record.  The database is only read once (for the known services), so
+        this may be run in a worker process.
 
-        df_svc = df['path'].str.extract(self.regex)
+        Parameters
+        ----------
+        df : dataframe
+            The shared batch of raw records.
 
-        # Cleanly determine export and WMS map draws.
-        df_svc['export_mapdraws'] = (~df_svc['export'].isnull()).astype(int)
-        df_svc['wms_mapdraws'] = (~df_svc['wmsgetmap'].isnull()).astype(int)
+        Returns
+        -------
+            dataframe of service ID (-1 if not a known service), export
+            mapdraws, and WMS mapdraws, aligned with the batch
+        """
+        if self.classifier is None:
+            sql = """
+                  SELECT * from service_lut
+                  """
+            known_services = pd.read_sql(sql, self.conn)
+            self.classifier = ServicePathClassifier(known_services,
+                                                    self.regex)
+
+        # Only the distinct paths need be classified.
+        paths = df['path'].astype('category')
+        df_svc = self.classifier.classify(paths.cat.categories)
+        df_svc = df_svc.take(paths.cat.codes.values)
+        df_svc.index = df.index
+        return df_svc
+
+    def aggregate_raw_records(self, df):
+        """
+        Aggregate the raw records to the set frequency.  The database is not
+        touched, so this may be run in a worker process.
 
-        cols = [
-            'folder', 'service', 'service_type', 'export_mapdraws',
-            'wms_mapdraws'
-        ]
-        df = pd.concat((df, df_svc[cols]), axis='columns')
-        df = df.drop('path', axis='columns')
+        Parameters
+        ----------
+        df : dataframe
+            The shared batch of raw records, already classified into the
+            "service_id", "export_mapdraws", and "wms_mapdraws" columns.  It
+            must not be modified.
+        """
+        # Requests that are not for a known service must be dropped.
+        known = df['service_id'] >= 0
+        msg = (
+            f"Dropping {(~known).sum()} requests not matched to a known "
+            f"service"
+        )
+        self.logger.info(msg)
 
         # Aggregate by the set frequency and service, taking sums.
-        groupers = [
-            pd.Grouper(freq=self.frequency),
-            'folder', 'service', 'service_type'
+        columns = [
+            'hits', 'errors', 'nbytes', 'export_mapdraws', 'wms_mapdraws'
         ]
-        df = df.set_index('date').groupby(groupers).sum().reset_index()
-
-        # Have to have the same column names as the database.
-        df = self.replace_folders_and_services_with_ids(df)
-        if len(df) == 0:
-            return
-
-        df = self.merge_with_database(df, 'service_logs')
-
-        df.to_sql('service_logs', self.conn, if_exists='append', index=False)
-        self.conn.commit()
-
-        # Reset
-        self.records = []
-
-    def replace_folders_and_services_with_ids(self, df_orig):
-
-        sql = """
-              SELECT * from service_lut
-              """
-        known_services = pd.read_sql(sql, self.conn)
-
-        group_cols = ['folder', 'service', 'service_type']
-
-        # Get the service IDs
-        df = pd.merge(df_orig, known_services,
-                      how='left',
-                      left_on=group_cols,
-                      right_on=group_cols)
-
-        # How many services have NaN for IDs?  This must be dropped.
-        dfnull = df[df.id.isnull()]
-        n = len(dfnull)
-        msg = f"Dropping {n} unmatched service IDs (these are errors)"
-        self.logger.info(msg)
-        df = df.dropna(subset=['id'])
-
-        # We have the service ID, we don't need the folder, service, or
-        # service_type columns anymore.
-        df = df.drop(group_cols, axis='columns')
+        df_svc = df.loc[known, ['bucket', 'service_id'] + columns]
+        df = (self.aggregate_by_frequency(df_svc, ['service_id'],
+                                          columns=columns)
+                  .rename(columns={'service_id': 'id'}))
 
         return df
 
+    def update_database(self, df):
+        """
+        Merge aggregated records into the database.  The caller is
+        responsible for committing.
+        """
+        self.merge_with_tiers(df, 'service_logs')
+
     def process_graphics(self, html_doc):
         """Create the HTML and graphs for the services.
 
@@ -274,20 +437,3 @@ class ServicesProcessor(CommonProcessor):
             'ptext': ptext,
         }
         self.create_html_table(df, html_doc, **kwargs)
-
-    def preprocess_database(self):
-        """
-        Do any cleaning necessary before processing any new records.
-
-        Delete anything older than 30 days.
-        """
-        sql = """
-              DELETE FROM service_logs WHERE date < ?
-              """
-        datenum = (
-            dt.datetime.now() - dt.timedelta(days=self.data_retention_days)
-        ).timestamp()
-
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (datenum,))
-        self.conn.commit()
@@ -0,0 +1,329 @@
+# standard library imports
+import math
+import zlib
+
+# 3rd party library imports
+import numpy as np
+import pandas as pd
+
+# Stands for everything that is not a heavy hitter.
+OTHER = '(other)'
+
+
+class HeavyHitters(object):
+    """
+    Fixed-size summary of aggregated records, keeping only the top-K keys
+    (e.g. IP addresses) for each time bucket plus a single "other" row.
+
+    The summaries are mergeable in the manner of Space-Saving, so each batch
+    of records is summarized on its own and the summaries are then combined
+    across batches, log files, and runs, i.e. with the summaries already in
+    the database.  The hits of a tracked key are a lower bound, the true
+    count being at most hits + hits_error.  The other row holds whatever is
+    not tracked, so the totals are exact, and its hits_error bounds the hits
+    of any single untracked key.
+
+    Attributes
+    ----------
+    capacity : int
+        Number of keys to keep per time bucket.
+    counters : list
+        Columns to sum.
+    key : str
+        Column identifying what is counted.
+    other : object
+        Value of the key column for the other row.
+    """
+    def __init__(self, key, capacity, other=OTHER,
+                 counters=('hits', 'errors', 'nbytes')):
+        """
+        Parameters
+        ----------
+        key : str
+            Column identifying what is counted.
+        capacity : int
+            Number of keys to keep per time bucket.
+        other : object
+            Value of the key column for the other row.
+        counters : list
+            Columns to sum.
+        """
+        self.key = key
+        self.capacity = capacity
+        self.other = other
+        self.counters = list(counters)
+
+    def summarize(self, df):
+        """
+        Summarize exact aggregates, e.g. those of a single batch.
+
+        Parameters
+        ----------
+        df : dataframe
+            Aggregated records with date and key columns.
+
+        Returns
+        -------
+            dataframe with at most capacity + 1 rows per date
+        """
+        df = df.assign(**{self.key: df[self.key].astype(object),
+                          'hits_error': 0})
+        return self.truncate(df)
+
+    def merge(self, dfs):
+        """
+        Combine several summaries into one.
+
+        A key tracked in some summaries but not in others may be hiding in
+        their other rows, so its error grows by their bounds.
+
+        Parameters
+        ----------
+        dfs : list
+            Dataframes as produced by summarize or merge.
+
+        Returns
+        -------
+            dataframe with at most capacity + 1 rows per date
+        """
+        parts = [df.assign(part=j) for j, df in enumerate(dfs)]
+        df = pd.concat(parts, axis='index', ignore_index=True, sort=False)
+
+        is_other = df[self.key] == self.other
+        thresholds = df.loc[is_other, ['date', 'part', 'hits_error']]
+        tracked = df[~is_other]
+
+        # Sum of the bounds of all the summaries for each date, and of just
+        # the summaries that tracked each key.
+        total = thresholds.groupby('date')['hits_error'].sum()
+        covered = (tracked[['date', self.key, 'part']]
+                   .merge(thresholds, on=['date', 'part'], how='left')
+                   .fillna({'hits_error': 0})
+                   .groupby(['date', self.key])['hits_error']
+                   .sum())
+
+        columns = self.counters + ['hits_error']
+        tracked = tracked.groupby(['date', self.key])[columns].sum()
+        dates = tracked.index.get_level_values('date')
+        tracked['hits_error'] += (total.reindex(dates, fill_value=0).values
+                                  - covered.reindex(tracked.index).values)
+        tracked = tracked.reset_index()
+
+        # Any key never tracked hides in at most all of the other rows.
+        others = df[is_other].groupby('date')[columns].sum().reset_index()
+        others[self.key] = self.other
+
+        df = pd.concat((tracked, others), axis='index', ignore_index=True,
+                       sort=False)
+        return self.truncate(df)
+
+    def truncate(self, df):
+        """
+        Keep the top keys for each date by their upper bound, folding the
+        rest into the other row.
+        """
+        is_other = df[self.key] == self.other
+        upper = df['hits'] + df['hits_error']
+
+        df = df.assign(upper=upper.where(~is_other, -1))
+        df = df.sort_values(by=['date', 'upper'], ascending=[True, False])
+        rank = df.groupby('date').cumcount()
+
+        keep = (rank < self.capacity) & (df['upper'] >= 0)
+        kept = df[keep]
+        dropped = df[~keep]
+        if len(dropped) == 0:
+            return kept.drop(columns=['upper'])
+
+        # The bound on any untracked key is the larger of the existing bound
+        # and the upper bound of any key just dropped.
+        others = dropped.groupby('date').agg(
+            **{col: (col, 'sum') for col in self.counters},
+            hits_error=('hits_error', 'max'),
+            upper=('upper', 'max'),
+        )
+        others['hits_error'] = others[['hits_error', 'upper']].max(axis=1)
+        others = others.drop(columns=['upper']).reset_index()
+        others[self.key] = self.other
+
+        columns = ['date', self.key] + self.counters + ['hits_error']
+        df = pd.concat((kept[columns], others[columns]), axis='index',
+                       ignore_index=True)
+        return df
+
+
+def hash_values(values):
+    """
+    64-bit hashes of strings (or bytes), the same in every process, unlike
+    python's own hash function.
+
+    Parameters
+    ----------
+    values : sequence
+        Distinct values to hash.
+
+    Returns
+    -------
+        numpy array of uint64
+    """
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+class HyperLogLog(object):
+    """
+    Sketch for estimating the number of distinct values, e.g. clients, in a
+    fixed amount of memory.  Sketches merge losslessly, so the count for a
+    day or a week is found by merging hourly sketches rather than by
+    scanning the records.
+
+    Attributes
+    ----------
+    precision : int
+        There are 2 ** precision registers.  The relative error of the
+        estimate is about 1.04 / sqrt(2 ** precision).
+    registers : numpy array
+        For each register, the maximum rank of the hashes assigned to it.
+    """
+    def __init__(self, precision=12, registers=None):
+        """
+        Parameters
+        ----------
+        precision : int
+            There are 2 ** precision registers.  Must be between 11 and 18,
+            so that the rest of a hash converts to a float exactly.
+        registers : numpy array
+            Existing registers, otherwise the sketch is empty.
+        """
+        if not 11 <= precision <= 18:
+            msg = f"HyperLogLog precision must be 11-18, not {precision}."
+            raise ValueError(msg)
+
+        self.precision = precision
+        if registers is None:
+            self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+        else:
+            self.registers = registers
+
+    @classmethod
+    def index_and_rank(cls, hashes, precision=12):
+        """
+        Split hashes into the register to update and the rank, i.e. the
+        position of the first 1 bit in the rest of the hash.
+
+        Parameters
+        ----------
+        hashes : numpy array
+            64-bit hashes.
+        precision : int
+            There are 2 ** precision registers.
+
+        Returns
+        -------
+            tuple of numpy arrays
+        """
+        nbits = 64 - precision
+        index = (hashes >> np.uint64(nbits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << nbits) - 1)
+
+        # The exponent is the bit length, and an empty rest has the maximum
+        # rank.
+        _, exponent = np.frexp(rest.astype(np.float64))
+        rank = (nbits + 1 - exponent).astype(np.uint8)
+        return index, rank
+
+    @classmethod
+    def from_groups(cls, groups, hashes, precision=12):
+        """
+        Build one sketch for each group of hashes at once.
+
+        Parameters
+        ----------
+        groups : numpy array
+            Group number (0, 1, ...) of each hash.
+        hashes : numpy array
+            64-bit hashes.
+        precision : int
+            There are 2 ** precision registers.
+
+        Returns
+        -------
+            list of sketches, one per group number
+        """
+        index, rank = cls.index_and_rank(hashes, precision)
+        ngroups = int(groups.max()) + 1 if len(groups) > 0 else 0
+
+        registers = np.zeros((ngroups, 2 ** precision), dtype=np.uint8)
+        np.maximum.at(registers, (groups, index), rank)
+
+        return [cls(precision, registers[j]) for j in range(ngroups)]
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """
+        Parameters
+        ----------
+        blob : bytes
+            As produced by to_bytes.
+        """
+        data = zlib.decompress(blob)
+        registers = np.frombuffer(data[1:], dtype=np.uint8).copy()
+        return cls(data[0], registers)
+
+    def to_bytes(self):
+        """
+        Serialize the sketch.  Sparse sketches compress well, so a service
+        with few clients costs little to store.
+        """
+        data = bytes([self.precision]) + self.registers.tobytes()
+        return zlib.compress(data)
+
+    def merge(self, other):
+        """
+        Fold another sketch into this one.
+
+        Returns
+        -------
+            this sketch
+        """
+        if other.precision != self.precision:
+            msg = "Cannot merge HyperLogLog sketches of different precision."
+            raise ValueError(msg)
+
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        """
+        Returns
+        -------
+            estimated number of distinct values
+        """
+        m = 2 ** self.precision
+        alpha = 0.7213 / (1 + 1.079 / m)
+        harmonic = np.sum(np.ldexp(1.0, -self.registers.astype(int)))
+        estimate = alpha * m * m / harmonic
+
+        # Use linear counting while many registers are still empty.
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+
+def merge_sketches(blobs):
+    """
+    Parameters
+    ----------
+    blobs : iterable
+        Serialized HyperLogLog sketches.
+
+    Returns
+    -------
+        the serialized union of the sketches
+    """
+    blobs = iter(blobs)
+    sketch = HyperLogLog.from_bytes(next(blobs))
+    for blob in blobs:
+        sketch.merge(HyperLogLog.from_bytes(blob))
+    return sketch.to_bytes()
@@ -12,6 +12,9 @@ import seaborn as sns
 
 # Local imports
 from .common import CommonProcessor
+from .schema import (
+    BURST_MINUTES, TIERS, floor_epoch, from_epoch, tier_table, to_epoch
+)
 
 sns.set()
 
@@ -36,16 +39,31 @@ class SummaryProcessor(CommonProcessor):
 
         self.time_series_sql = """
             SELECT
-                date,
-                SUM(hits) as hits,
-                SUM(errors) as errors,
-                SUM(nbytes) as nbytes,
-                SUM(mapdraws) as mapdraws
+                hour_epoch as date,
+                hits,
+                errors,
+                nbytes,
+                mapdraws
             FROM summary
-            GROUP BY date
-            ORDER BY date
+            ORDER BY hour_epoch
             """
 
+        # The daily graphics reach back over the full timescale, which only
+        # the daily table still covers.
+        self.daily_time_series_sql = """
+            SELECT
+                day_epoch as date,
+                hits,
+                errors,
+                nbytes,
+                mapdraws
+            FROM summary_daily
+            ORDER BY day_epoch
+            """
+
+        self.aggregate_keys = ['date']
+        self.tables = ['summary']
+
     def post_process_burst(self):
         fig, ax = plt.subplots()
 
@@ -71,18 +89,7 @@ class SummaryProcessor(CommonProcessor):
 
         df.plot(ax=ax)
 
-        sql = """
-              SELECT date,
-                     SUM(hits) as hits,
-                     SUM(errors) as errors,
-                     SUM(nbytes) as nbytes
-              FROM burst_staging
-              GROUP BY date
-              ORDER BY date
-              """
-        df = pd.read_sql(sql, self.conn)
-        df['date'] = pd.to_datetime(df['date'], unit='s')
-
+        df = self.get_burst(BURST_MINUTES)
         df = df.set_index('date')
 
         # Get average rate per second.
@@ -95,48 +102,120 @@ class SummaryProcessor(CommonProcessor):
         df.plot.bar(dfr.index.values, dfr['amax'] - dfr['amin'],
                     bottom=dfr['amin'], edgecolor='none')
 
-    def process_raw_records(self, raw_df):
-
-        columns = ['date', 'hits', 'errors', 'nbytes']
-        df = raw_df[columns].copy()
+    def get_burst(self, minutes):
+        """
+        Read the burst summary for the last so many minutes for which there
+        are records.  Only those minutes are read, through the index.
 
-        # Do the burst summary (1 minute)
-        df = (df.set_index('date')
-                .resample('T')
-                .sum()
-                .reset_index())
-        df.to_sql('burst_staging', self.conn, if_exists='append', index=False)
+        Parameters
+        ----------
+        minutes : int
+            At most BURST_MINUTES.
+        """
+        sql = """
+              SELECT minute_epoch as date, hits, errors, nbytes
+              FROM burst_staging
+              WHERE minute_epoch > (
+                  SELECT MAX(minute_epoch) FROM burst_staging
+              ) - ?
+              ORDER BY minute_epoch
+              """
+        return self.get_rollup(sql, params=(minutes * 60,))
 
-        # Do the hourly summary
-        df = raw_df[columns].copy()
+    def aggregate_raw_records(self, raw_df):
+        """
+        Aggregate the raw records to one minute, which is the resolution
+        needed for the burst summary.  The hourly summary is derived from
+        this.  The database is not touched, so this may be run in a worker
+        process.
+
+        Parameters
+        ----------
+        raw_df : dataframe
+            The shared batch of raw records.  It must not be modified.
+        """
+        columns = ['hits', 'errors', 'nbytes']
 
-        # As a last step, aggregate the data without regard to the referer.
-        df = (df.set_index('date')
-                .resample(self.frequency)
-                .sum()
-                .reset_index())
+        # Do the burst summary (1 minute).  Any minutes without records
+        # still get a row.
+        df = (raw_df.groupby(raw_df['date'].dt.floor('T'))[columns]
+                    .sum()
+                    .resample('T')
+                    .sum()
+                    .reset_index())
 
-        df = self.merge_with_database(df, 'summary')
+        return df
 
-        # Now merge with the map draw information from the services table.
-        starting_date = df.loc[0]['date'].isoformat()
+    def update_database(self, df_minute):
+        """
+        Merge aggregated records into the database.  The caller is
+        responsible for committing.
+        """
+        # The burst summary goes into its ring of minutes.  A minute already
+        # there is added to, while the minute a full turn of the ring earlier
+        # is overwritten.  Anything older than what is there is too late to
+        # keep, as is anything before the last turn of the ring in the batch.
         sql = """
-              SELECT date,
-                     SUM(export_mapdraws) as export_mapdraws,
-                     SUM(wms_mapdraws) as wms_mapdraws
-              FROM service_logs
-              WHERE date >= ?
-              GROUP BY date
+              INSERT INTO burst_staging
+                  (slot, minute_epoch, hits, errors, nbytes)
+              VALUES (?, ?, ?, ?, ?)
+              ON CONFLICT (slot) DO UPDATE SET
+                  hits = excluded.hits + CASE minute_epoch
+                      WHEN excluded.minute_epoch THEN hits ELSE 0 END,
+                  errors = excluded.errors + CASE minute_epoch
+                      WHEN excluded.minute_epoch THEN errors ELSE 0 END,
+                  nbytes = excluded.nbytes + CASE minute_epoch
+                      WHEN excluded.minute_epoch THEN nbytes ELSE 0 END,
+                  minute_epoch = excluded.minute_epoch
+              WHERE excluded.minute_epoch >= minute_epoch
               """
-        df_svc = pd.read_sql(sql, self.conn, params=(starting_date,))
+        df = df_minute[['date', 'hits', 'errors', 'nbytes']]
+        df = df.tail(n=BURST_MINUTES)
+        minutes = to_epoch(df['date'])
+        df = (df.assign(date=minutes)
+                .rename(columns={'date': 'minute_epoch'}))
+        df.insert(0, 'slot', minutes // 60 % BURST_MINUTES)
+        self.conn.executemany(sql, df.itertuples(index=False, name=None))
+
+        # Do the summary for each tier, without regard to anything else.
+        columns = ['hits', 'errors', 'nbytes']
+        epochs = to_epoch(df_minute['date'])
+        for tier in TIERS:
+            dates = from_epoch(floor_epoch(epochs, tier))
+            df = (df_minute.groupby(dates)[columns]
+                           .sum()
+                           .rename_axis('date')
+                           .reset_index())
+            df = self.add_mapdraws(df, tier)
+            self.merge_with_database(df, 'summary', keys=[],
+                                     replace=['mapdraws'], tier=tier)
+
+    def add_mapdraws(self, df, tier):
+        """
+        Add the map draw information from the services table for the tier,
+        which already includes this batch.  Those are totals for each time
+        bucket, so they replace what is in the database.
+
+        Parameters
+        ----------
+        df : dataframe
+            Summary for each time bucket of the tier.
+        tier : str
+            Key of TIERS.
+        """
+        key = TIERS[tier]['key']
+        params = [int(x) for x in to_epoch(df['date'].iloc[[0, -1]])]
+        sql = f"""
+               SELECT {key} as date,
+                      SUM(export_mapdraws) + SUM(wms_mapdraws) as mapdraws
+               FROM {tier_table('service_logs', tier)}
+               WHERE {key} >= ? AND {key} <= ?
+               GROUP BY {key}
+               """
+        df_svc = self.get_rollup(sql, params=params)
         df = pd.merge(df, df_svc, on='date', how='left')
-        df = df.fillna(value=0)
-
-        df['mapdraws'] = df['export_mapdraws'] + df['wms_mapdraws']
-        df = df.drop(['export_mapdraws', 'wms_mapdraws'], axis='columns')
-
-        df.to_sql('summary', self.conn, if_exists='append', index=False)
-        self.conn.commit()
+        df['mapdraws'] = df['mapdraws'].fillna(0).astype(int)
+        return df
 
     def process_graphics(self, html_doc):
 
@@ -147,6 +226,7 @@ class SummaryProcessor(CommonProcessor):
         h1.text = f"{self.project.upper()} Summary"
 
         self.get_timeseries()
+        self.df_daily = self.get_rollup(self.daily_time_series_sql)
         self.summarize_transactions(html_doc)
         self.summarize_bandwidth(html_doc)
 
@@ -161,8 +241,11 @@ class SummaryProcessor(CommonProcessor):
 
         total_throughput = df.tail(n=24).sum().values[0] * 1000
 
-        # Downsample to days.
-        df = df.resample('D').sum()
+        # The days come from the daily table.  Fill in any missing days.
+        df = self.df_daily[['date', 'nbytes']].copy()
+        df.columns = ['date', 'bandwidth']
+        df.loc[:, 'bandwidth'] /= (1024 ** 4)
+        df = df.set_index('date').asfreq('D', fill_value=0)
 
         text = (
             f"{self.project.upper()} processed a total of "
@@ -207,21 +290,9 @@ class SummaryProcessor(CommonProcessor):
                             color='#2ca02c')
 
         # Ok, have the mapdraws and the axis in place.  Now add the hits and
-        # error information from burst_staging.
-        sql = """
-              SELECT date,
-                     SUM(hits) as hits,
-                     SUM(errors) as errors
-              FROM burst_staging
-              GROUP BY date
-              ORDER BY date
-              """
-        df = pd.read_sql(sql, self.conn)
-        df['date'] = pd.to_datetime(df['date'], unit='s')
-
-        # This are by the minute, so restrict to last day = 1440 minutes.
-        df = df.tail(n=1440 * 3)
-
+        # error information from burst_staging.  These are by the minute, so
+        # read just the last 3 days = 3 * 1440 minutes.
+        df = self.get_burst(1440 * 3)
         df = df.set_index('date')
 
         # Get average rate per second.
@@ -251,22 +322,12 @@ class SummaryProcessor(CommonProcessor):
 
         # get the geoevent information
         sql = """
-              SELECT MAX(date) AS date FROM user_agent_logs
-              """
-        df = pd.read_sql(sql, self.conn)
-
-        sql = """
-              SELECT a.date, SUM(a.hits) as hits
-              FROM user_agent_logs a
-              INNER JOIN user_agent_lut b
-              ON a.id = b.id
-              WHERE b.name LIKE 'GeoEvent%'
-              GROUP BY a.date
-              ORDER BY a.date
+              SELECT hour_epoch as date, hits
+              FROM user_agent_family_logs
+              WHERE family = 'GeoEvent'
+              ORDER BY hour_epoch
               """
-        # df = pd.read_sql(sql, self.conn, params=(max_date,))
-        df = pd.read_sql(sql, self.conn)
-        df['date'] = pd.to_datetime(df['date'], unit='s')
+        df = self.get_rollup(sql)
         df = df.set_index('date')
 
         # resample to minute
@@ -315,12 +376,10 @@ class SummaryProcessor(CommonProcessor):
         self.write_html_and_image_output(df, html_doc, **kwargs)
 
     def summarize_daily_transactions(self, df, html_doc):
-        # Now restrict the hourly data over the last few days to those
-        # referers.  Then restrict to valid hits.  And rename valid_hits to
-        # hits.
-        df['hits'] = df['hits']
-        df = df[['date', 'hits', 'errors', 'mapdraws']]
-        df = df.set_index('date').resample('D').sum()
+        # Read from the daily table, which covers the full timescale unlike
+        # the hourly data.  Fill in any missing days.
+        df = self.df_daily[['date', 'hits', 'errors', 'mapdraws']]
+        df = df.set_index('date').asfreq('D', fill_value=0)
 
         # Turn the data from hits/day to hits/second
         df['hits'] /= 86400
@@ -0,0 +1,182 @@
+# standard library imports
+import re
+
+# The general regular expression for an apache log line.  This is the slow
+# path, used only for lines that the tokenizer cannot handle.
+pattern = r'''
+    # (?P<ip_address>((\d+.\d+.\d+.\d+)|((\w*?:){6}(\w*?:)?(\w+)?)))
+    (?P<ip_address>.*?)
+    \s
+    # Client identity, always -?
+    -
+    \s
+    # Remote user, always -?
+    -
+    \s
+    # Time of request.  The timezone is always UTC, so don't bother
+    # parsing it.
+    \[(?P<timestamp>\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2})\s.....\]
+    \s
+    # The request
+    "(?P<request_op>(GET|DELETE|HEAD|OPTIONS|POST|PROPFIND|PUT))
+    \s
+    (?P<path>.*?)
+    \s
+    HTTP\/1.1"
+    \s
+    # Status code
+    (?P<status_code>\d+)
+    \s
+    # payload size
+    (?P<nbytes>\d+)
+    \s
+    # referer
+    "(?P<referer>.*?)"
+    \s
+    # user agent
+    "(?P<user_agent>.*?)"
+    \s
+    # something else that seems to always be "-"
+    "-"
+    '''
+regex = re.compile(pattern, re.VERBOSE)
+
+REQUEST_OPS = frozenset((
+    b'GET', b'DELETE', b'HEAD', b'OPTIONS', b'POST', b'PROPFIND', b'PUT'
+))
+
+# Validate a timestamp such as 01/Mar/2019:00:00:00 in a single pass by
+# mapping every digit to 9 and every letter to "a".
+DIGITS = b'0123456789'
+LETTERS = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+TIMESTAMP_TABLE = bytes.maketrans(DIGITS + LETTERS,
+                                  b'9' * len(DIGITS) + b'a' * len(LETTERS))
+TIMESTAMP_TEMPLATE = b'99/aaa/9999:99:99:99'
+
+
+def parse_line(line):
+    """
+    Parse a raw log line, trying the tokenizer first and falling back to the
+    regular expression.
+
+    Parameters
+    ----------
+    line : bytes
+        Raw line from the apache log file.
+
+    Returns
+    -------
+        tuple of (timestamp, ip_address, path, hits, status_code, nbytes,
+        referer, user_agent), or None if the line could not be parsed
+    """
+    record = tokenize_line(line)
+    if record is None:
+        record = match_line(line.decode('utf-8', errors='replace'))
+    return record
+
+
+def match_line(line):
+    """
+    Parse a decoded log line with the regular expression.
+
+    Parameters
+    ----------
+    line : str
+        Decoded line from the apache log file.
+
+    Returns
+    -------
+        record tuple, or None if the line was not matched
+    """
+    m = regex.match(line)
+    if m is None:
+        return None
+
+    # the 4th item is to designate a "hit".
+    return (
+        m.group('timestamp'),
+        m.group('ip_address'),
+        m.group('path'),
+        1,
+        int(m.group('status_code')),
+        int(m.group('nbytes')),
+        m.group('referer'),
+        m.group('user_agent')
+    )
+
+
+def tokenize_line(line):
+    """
+    Split a raw log line in the fixed Akamai layout, i.e.
+
+        IP - - [TIME +0000] "OP PATH HTTP/1.1" STATUS NBYTES "REF" "UA" "-"
+
+    without the regular expression.  Anything out of the ordinary is left to
+    the regular expression, so a successful result here is always the same
+    as that of match_line.
+
+    Parameters
+    ----------
+    line : bytes
+        Raw line from the apache log file.
+
+    Returns
+    -------
+        record tuple, or None if the line does not have the expected layout
+    """
+    i = line.find(b' - - [')
+    if i <= 0:
+        return None
+
+    # The timestamp is fixed width, followed by the timezone.
+    j = i + 6
+    timestamp = line[j:j + 20]
+    if line[j + 20:j + 21] != b' ' or line[j + 26:j + 29] != b'] "':
+        return None
+    if timestamp.translate(TIMESTAMP_TABLE) != TIMESTAMP_TEMPLATE:
+        return None
+
+    # The request.
+    k = j + 29
+    m = line.find(b' ', k)
+    if line[k:m] not in REQUEST_OPS:
+        return None
+    # The path may be empty only if it is set off by two spaces, as the
+    # regular expression expects a space on either side of it.
+    n = line.find(b' HTTP/1.1" ', m + 1)
+    if n < 0:
+        return None
+
+    # The regular expression would take anything like HTTP/1x1 in the path
+    # as the end of it instead.
+    if line.find(b'HTTP/1', m + 2, n + 6) >= 0:
+        return None
+    path = line[m + 1:n]
+
+    try:
+        status_code, nbytes, rest = line[n + 11:].split(b' ', 2)
+    except ValueError:
+        return None
+    if not (status_code.isdigit() and nbytes.isdigit()):
+        return None
+
+    # The referer and user agent are both quoted, followed by "-".
+    if rest[:1] != b'"':
+        return None
+    r = rest.find(b'" "', 1)
+    if r < 0:
+        return None
+    u = rest.find(b'" "-"', r + 3)
+    if u < 0:
+        return None
+
+    return (
+        timestamp.decode('ascii', errors='replace'),
+        line[:i].decode('utf-8', errors='replace'),
+        path.decode('utf-8', errors='replace'),
+        1,
+        int(status_code),
+        int(nbytes),
+        rest[1:r].decode('utf-8', errors='replace'),
+        rest[r + 3:u].decode('utf-8', errors='replace'),
+    )
@@ -2,6 +2,8 @@
 
 # Standard library imports
 import datetime as dt
+import functools
+import re
 
 # 3rd party library imports
 import matplotlib.pyplot as plt
@@ -11,6 +13,7 @@ import seaborn as sns
 
 # Local imports
 from .common import CommonProcessor
+from .lut import LookupTableCache
 
 sns.set()
 
@@ -25,6 +28,42 @@ def millions_fcn(x, pos):
     return f'{(x/1e6):.2f}M'
 
 
+# The first match wins, so the more specific families come first.
+USER_AGENT_FAMILIES = [
+    ('GeoEvent', re.compile(r'^GeoEvent', re.IGNORECASE)),
+    ('ArcGIS Pro', re.compile(r'ArcGIS ?Pro\b', re.IGNORECASE)),
+    ('ArcGIS Runtime', re.compile(r'ArcGIS ?Runtime', re.IGNORECASE)),
+    ('ArcGIS other', re.compile(r'ArcGIS|Esri', re.IGNORECASE)),
+    ('Bot', re.compile(r'bot\b|crawl|spider|slurp|facebookexternalhit',
+                       re.IGNORECASE)),
+    ('Script', re.compile(r'^(python|curl|wget|libwww-perl|java/|okhttp|'
+                          r'go-http-client|apache-httpclient|node-fetch|'
+                          r'axios|powershell)', re.IGNORECASE)),
+    ('Browser', re.compile(r'^(Mozilla|Opera)/')),
+]
+
+
+@functools.lru_cache(maxsize=100000)
+def classify_user_agent(user_agent):
+    """
+    Determine the family of a user agent, e.g. GeoEvent or Browser.  The
+    same user agents turn up over and over again, so the results are cached.
+
+    Parameters
+    ----------
+    user_agent : str
+        User agent as found in the log.
+    """
+    if user_agent in ('', '-'):
+        return 'Unknown'
+
+    for family, regex in USER_AGENT_FAMILIES:
+        if regex.search(user_agent) is not None:
+            return family
+
+    return 'Other'
+
+
 class UserAgentProcessor(CommonProcessor):
     """
     Attributes
@@ -46,76 +85,64 @@ class UserAgentProcessor(CommonProcessor):
         super().__init__(project, **kwargs)
 
         self.time_series_sql = """
-            SELECT a.date, SUM(a.hits) as hits, SUM(a.errors) as errors,
-                   SUM(a.nbytes) as nbytes, b.name as user_agent
+            SELECT a.hour_epoch as date, SUM(a.hits) as hits,
+                   SUM(a.errors) as errors, SUM(a.nbytes) as nbytes,
+                   b.name as user_agent
             FROM user_agent_logs a
             INNER JOIN user_agent_lut b
             ON a.id = b.id
-            GROUP BY a.date, user_agent
-            ORDER BY a.date
+            WHERE b.name != '(other)' AND a.hour_epoch >= ?
+            GROUP BY a.hour_epoch, user_agent
+            ORDER BY a.hour_epoch
             """
 
         self.data_retention_days = 7
 
-    def process_raw_records(self, df):
+        self.aggregate_keys = ['date', 'user_agent']
+        self.tables = ['user_agent_logs']
+        self.lut_cache = LookupTableCache(self.conn, 'user_agent_lut', 'name')
+
+    def upgrade_tables(self):
         """
-        We have reached a limit on how many records we accumulate before
-        processing.  Turn what we have into a dataframe and aggregate it
-        to the appropriate granularity.
+        Older databases have no room for the error bounds of heavy hitters.
         """
-        columns = ['date', 'user_agent', 'hits', 'errors', 'nbytes']
-        df = df[columns].copy()
+        self.add_missing_column('user_agent_logs', 'hits_error',
+                                'integer DEFAULT 0')
 
+    def aggregate_raw_records(self, df):
+        """
+        Aggregate the raw records to the set frequency.  The database is not
+        touched, so this may be run in a worker process.
+
+        Parameters
+        ----------
+        df : dataframe
+            The shared batch of raw records.  It must not be modified.
+        """
         # Aggregate by the set frequency and user_agent, taking sums.
-        groupers = [pd.Grouper(freq=self.frequency), 'user_agent']
-        df = df.set_index('date').groupby(groupers).sum().reset_index()
+        df = self.aggregate_by_frequency(df, ['user_agent'])
 
-        # Have to have the same column names as the database.
-        df = self.replace_user_agents_with_ids(df)
+        if self.heavy_hitters is not None:
+            df = self.heavy_hitters.summarize(df)
 
-        df = self.merge_with_database(df, 'user_agent_logs')
+        return df
 
-        df.to_sql('user_agent_logs', self.conn,
-                  if_exists='append', index=False)
-        self.conn.commit()
+    def update_database(self, df):
+        """
+        Merge aggregated records into the database.  The caller is
+        responsible for committing.
+        """
+        # Have to have the same column names as the database.
+        df = self.replace_user_agents_with_ids(df)
 
-        # Reset for the next round of records.
-        self.records = []
+        self.merge_with_tiers(df, 'user_agent_logs')
 
     def replace_user_agents_with_ids(self, df_orig):
         """
         Don't log the actual user_agent names to the database, log the ID
         instead.
         """
-
-        sql = """
-              SELECT * from user_agent_lut
-              """
-        known_user_agents = pd.read_sql(sql, self.conn)
-
-        # Get the user_agent IDs
-        df = pd.merge(df_orig, known_user_agents,
-                      how='left', left_on='user_agent', right_on='name')
-
-        # How many user_agents have NaN for IDs?  This must populate the known
-        # user_agents table before going further.
-        unknown_user_agents = df['user_agent'][df['id'].isnull()].unique()
-        if len(unknown_user_agents) > 0:
-            new_df = pd.Series(unknown_user_agents, name='name').to_frame()
-
-            new_df.to_sql('user_agent_lut', self.conn,
-                          if_exists='append', index=False)
-
-            sql = """
-                  SELECT * from user_agent_lut
-                  """
-            known_user_agents = pd.read_sql(sql, self.conn)
-            df = pd.merge(df_orig, known_user_agents,
-                          how='left', left_on='user_agent', right_on='name')
-
-        df.drop(['user_agent', 'name'], axis='columns', inplace=True)
-
-        return df
+        return self.replace_with_ids(df_orig, 'user_agent')
 
     def process_graphics(self, html_doc):
         self.get_timeseries()
@@ -251,3 +278,174 @@ class UserAgentProcessor(CommonProcessor):
             'h1text': f'Top UserAgents by Hits: {yesterday}'
         }
         self.create_html_table(df, html_doc, **kwargs)
+
+
+class UserAgentFamilyProcessor(CommonProcessor):
+    """
+    Aggregate by the family of the user agent rather than by the user agent
+    itself, so that questions about e.g. GeoEvent traffic go to a small,
+    indexed table.
+
+    Attributes
+    ----------
+    time_series_sql : str
+        SQL to collect a coherent timeseries of user agent family
+        information.
+    """
+    def __init__(self, project, **kwargs):
+        """
+        Parameters
+        ----------
+        """
+        super().__init__(project, **kwargs)
+
+        self.time_series_sql = """
+            SELECT hour_epoch as date, family, SUM(hits) as hits,
+                   SUM(errors) as errors, SUM(nbytes) as nbytes
+            FROM user_agent_family_logs
+            WHERE hour_epoch >= ?
+            GROUP BY hour_epoch, family
+            ORDER BY hour_epoch
+            """
+
+        self.data_retention_days = 7
+
+        self.aggregate_keys = ['date', 'family']
+        self.tables = ['user_agent_family_logs']
+
+    def upgrade_tables(self):
+        """
+        Older databases have no user agent family table.  It is filled in
+        from the user agents already logged before those are migrated.
+        """
+        sql = """
+              SELECT name
+              FROM sqlite_master
+              WHERE type='table' AND name='user_agent_family_logs'
+              """
+        if self.conn.execute(sql).fetchone() is None:
+            self.add_family_table()
+
+    def add_family_table(self):
+        """
+        Create the user agent family table, filling it in from the user
+        agents already logged.  Only databases from before the tables were
+        versioned lack it, so it is created in their form and migrated along
+        with the others.
+        """
+        self.logger.info("Adding user_agent_family_logs...")
+
+        sql = """
+              CREATE TABLE user_agent_family_logs (
+                  date timestamp,
+                  family text,
+                  hits integer,
+                  errors integer,
+                  nbytes integer
+              )
+              """
+        self.conn.execute(sql)
+
+        sql = """
+              SELECT a.date, b.name as user_agent, SUM(a.hits) as hits,
+                     SUM(a.errors) as errors, SUM(a.nbytes) as nbytes
+              FROM user_agent_logs a
+              INNER JOIN user_agent_lut b
+              ON a.id = b.id
+              GROUP BY a.date, b.name
+              """
+        df = pd.read_sql(sql, self.conn)
+        if len(df) > 0:
+            family = df['user_agent'].map(classify_user_agent)
+            columns = ['hits', 'errors', 'nbytes']
+            df = (df.groupby(['date', family])[columns]
+                    .sum()
+                    .reset_index()
+                    .rename(columns={'user_agent': 'family'}))
+            df.to_sql('user_agent_family_logs', self.conn,
+                      if_exists='append', index=False)
+
+        self.conn.commit()
+
+    def aggregate_raw_records(self, df):
+        """
+        Aggregate the raw records to the set frequency.  The database is not
+        touched, so this may be run in a worker process.
+
+        Parameters
+        ----------
+        df : dataframe
+            The shared batch of raw records.  It must not be modified.
+        """
+        # Classify each distinct user agent only once, then map the results
+        # back onto the records by their codes.
+        user_agents = df['user_agent'].astype('category')
+        families = [
+            classify_user_agent(x) for x in user_agents.cat.categories
+        ]
+        codes, uniques = pd.factorize(families)
+        family = pd.Series(
+            pd.Categorical.from_codes(
+                codes.take(user_agents.cat.codes.values), categories=uniques
+            ),
+            index=df.index, name='family'
+        )
+
+        # Aggregate by the set frequency and family, taking sums.
+        df = self.aggregate_by_frequency(df, [family])
+
+        return df
+
+    def update_database(self, df):
+        """
+        Merge aggregated records into the database.  The caller is
+        responsible for committing.
+        """
+        self.merge_with_tiers(df, 'user_agent_family_logs', keys=['family'])
+
+    def process_graphics(self, html_doc):
+        """
+        Create a table of the hits for each user agent family for the latest
+        day.
+
+        Parameters
+        ----------
+        html_doc : lxml.etree.ElementTree
+            HTML document for the logs.
+        """
+        self.get_timeseries()
+
+        columns = ['hits', 'nbytes', 'errors']
+        df = self.df_today.groupby('family')[columns].sum()
+
+        total_hits = df['hits'].sum()
+        total_bytes = df['nbytes'].sum()
+        total_errors = df['errors'].sum()
+
+        df['hits %'] = df['hits'] / total_hits * 100
+        df['GBytes'] = df['nbytes'] / (1024 ** 3)  # GBytes
+        df['GBytes %'] = df['nbytes'] / total_bytes * 100
+
+        df['errors: % of all hits'] = df['errors'] / total_hits * 100
+        df['errors: % of all errors'] = df['errors'] / total_errors * 100
+
+        # Reorder the columns
+        reordered_cols = [
+            'hits',
+            'hits %',
+            'GBytes',
+            'GBytes %',
+            'errors',
+            'errors: % of all hits',
+            'errors: % of all errors'
+        ]
+        df = df[reordered_cols]
+        df = df.sort_values(by='hits', ascending=False)
+
+        yesterday = (dt.date.today() - dt.timedelta(days=1)).isoformat()
+        kwargs = {
+            'aname': 'user_agent_families',
+            'atext': 'UserAgent Families',
+            'h1text': f'UserAgent Families by Hits: {yesterday}'
+        }
+        self.create_html_table(df, html_doc, **kwargs)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Compare the throughput of the regular expression with that of the tokenizer
+for parsing apache log lines.
+
+    python benchmarks/tokenizer_benchmark.py [logfile.gz]
+
+If no log file is given, synthetic lines in the Akamai layout are used.
+"""
+
+# standard library imports
+import argparse
+import gzip
+import itertools
+import time
+
+# local imports
+from arcgis_apache_logs.tokenizer import match_line, parse_line
+
+SAMPLE_LINES = [
+    (
+        b'192.168.1.10 - - [01/Mar/2019:00:00:01 +0000] '
+        b'"GET /idpgis.ncep.noaa.gov.akadns.net/arcgis/rest/services'
+        b'/NWS_Observations/radar_base_reflectivity/MapServer/export'
+        b'?bbox=-130,20,-60,50&size=800,600&f=image HTTP/1.1" 200 52344 '
+        b'"https://www.weather.gov/" '
+        b'"Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/72.0" "-"\n'
+    ),
+    (
+        b'2001:db8::5 - - [01/Mar/2019:00:00:02 +0000] '
+        b'"GET /idpgis.ncep.noaa.gov.akadns.net/arcgis/services'
+        b'/NOS_Observations/CO_OPS_Station_Locations/MapServer/WMSServer'
+        b'?service=WMS&request=GetMap&layers=0 HTTP/1.1" 304 0 "-" '
+        b'"ArcGIS Pro 2.3.0 (00000000000) - ArcGISPro" "-"\n'
+    ),
+]
+
+
+def read_lines(path, nlines):
+    if path is None:
+        return list(itertools.islice(itertools.cycle(SAMPLE_LINES), nlines))
+    with gzip.open(path, mode='rb') as f:
+        return list(itertools.islice(f, nlines))
+
+
+def regex_path(lines):
+    # This is how lines were parsed before the tokenizer, i.e. decode
+    # everything first and then match.
+    for line in lines:
+        match_line(line.decode('utf-8', errors='replace'))
+
+
+def tokenizer_path(lines):
+    for line in lines:
+        parse_line(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logfile', nargs='?')
+    parser.add_argument('--lines', type=int, default=500000)
+    args = parser.parse_args()
+
+    lines = read_lines(args.logfile, args.lines)
+
+    for name, fcn in (('regex', regex_path), ('tokenizer', tokenizer_path)):
+        t0 = time.perf_counter()
+        fcn(lines)
+        elapsed = time.perf_counter() - t0
+        print(f'{name:>10}:  {len(lines) / elapsed:12,.0f} lines/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -18,10 +18,11 @@ ags-get-akamai-logs $project
 # Process files just recently downloaded
 files_to_process=$(find "$root" -mmin -60 -name "*.gz" | sort -t "-" -k 3,3n -k4,4 -k5,5n)
 
-for logfile in $files_to_process
-do
-	ags-parse-logs $project --infile $logfile
-done
+# Parse all the fragments at once, merging into the database just once.
+if [ -n "$files_to_process" ]
+then
+	ags-parse-logs $project --infile $files_to_process
+fi
 
 ags-produce-graphics $project
 
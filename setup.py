@@ -5,6 +5,7 @@ from setuptools import setup, find_packages
 
 cmdline = 'arcgis_apache_logs.commandline'
 console_scripts = [
+    f'ags-explain-sql={cmdline}:explain_arcgis_apache_sql',
     f'ags-initialize={cmdline}:init_db',
     f'ags-parse-logs={cmdline}:parse_arcgis_apache_logs',
     f'ags-prune-database={cmdline}:prune_arcgis_apache_database',
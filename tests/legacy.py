@@ -0,0 +1,178 @@
+"""
+Databases as created by the earliest, unversioned layout, i.e. schema
+version 0.
+"""
+# Standard library imports
+import sqlite3
+
+TABLES = [
+    """
+    CREATE TABLE summary (
+        date timestamp,
+        hits integer,
+        mapdraws integer,
+        errors integer,
+        nbytes integer
+    )
+    """,
+    """
+    CREATE TABLE burst_staging (
+        date timestamp,
+        hits integer,
+        errors integer,
+        nbytes integer
+    )
+    """,
+    """
+    CREATE TABLE service_lut (
+        id integer PRIMARY KEY,
+        folder text,
+        service text,
+        service_type text
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX idx_services
+    ON service_lut(folder, service, service_type)
+    """,
+    """
+    CREATE TABLE service_logs (
+        date timestamp,
+        id integer,
+        hits integer,
+        errors integer,
+        nbytes integer,
+        export_mapdraws integer,
+        wms_mapdraws integer,
+        CONSTRAINT fk_service_lut_id
+            FOREIGN KEY (id)
+            REFERENCES service_lut(id)
+            ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE ip_address_lut (
+        id integer PRIMARY KEY,
+        ip_address text,
+        name text
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX idx_ip_address
+    ON ip_address_lut(ip_address)
+    """,
+    """
+    CREATE TABLE ip_address_logs (
+        date timestamp,
+        id integer,
+        hits integer,
+        errors integer,
+        nbytes integer,
+        CONSTRAINT fk_known_ip_address_id
+            FOREIGN KEY (id)
+            REFERENCES ip_address_lut(id)
+            ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE referer_lut (
+        id integer PRIMARY KEY,
+        name text
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX idx_referer
+    ON referer_lut(name)
+    """,
+    """
+    CREATE TABLE referer_logs (
+        date timestamp,
+        id integer,
+        hits integer,
+        errors integer,
+        nbytes integer,
+        CONSTRAINT fk_referer_lut_id
+            FOREIGN KEY (id)
+            REFERENCES referer_lut(id)
+            ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE user_agent_lut (
+        id integer PRIMARY KEY,
+        name text
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX idx_user_agent
+    ON user_agent_lut(name)
+    """,
+    """
+    CREATE TABLE user_agent_logs (
+        date timestamp,
+        id integer,
+        hits integer,
+        errors integer,
+        nbytes integer,
+        CONSTRAINT fk_user_agents_id
+            FOREIGN KEY (id)
+            REFERENCES user_agent_lut(id)
+            ON DELETE CASCADE
+    )
+    """,
+]
+
+
+def create_legacy_database(path, date):
+    """
+    Create a version 0 database with a few hours of traffic.
+
+    Parameters
+    ----------
+    path : path or str
+        The database file.
+    date : datetime
+        Start of the first hour.
+    """
+    conn = sqlite3.connect(path)
+    for sql in TABLES:
+        conn.execute(sql)
+
+    conn.execute("""
+        INSERT INTO service_lut VALUES
+        (1, 'NWS_Observations', 'radar_base_reflectivity', 'MapServer')
+        """)
+    conn.execute("""
+        INSERT INTO ip_address_lut VALUES
+        (1, '192.0.2.1', NULL), (2, '2001:db8::1', NULL)
+        """)
+    conn.execute("""
+        INSERT INTO referer_lut VALUES (1, 'https://www.weather.gov/')
+        """)
+    conn.execute("""
+        INSERT INTO user_agent_lut VALUES
+        (1, 'Mozilla/5.0 (X11; Linux x86_64) Firefox/66.0'),
+        (2, 'GeoEvent Server 10.6')
+        """)
+
+    for hour in range(3):
+        when = f"{date:%Y-%m-%d} {date.hour + hour:02d}:00:00"
+        conn.execute("INSERT INTO summary VALUES (?, 30, 10, 3, 3000)",
+                     (when,))
+        conn.execute("INSERT INTO burst_staging VALUES (?, 30, 3, 3000)",
+                     (when,))
+        conn.execute(
+            "INSERT INTO service_logs VALUES (?, 1, 30, 3, 3000, 10, 0)",
+            (when,)
+        )
+        for id in (1, 2):
+            for table in ('ip_address_logs', 'user_agent_logs'):
+                conn.execute(
+                    f"INSERT INTO {table} VALUES (?, ?, 15, 1, 1500)",
+                    (when, id)
+                )
+        conn.execute("INSERT INTO referer_logs VALUES (?, 1, 30, 3, 3000)",
+                     (when,))
+
+    conn.commit()
+    conn.close()
@@ -0,0 +1,68 @@
+# Standard library imports
+import datetime as dt
+import unittest
+
+# 3rd party library imports
+import pandas as pd
+
+# Local imports
+from arcgis_apache_logs.schema import to_epoch
+from .utils import ParserTestCase, make_log_lines, write_log_file
+
+
+class TestClients(ParserTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.start = dt.datetime.combine(
+            dt.date.today() - dt.timedelta(days=1), dt.time(10)
+        )
+
+    def ingest(self, name, start, addresses):
+        """
+        Parse a log file with requests from these clients.
+        """
+        path = f'{self.root}/{name}.log.gz'
+        write_log_file(path, make_log_lines(600, start=start,
+                                            addresses=addresses))
+        parser = self.make_parser(infile=path)
+        parser.parse_input(max_workers=1)
+        return parser.clients
+
+    def test_late_batch(self):
+        """
+        A late batch is merged into the sketches of its own hour, and only
+        those are read back.
+        """
+        early = [f'192.0.2.{j}' for j in range(100)]
+        late = [f'198.51.100.{j}' for j in range(50)]
+
+        self.ingest('early', self.start, early)
+        self.ingest('later', self.start + dt.timedelta(hours=4), early)
+        clients = self.ingest('late', self.start, late)
+
+        stop = self.start + dt.timedelta(hours=1)
+        self.assertAlmostEqual(clients.count_unique_clients(self.start, stop),
+                               150, delta=5)
+
+        # The day has the same clients, merged into its own sketch.
+        day = self.start.date()
+        n = clients.count_unique_clients(day, day + dt.timedelta(days=1),
+                                         tier='daily')
+        self.assertAlmostEqual(n, 150, delta=5)
+
+        # The later hour has a sketch for the service too, but only the
+        # keys of the batch are read back.
+        (service_id,), = clients.conn.execute("SELECT id FROM service_lut")
+        df = pd.DataFrame({
+            'hour_epoch': to_epoch([self.start]),
+            'id': [service_id],
+        })
+        existing = clients.select_sketches(df, 'service_clients',
+                                           ['hour_epoch', 'id'])
+        self.assertEqual(list(existing),
+                         [(int(df.at[0, 'hour_epoch']), service_id)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# Standard library imports
+import contextlib
+import hashlib
+import io
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+# Local imports
+from arcgis_apache_logs.explain import explain_sql
+from .utils import ParserTestCase, make_log_lines, write_log_file
+
+
+class TestExplain(ParserTestCase):
+
+    def test_source_unchanged(self):
+        """
+        The database is copied without being changed in any way, not even
+        its journal mode.
+        """
+        path = pathlib.Path(self.root) / 'arcgis_apache_idpgis.db'
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+
+        infile = f'{self.root}/access.log.gz'
+        write_log_file(infile, make_log_lines(100))
+
+        with contextlib.redirect_stdout(io.StringIO()) as f:
+            explain_sql('idpgis', document_root=self.root, infile=[infile])
+
+        self.assertIn('INSERT INTO summary', f.getvalue())
+        self.assertEqual(hashlib.sha256(path.read_bytes()).hexdigest(),
+                         digest)
+        self.assertFalse(path.with_name(path.name + '-wal').exists())
+
+    def test_missing_database(self):
+        """
+        A missing database is not created.
+        """
+        with tempfile.TemporaryDirectory() as root:
+            with self.assertRaises(sqlite3.OperationalError):
+                explain_sql('idpgis', document_root=root)
+            self.assertEqual(list(pathlib.Path(root).iterdir()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
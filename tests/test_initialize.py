@@ -0,0 +1,119 @@
+# Standard library imports
+import json
+import logging
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# 3rd party library imports
+import pandas as pd
+import requests
+
+# Local imports
+from arcgis_apache_logs.initialize import Initializer
+
+URL = 'https://idpgis.ncep.noaa.gov/arcgis/rest/services'
+
+CATALOG = {
+    URL: {'folders': ['NOS_Observations', 'NWS_Observations', 'NWS_Climate']},
+    f'{URL}/NOS_Observations': {
+        'services': [
+            {'name': 'NOS_Observations/CO_OPS_Station_Locations',
+             'type': 'MapServer'},
+        ],
+    },
+    f'{URL}/NWS_Observations': {
+        'services': [
+            {'name': 'NWS_Observations/radar_base_reflectivity',
+             'type': 'MapServer'},
+        ],
+    },
+    f'{URL}/NWS_Climate': {
+        'services': [
+            {'name': 'NWS_Climate/cpc_6_10_day_outlk', 'type': 'MapServer'},
+        ],
+    },
+}
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        logger = logging.getLogger('arcgis_apache_logs.initialize')
+        logger.disabled = True
+        self.addCleanup(setattr, logger, 'disabled', False)
+
+        self.initializer = Initializer('idpgis', document_root=self.root)
+
+        # The last complete snapshot.
+        df = pd.DataFrame({
+            'folder': ['NWS_Observations'],
+            'service': ['radar_base_reflectivity'],
+            'service_type': ['MapServer'],
+        })
+        self.initializer.save_snapshot(df)
+        self.snapshot = self.initializer.snapshot_path.read_text()
+
+    def retrieve(self, catalog):
+        """
+        Retrieve and save the services from a fake web site.
+        """
+        def retrieve_json(url, **kwargs):
+            j = catalog[url]
+            if isinstance(j, Exception):
+                raise j
+            return j
+
+        with mock.patch.object(self.initializer, 'retrieve_json',
+                               side_effect=retrieve_json):
+            return self.initializer.retrieve_and_save_services()
+
+    def test_complete(self):
+        """
+        A complete catalog replaces the snapshot.
+        """
+        df = self.retrieve(CATALOG)
+
+        self.assertEqual(len(df), 3)
+        snapshot = json.loads(self.initializer.snapshot_path.read_text())
+        self.assertEqual(len(snapshot['services']), 3)
+        self.assertFalse(self.initializer.partial_snapshot_path.exists())
+
+    def test_failed_folder(self):
+        """
+        A folder that cannot be retrieved leaves the snapshot alone.
+        """
+        catalog = dict(CATALOG)
+        catalog[f'{URL}/NWS_Climate'] = requests.ConnectionError()
+
+        df = self.retrieve(catalog)
+
+        self.assertEqual(len(df), 2)
+        self.assertEqual(self.initializer.snapshot_path.read_text(),
+                         self.snapshot)
+        self.assertTrue(self.initializer.partial_snapshot_path.exists())
+
+    def test_error_body(self):
+        """
+        ArcGIS reports errors in the body, even with a status of 200.  The
+        folder is treated as failed.
+        """
+        catalog = dict(CATALOG)
+        catalog[f'{URL}/NWS_Climate'] = {
+            'error': {'code': 500, 'message': 'Internal server error'},
+        }
+
+        df = self.retrieve(catalog)
+
+        self.assertEqual(sorted(df['folder']),
+                         ['NOS_Observations', 'NWS_Observations'])
+        self.assertEqual(self.initializer.snapshot_path.read_text(),
+                         self.snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# Standard library imports
+import unittest
+from unittest import mock
+
+# Local imports
+from .utils import ParserTestCase, make_log_lines, write_log_file
+
+
+class TestPrefixes(ParserTestCase):
+
+    def test_summarize_prefixes(self):
+        """
+        The prefix summary is read from the tables keyed by the hour in
+        seconds since the epoch.
+        """
+        path = f'{self.root}/access.log.gz'
+        write_log_file(path, make_log_lines(1200))
+        parser = self.make_parser(infile=path)
+        parser.parse_input(max_workers=1)
+
+        processor = parser.ip_address
+        with mock.patch.object(processor, 'create_html_table') as table:
+            processor.summarize_prefixes(None)
+
+        df = table.call_args[0][0]
+        self.assertEqual(list(df.index),
+                         ['192.0.0.0/24', '192.0.1.0/24', '192.0.2.0/24'])
+        self.assertEqual(df['hits'].sum(), 1200)
+
+    def test_prefixes_with_heavy_hitters(self):
+        """
+        Only the IP addresses are cut down to the heavy hitters, the prefix
+        rollup is exact.
+        """
+        path = f'{self.root}/access.log.gz'
+        write_log_file(path, make_log_lines(3000))
+
+        sql = """
+              SELECT hour_epoch, prefix, hits, errors, nbytes
+              FROM ip_prefix_logs
+              ORDER BY hour_epoch, prefix
+              """
+        # Several batches are combined along the way.
+        rows = {}
+        for heavy_hitters in (None, 5):
+            parser = self.make_parser(infile=path, root=self.make_root(),
+                                      memory_budget=64 * 1024,
+                                      heavy_hitters=heavy_hitters)
+            parser.parse_input(max_workers=1)
+            rows[heavy_hitters] = parser.conn.execute(sql).fetchall()
+
+        self.assertEqual(len(rows[None]), 3)
+        self.assertEqual(rows[5], rows[None])
+
+        # The IP addresses themselves were cut down, though.
+        sql = """
+              SELECT COUNT(*) FROM ip_address_logs
+              """
+        self.assertEqual(parser.conn.execute(sql).fetchone()[0], 6)
+
+
+class TestLookupTable(ParserTestCase):
+
+    def test_keyed_by_address_only(self):
+        """
+        The lookup table has a single unique index, on the binary address,
+        and the reports render the addresses as text.
+        """
+        path = f'{self.root}/access.log.gz'
+        write_log_file(path, make_log_lines(120, addresses=['192.0.2.1',
+                                                            '2001:db8::1']))
+        parser = self.make_parser(infile=path)
+        parser.parse_input(max_workers=1)
+
+        sql = """
+              SELECT name FROM pragma_index_list('ip_address_lut')
+              WHERE "unique"
+              """
+        indexes = [row[0] for row in parser.conn.execute(sql)]
+        self.assertEqual(indexes, ['idx_ip_address_key'])
+
+        processor = parser.ip_address
+        processor.get_timeseries()
+        self.assertEqual(set(processor.df['ip_address']),
+                         {'192.0.2.1', '2001:db8::1'})
+        self.assertEqual(processor.df_today['hits'].sum(), 120)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# Standard library imports
+import os
+import shutil
+import signal
+import threading
+import unittest
+from unittest import mock
+
+# Local imports
+from .utils import ParserTestCase, make_log_lines, write_log_file
+
+
+class TestManifest(ParserTestCase):
+
+    def test_duplicate_in_same_run(self):
+        """
+        A copy of a log file under another name in the same run is only
+        counted once.
+        """
+        paths = [f'{self.root}/foo.log.gz', f'{self.root}/foo (1).log.gz']
+        write_log_file(paths[0], make_log_lines(100))
+        shutil.copyfile(paths[0], paths[1])
+
+        parser = self.make_parser(infile=paths)
+        parser.parse_input(max_workers=1)
+
+        sql = """
+              SELECT SUM(hits) FROM summary
+              """
+        self.assertEqual(parser.conn.execute(sql).fetchone()[0], 100)
+
+        sql = """
+              SELECT filename, records FROM ingest_manifest
+              """
+        self.assertEqual(parser.conn.execute(sql).fetchall(),
+                         [('foo.log.gz', 100)])
+
+
+class TestStream(ParserTestCase):
+
+    def test_interrupted_stdin(self):
+        """
+        Interrupting stdin, e.g. with Ctrl-C, merges the pending batch and
+        ends cleanly, even though the stream itself never ends.
+        """
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        # Few enough lines to fit in the pipe.
+        os.write(write_fd, b''.join(make_log_lines(100)))
+
+        parser = self.make_parser(infile='-')
+        timer = threading.Timer(1, os.kill, (os.getpid(), signal.SIGINT))
+        with mock.patch('sys.stdin', mock.Mock(fileno=lambda: read_fd)):
+            timer.start()
+            parser.parse_input()
+
+        sql = """
+              SELECT SUM(hits) FROM summary
+              """
+        self.assertEqual(parser.conn.execute(sql).fetchone()[0], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
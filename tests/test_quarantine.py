@@ -0,0 +1,38 @@
+# Standard library imports
+import gzip
+import os
+import unittest
+
+# Local imports
+from .utils import ParserTestCase, make_log_lines, write_log_file
+
+
+class TestQuarantine(ParserTestCase):
+
+    def test_same_name_in_different_directories(self):
+        """
+        Log files of the same name in different directories, e.g. one for
+        each host, each get their own quarantine file.
+        """
+        paths = []
+        for host in ('web1', 'web2'):
+            os.mkdir(f'{self.root}/{host}')
+            path = f'{self.root}/{host}/access_log.gz'
+            lines = make_log_lines(10) + [f'garbage from {host}'.encode()]
+            write_log_file(path, lines)
+            paths.append(path)
+
+        parser = self.make_parser(infile=paths)
+        parser.parse_input(max_workers=1)
+
+        unmatched = set()
+        for path in (parser.root / 'quarantine').iterdir():
+            with gzip.open(path) as f:
+                unmatched.update(f.read().splitlines())
+
+        self.assertEqual(unmatched,
+                         {b'garbage from web1', b'garbage from web2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
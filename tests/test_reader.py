@@ -0,0 +1,46 @@
+# Standard library imports
+import io
+import threading
+import time
+import unittest
+
+# Local imports
+from arcgis_apache_logs.reader import BackgroundReader
+
+
+class BlockedStream(io.BufferedReader):
+    """
+    Stands in for stdin when nothing more arrives, blocking in read1 until
+    released.
+    """
+    def __init__(self, raw):
+        super().__init__(raw)
+        self.released = threading.Event()
+
+    def read1(self, size=-1):
+        data = super().read1(size)
+        if len(data) == 0:
+            self.released.wait()
+        return data
+
+
+class TestBackgroundReader(unittest.TestCase):
+
+    def test_close_blocked_stream(self):
+        """
+        Closing does not wait forever on a thread blocked reading a stream.
+        """
+        stream = BlockedStream(io.BytesIO(b'line 1\nline 2\n'))
+        self.addCleanup(stream.released.set)
+
+        reader = BackgroundReader(stream, close_timeout=0.1)
+        with reader:
+            self.assertEqual(next(iter(reader)), [b'line 1', b'line 2'])
+            t0 = time.monotonic()
+
+        self.assertLess(time.monotonic() - t0, 2)
+        self.assertTrue(reader._thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
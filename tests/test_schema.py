@@ -0,0 +1,83 @@
+# Standard library imports
+import datetime as dt
+import logging
+import shutil
+import tempfile
+import unittest
+
+# Local imports
+from arcgis_apache_logs.ip_address import pack_ip_address
+from arcgis_apache_logs.parse_apache_logs import ApacheLogParser
+from arcgis_apache_logs.schema import SCHEMA_VERSION, get_schema_version
+from .legacy import create_legacy_database
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        logger = logging.getLogger('arcgis_apache_logs.parse_apache_logs')
+        logger.disabled = True
+        self.addCleanup(setattr, logger, 'disabled', False)
+
+        self.start = dt.datetime.combine(
+            dt.date.today() - dt.timedelta(days=1), dt.time(10)
+        )
+        create_legacy_database(f'{self.root}/arcgis_apache_idpgis.db',
+                               self.start)
+
+    def test_services_only(self):
+        """
+        A version 0 database is migrated in full even when only the
+        services are processed.
+        """
+        parser = ApacheLogParser('idpgis', document_root=self.root,
+                                 services_only=True)
+        self.addCleanup(parser.conn.close)
+        conn = parser.conn
+
+        self.assertEqual(get_schema_version(conn), SCHEMA_VERSION)
+
+        for table in ('ip_address_logs', 'referer_logs', 'user_agent_logs',
+                      'service_logs', 'summary'):
+            for suffix in ('', '_daily', '_weekly'):
+                with self.subTest(table=table + suffix):
+                    sql = f"""
+                           SELECT SUM(hits) FROM {table}{suffix}
+                           """
+                    self.assertEqual(conn.execute(sql).fetchone()[0], 90)
+
+        # The heavy hitter bounds of the old rows are 0.
+        sql = """
+              SELECT SUM(hits_error) FROM ip_address_logs
+              """
+        self.assertEqual(conn.execute(sql).fetchone()[0], 0)
+
+        # The IP addresses are keyed only in binary form.
+        sql = """
+              PRAGMA table_info(ip_address_lut)
+              """
+        columns = [row[1] for row in conn.execute(sql)]
+        self.assertNotIn('ip_address', columns)
+
+        sql = """
+              SELECT id, address FROM ip_address_lut ORDER BY id
+              """
+        self.assertEqual(conn.execute(sql).fetchall(),
+                         [(1, pack_ip_address('192.0.2.1')),
+                          (2, pack_ip_address('2001:db8::1'))])
+
+        # The families are filled in from the user agents.
+        sql = """
+              SELECT family, SUM(hits)
+              FROM user_agent_family_logs_daily
+              GROUP BY family
+              ORDER BY family
+              """
+        self.assertEqual(len(conn.execute(sql).fetchall()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# Standard library imports
+import collections
+import unittest
+
+# Local imports
+from arcgis_apache_logs.ip_address import OTHER_IP_ADDRESS, pack_ip_address
+from .utils import ParserTestCase, make_log_lines, write_log_file
+
+
+class TestHeavyHitters(ParserTestCase):
+
+    def read_tiers(self, parser):
+        """
+        Returns
+        -------
+            for each tier, rows of (bucket, address, hits, hits_error)
+        """
+        tiers = {}
+        for suffix, key in (('', 'hour_epoch'), ('_daily', 'day_epoch')):
+            sql = f"""
+                   SELECT a.{key}, b.address, a.hits, a.hits_error
+                   FROM ip_address_logs{suffix} a
+                   INNER JOIN ip_address_lut b
+                   ON a.id = b.id
+                   """
+            tiers[suffix] = parser.conn.execute(sql).fetchall()
+        return tiers
+
+    def test_merge_across_runs(self):
+        """
+        Summaries merged into the database by separate runs keep their
+        bounds and their size, for the hours as well as the days.
+        """
+        # Each log file has its own heaviest hitter, plus many light ones,
+        # over the same three hours.
+        paths = []
+        for host in (1, 2, 3):
+            addresses = [f'198.51.100.{host}'] * 20 + [
+                f'203.0.113.{j}' for j in range(host * 20, host * 20 + 40)
+            ]
+            path = f'{self.root}/access.{host}.log.gz'
+            write_log_file(path, make_log_lines(9000, addresses=addresses))
+            paths.append(path)
+
+        exact = self.make_parser(infile=paths, root=self.make_root())
+        exact.parse_input(max_workers=1)
+        expected = self.read_tiers(exact)
+
+        for path in paths:
+            parser = self.make_parser(infile=path, heavy_hitters=5)
+            parser.parse_input(max_workers=1)
+        actual = self.read_tiers(parser)
+
+        for suffix in expected:
+            truth = collections.Counter()
+            for bucket, address, hits, _ in expected[suffix]:
+                truth[bucket, address] += hits
+
+            rows = collections.Counter()
+            totals = collections.Counter()
+            others = {}
+            for bucket, address, hits, hits_error in actual[suffix]:
+                rows[bucket] += 1
+                totals[bucket] += hits
+                if address == OTHER_IP_ADDRESS:
+                    others[bucket] = hits_error
+                    continue
+
+                with self.subTest(tier=suffix, bucket=bucket, key=address):
+                    self.assertLessEqual(hits, truth[bucket, address])
+                    self.assertLessEqual(truth[bucket, address],
+                                         hits + hits_error)
+
+            with self.subTest(tier=suffix):
+                self.assertLessEqual(max(rows.values()), 6)
+
+                # The totals are exact, and the other row bounds the hits of
+                # anything it hides.
+                tracked = {(bucket, address)
+                           for bucket, address, *_ in actual[suffix]}
+                for (bucket, address), hits in truth.items():
+                    totals[bucket] -= hits
+                    if (bucket, address) not in tracked:
+                        self.assertLessEqual(hits, others[bucket])
+                self.assertEqual(set(totals.values()), {0})
+
+                # The heaviest hitter of each log file is tracked.
+                for host in (1, 2, 3):
+                    address = pack_ip_address(f'198.51.100.{host}')
+                    self.assertIn(address, {x[1] for x in tracked})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Standard library imports
+import random
+import unittest
+
+# Local imports
+from arcgis_apache_logs.tokenizer import match_line, tokenize_line
+
+PREFIX = b'192.0.2.1 - - [01/Mar/2019:00:00:01 +0000] '
+
+# Lines at the edges of the layout, each completing PREFIX unless it is a
+# whole line itself.
+EDGE_CASES = [
+    b'"GET /a HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"POST HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET  HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET HTTP/1.1" 200 5 "x HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET /a HTTP/1.1" 200 5 "b" HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET /a b HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET /a - - [ HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET /\xff HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"FOO /a HTTP/1.1" 200 5 "r" "u" "-"',
+    b'"GET /a HTTP/1.0" 200 5 "r" "u" "-"',
+    b'"GET /a HTTP/1.1"  200 5 "r" "u" "-"',
+    b'"GET /a HTTP/1.1" 2x0 5 "r" "u" "-"',
+    b'"GET /a HTTP/1.1" 200 - "r" "u" "-"',
+    b'"GET /a HTTP/1.1" 200  5 "r" "u" "-"',
+    b'"GET /a HTTP/1.1" 200 5  "r" "u" "-"',
+    b'"GET /a HTTP/1.1" 200 5 "" "" "-"',
+    b'"GET /a HTTP/1.1" 200 5 "r "u" "-"',
+    b'"GET /a HTTP/1.1" 200 5 "r" "x" "y" "-"',
+    b'"GET /a HTTP/1.1" 200 5 "r" "u" "-"" "-"',
+    b'"GET /a HTTP/1.1" 200 5 "r" "u"',
+    b'"GET /a HTTP/1.1" 200 5 "r" "u" "-" "-"',
+    b'"GET /a HTTP/1.1" 200 5 "r" "u" "-" extra',
+    b'"GET /a HTTP/1.1" 200 5 "r" "u" "-"\r',
+]
+EDGE_CASES = [PREFIX + line for line in EDGE_CASES] + [
+    b' - - [01/Mar/2019:00:00:01 +0000] "GET /a HTTP/1.1" 200 5 "r" "u" "-"',
+    b'192.0.2.1 x - - [01/Mar/2019:00:00:01 +0000] "GET /a HTTP/1.1" 200 5 '
+    b'"r" "u" "-"',
+    b'192.0.2.1 - - [1/Mar/2019:00:00:01 +0000] "GET /a HTTP/1.1" 200 5 '
+    b'"r" "u" "-"',
+    b'192.0.2.1 - - [01/Mar/2019:00:00:01 -0500] "GET /a HTTP/1.1" 200 5 '
+    b'"r" "u" "-"',
+    b'192.0.2.1 - - [01/Mar/2019:00:00:01 +0000]"GET /a HTTP/1.1" 200 5 '
+    b'"r" "u" "-"',
+]
+
+# Fragments of the layout to splice into lines at random.
+PIECES = [b' ', b'"', b'-', b'0', b'\xff', b' HTTP/1.1" ', b' - - [',
+          b'" "', b'" "-"', b'GET ', b'POST']
+
+
+class TestTokenizer(unittest.TestCase):
+    """
+    Whenever the tokenizer parses a line, the result must be the same as
+    that of the regular expression.
+    """
+    def assertSameAsRegex(self, line):
+        record = tokenize_line(line)
+        if record is not None:
+            expected = match_line(line.decode('utf-8', errors='replace'))
+            self.assertEqual(record, expected, msg=line)
+
+    def test_edge_cases(self):
+        for line in EDGE_CASES:
+            with self.subTest(line=line):
+                self.assertSameAsRegex(line)
+
+    def test_empty_path(self):
+        """
+        The path must be set off by a space on either side.
+        """
+        self.assertIsNone(tokenize_line(EDGE_CASES[1]))
+        self.assertEqual(tokenize_line(EDGE_CASES[3])[2], '')
+
+    def test_mutations(self):
+        """
+        Compare the two on random mutations of the edge cases.
+        """
+        rng = random.Random(0)
+        for _ in range(20000):
+            line = bytearray(rng.choice(EDGE_CASES[:1] + EDGE_CASES))
+            for _ in range(rng.randint(1, 3)):
+                k = rng.randrange(len(line) + 1)
+                op = rng.randrange(3)
+                if op == 0:
+                    del line[k:k + rng.randint(1, 20)]
+                elif op == 1:
+                    line[k:k] = rng.choice(PIECES)
+                elif k < len(line):
+                    line[k] = rng.randrange(32, 127)
+            self.assertSameAsRegex(bytes(line))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# Standard library imports
+import datetime as dt
+import gzip
+import logging
+import shutil
+import tempfile
+import unittest
+
+# 3rd party library imports
+import pandas as pd
+
+# Local imports
+from arcgis_apache_logs.initialize import Initializer
+from arcgis_apache_logs.parse_apache_logs import ApacheLogParser
+
+PATH = (
+    '/idpgis.ncep.noaa.gov.akadns.net/arcgis/rest/services'
+    '/NWS_Observations/radar_base_reflectivity/MapServer/export'
+    '?bbox=-130,20,-60,50&size=800,600&f=image'
+)
+
+
+def make_log_line(ip_address, timestamp, status_code=200, nbytes=1000,
+                  referer='https://www.weather.gov/',
+                  user_agent='Mozilla/5.0 (X11; Linux x86_64) Firefox/66.0'):
+    """
+    Parameters
+    ----------
+    ip_address : str
+        Client of the request.
+    timestamp : datetime
+        Time of the request.
+
+    Returns
+    -------
+        raw log line in the Akamai layout
+    """
+    line = (
+        f'{ip_address} - - [{timestamp:%d/%b/%Y:%H:%M:%S} +0000] '
+        f'"GET {PATH} HTTP/1.1" {status_code} {nbytes} '
+        f'"{referer}" "{user_agent}" "-"\n'
+    )
+    return line.encode('utf-8')
+
+
+def make_log_lines(n, start=None, addresses=None):
+    """
+    Parameters
+    ----------
+    n : int
+        Number of lines, one second apart.
+    start : datetime
+        Time of the first request, defaults to 10 o'clock yesterday.
+    addresses : list
+        IP addresses of the clients, cycled through.  Defaults to a spread
+        over a few /24 networks.
+
+    Returns
+    -------
+        list of raw log lines
+    """
+    if start is None:
+        start = dt.datetime.combine(dt.date.today() - dt.timedelta(days=1),
+                                    dt.time(10))
+    if addresses is None:
+        addresses = [
+            f'192.0.{net}.{host}' for net in range(3) for host in range(40)
+        ]
+
+    return [
+        make_log_line(addresses[j % len(addresses)],
+                      start + dt.timedelta(seconds=j))
+        for j in range(n)
+    ]
+
+
+def write_log_file(path, lines):
+    """
+    Write raw log lines to a gzipped log file.
+    """
+    with gzip.open(path, mode='wb') as f:
+        f.writelines(lines)
+
+
+class ParserTestCase(unittest.TestCase):
+    """
+    Each test gets its own document root, and so its own database,
+    initialized from a snapshot of a single service.
+    """
+    def setUp(self):
+        # Keep the chatter out of the test output.
+        for name in ('initialize', 'parse_apache_logs'):
+            logger = logging.getLogger(f'arcgis_apache_logs.{name}')
+            logger.disabled = True
+            self.addCleanup(setattr, logger, 'disabled', False)
+
+        self.root = self.make_root()
+
+    def make_root(self):
+        """
+        Returns
+        -------
+            a new document root with an initialized database
+        """
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        initializer = Initializer('idpgis', document_root=root)
+        df = pd.DataFrame({
+            'folder': ['NWS_Observations'],
+            'service': ['radar_base_reflectivity'],
+            'service_type': ['MapServer'],
+        })
+        initializer.save_snapshot(df)
+        initializer.initialize(snapshot=initializer.snapshot_path)
+        initializer.conn.close()
+
+        return root
+
+    def make_parser(self, infile=None, root=None, **kwargs):
+        """
+        Returns
+        -------
+            parser for the database of the document root, by default the
+            test's own
+        """
+        root = self.root if root is None else root
+        parser = ApacheLogParser('idpgis', infile=infile, document_root=root,
+                                 **kwargs)
+        self.addCleanup(parser.conn.close)
+        return parser